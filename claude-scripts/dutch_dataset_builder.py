@@ -3,11 +3,16 @@ Build Dutch pronoun fidelity dataset
 Adapted from the original RUFF methodology with Dutch templates
 """
 
-import csv
-import sys
+import argparse
+import hashlib
 import itertools
+import json
+import multiprocessing
+import os
+import time
+from datetime import datetime, timezone
+from functools import partial
 from pathlib import Path
-import pandas as pd
 from dutch_templates import dutch_mapping, dutch_occupation_to_participant, dutch_context_templates, dutch_task_templates
 
 def instantiate_template(template, occupation, participant, pronoun_type, pronoun):
@@ -34,10 +39,8 @@ def build_pronoun_type_template_mapping():
     
     return pronoun_type_template_mapping
 
-def create_base_dataset():
-    """Create base dataset with occupation-participant pairs and task templates"""
-    base_data = []
-    
+def iter_base_rows():
+    """Yield base rows (occupation-participant pairs with task templates) one at a time, grouped by occupation"""
     for occupation, participant in dutch_occupation_to_participant.items():
         for pronoun_type, task_templates in dutch_task_templates.items():
             for task_template in task_templates:
@@ -45,16 +48,14 @@ def create_base_dataset():
                     # Create the task sentence with the target pronoun as placeholder
                     task_sentence = task_template.replace('$OCCUPATION', occupation)
                     
-                    base_data.append({
+                    yield {
                         'occupation': occupation,
                         'participant': participant,
                         'sentence': task_sentence,
                         'pronoun_type': pronoun_type,
                         'word': occupation,  # The word being referred to
                         'target_pronoun': pronoun
-                    })
-    
-    return base_data
+                    }
 
 def get_output_line(row, context, pronoun1, uid, confuse=''):
     """Format output line for dataset"""
@@ -75,16 +76,11 @@ def get_output_line(row, context, pronoun1, uid, confuse=''):
         confuse
     ]) + '\n'
 
-def add_dutch_context(base_data, pronoun_type_template_mapping, occupation_focus=True):
-    """Add context to base dataset following original methodology"""
-    
-    # Determine file naming
+def get_file_patterns(occupation_focus=True):
+    """Output file names, from the explicit introduction only to four implicit distractors"""
     f = 'o' if occupation_focus else 'p'  # first entity focus
     s = 'p' if occupation_focus else 'o'  # second entity focus
-    
-    # Create output files
-    output_files = {}
-    file_patterns = [
+    return [
         f'e{f}_dutch_base.tsv',
         f'e{f}_e{s}_dutch_base.tsv', 
         f'e{f}_e{s}_i{s}_dutch_base.tsv',
@@ -92,119 +88,186 @@ def add_dutch_context(base_data, pronoun_type_template_mapping, occupation_focus
         f'e{f}_e{s}_i{s}_i{s}_i{s}_dutch_base.tsv',
         f'e{f}_e{s}_i{s}_i{s}_i{s}_i{s}_dutch_base.tsv'
     ]
-    
-    for pattern in file_patterns:
-        output_files[pattern] = open(pattern, 'w', encoding='utf-8')
-    
-    # Write headers
-    header = 'occupation\tparticipant\tsentence\tpronoun_type\tword\tpronoun\tuid\tconfuse_pronoun\n'
-    for f_obj in output_files.values():
-        f_obj.write(header)
-    
-    try:
-        first = 'occupation' if occupation_focus else 'participant'
-        second = 'participant' if occupation_focus else 'occupation'
-        
-        for row in base_data:
-            pronoun_type = row['pronoun_type']
-            pronouns = dutch_mapping[pronoun_type]
-            
-            # Generate contexts with different complexity levels
-            for i, (e1, s1) in enumerate(pronoun_type_template_mapping['explicit_template'][pronoun_type]):
-                for pronoun1 in pronouns:
-                    # Single explicit context
-                    intro1 = instantiate_template(e1, row['occupation'], row['participant'], pronoun_type, pronoun1)
-                    output_files[f'e{f}_dutch_base.tsv'].write(
-                        get_output_line(row, [intro1], pronoun1, f'e{f}{i}'))
-                    
-                    # Two explicit contexts with different sentiment
-                    for j, (e2, s2) in enumerate(pronoun_type_template_mapping['explicit_template'][pronoun_type]):
-                        if (j % 5) == (i % 5):  # Different content
+
+def get_row_lines(row, pronoun_type_template_mapping, occupation_focus=True):
+    """Generate the output lines of one base row for every output file, following original methodology
+
+    Returns one (text, number of lines) pair per output file, in the order of get_file_patterns.
+    """
+    f = 'o' if occupation_focus else 'p'  # first entity focus
+    s = 'p' if occupation_focus else 'o'  # second entity focus
+    lines = {pattern: [] for pattern in get_file_patterns(occupation_focus)}
+    pronoun_type = row['pronoun_type']
+    pronouns = dutch_mapping[pronoun_type]
+
+    # Generate contexts with different complexity levels
+    for i, (e1, s1) in enumerate(pronoun_type_template_mapping['explicit_template'][pronoun_type]):
+        for pronoun1 in pronouns:
+            # Single explicit context
+            intro1 = instantiate_template(e1, row['occupation'], row['participant'], pronoun_type, pronoun1)
+            lines[f'e{f}_dutch_base.tsv'].append(
+                get_output_line(row, [intro1], pronoun1, f'e{f}{i}'))
+
+            # Two explicit contexts with different sentiment
+            for j, (e2, s2) in enumerate(pronoun_type_template_mapping['explicit_template'][pronoun_type]):
+                if (j % 5) == (i % 5):  # Different content
+                    continue
+                if s2 == s1:  # Different sentiment
+                    continue
+
+                for pronoun2 in pronouns:
+                    if pronoun1 == pronoun2:  # Different pronouns
+                        continue
+
+                    # Use second entity for second context
+                    second_entity = row['participant'] if occupation_focus else row['occupation']
+                    intro2 = instantiate_template(e2, second_entity, second_entity, pronoun_type, pronoun2)
+
+                    lines[f'e{f}_e{s}_dutch_base.tsv'].append(
+                        get_output_line(row, [intro1, intro2], pronoun1, f'e{f}{i}_e{s}{j}', pronoun2))
+
+                    # Add implicit continuations
+                    implicit_continuations = []
+                    for k, (it, st) in enumerate(pronoun_type_template_mapping['implicit_template'][pronoun_type]):
+                        if k == j or k == i:
                             continue
-                        if s2 == s1:  # Different sentiment
+                        if st != s2:  # Same sentiment as last explicit
                             continue
-                            
-                        for pronoun2 in pronouns:
-                            if pronoun1 == pronoun2:  # Different pronouns
-                                continue
-                                
-                            # Use second entity for second context
-                            second_entity = row['participant'] if occupation_focus else row['occupation']
-                            intro2 = instantiate_template(e2, second_entity, second_entity, pronoun_type, pronoun2)
-                            
-                            output_files[f'e{f}_e{s}_dutch_base.tsv'].write(
-                                get_output_line(row, [intro1, intro2], pronoun1, f'e{f}{i}_e{s}{j}', pronoun2))
-                            
-                            # Add implicit continuations
-                            implicit_continuations = []
-                            for k, (it, st) in enumerate(pronoun_type_template_mapping['implicit_template'][pronoun_type]):
-                                if k == j or k == i:
-                                    continue
-                                if st != s2:  # Same sentiment as last explicit
-                                    continue
-                                    
-                                implicit = instantiate_template(it, second_entity, second_entity, pronoun_type, pronoun2)
-                                implicit_continuations.append((k, implicit))
-                            
-                            if len(implicit_continuations) >= 4:
-                                implicit_continuations = implicit_continuations[:4]  # Take first 4
-                                
-                                # Single implicit
-                                for perm in itertools.permutations(implicit_continuations, 1):
-                                    k1, i1 = perm[0]
-                                    output_files[f'e{f}_e{s}_i{s}_dutch_base.tsv'].write(
-                                        get_output_line(row, [intro1, intro2, i1], pronoun1,
-                                                       f'e{f}{i}_e{s}{j}_i{s}{k1}', pronoun2))
-                                
-                                # Two implicit
-                                for perm in itertools.permutations(implicit_continuations, 2):
-                                    k1, i1 = perm[0]
-                                    k2, i2 = perm[1]
-                                    output_files[f'e{f}_e{s}_i{s}_i{s}_dutch_base.tsv'].write(
-                                        get_output_line(row, [intro1, intro2, i1, i2], pronoun1,
-                                                       f'e{f}{i}_e{s}{j}_i{s}{k1}_i{s}{k2}', pronoun2))
-                                
-                                # Three and four implicit (using all 4)
-                                for perm in itertools.permutations(implicit_continuations, 4):
-                                    k1, i1 = perm[0]
-                                    k2, i2 = perm[1] 
-                                    k3, i3 = perm[2]
-                                    k4, i4 = perm[3]
-                                    
-                                    output_files[f'e{f}_e{s}_i{s}_i{s}_i{s}_dutch_base.tsv'].write(
-                                        get_output_line(row, [intro1, intro2, i1, i2, i3], pronoun1,
-                                                       f'e{f}{i}_e{s}{j}_i{s}{k1}_i{s}{k2}_i{s}{k3}', pronoun2))
-                                    
-                                    output_files[f'e{f}_e{s}_i{s}_i{s}_i{s}_i{s}_dutch_base.tsv'].write(
-                                        get_output_line(row, [intro1, intro2, i1, i2, i3, i4], pronoun1,
-                                                       f'e{f}{i}_e{s}{j}_i{s}{k1}_i{s}{k2}_i{s}{k3}_i{s}{k4}', pronoun2))
-    
+
+                        implicit = instantiate_template(it, second_entity, second_entity, pronoun_type, pronoun2)
+                        implicit_continuations.append((k, implicit))
+
+                    if len(implicit_continuations) >= 4:
+                        implicit_continuations = implicit_continuations[:4]  # Take first 4
+
+                        # Single implicit
+                        for perm in itertools.permutations(implicit_continuations, 1):
+                            k1, i1 = perm[0]
+                            lines[f'e{f}_e{s}_i{s}_dutch_base.tsv'].append(
+                                get_output_line(row, [intro1, intro2, i1], pronoun1,
+                                               f'e{f}{i}_e{s}{j}_i{s}{k1}', pronoun2))
+
+                        # Two implicit
+                        for perm in itertools.permutations(implicit_continuations, 2):
+                            k1, i1 = perm[0]
+                            k2, i2 = perm[1]
+                            lines[f'e{f}_e{s}_i{s}_i{s}_dutch_base.tsv'].append(
+                                get_output_line(row, [intro1, intro2, i1, i2], pronoun1,
+                                               f'e{f}{i}_e{s}{j}_i{s}{k1}_i{s}{k2}', pronoun2))
+
+                        # Three and four implicit (using all 4)
+                        for perm in itertools.permutations(implicit_continuations, 4):
+                            k1, i1 = perm[0]
+                            k2, i2 = perm[1] 
+                            k3, i3 = perm[2]
+                            k4, i4 = perm[3]
+
+                            lines[f'e{f}_e{s}_i{s}_i{s}_i{s}_dutch_base.tsv'].append(
+                                get_output_line(row, [intro1, intro2, i1, i2, i3], pronoun1,
+                                               f'e{f}{i}_e{s}{j}_i{s}{k1}_i{s}{k2}_i{s}{k3}', pronoun2))
+
+                            lines[f'e{f}_e{s}_i{s}_i{s}_i{s}_i{s}_dutch_base.tsv'].append(
+                                get_output_line(row, [intro1, intro2, i1, i2, i3, i4], pronoun1,
+                                               f'e{f}{i}_e{s}{j}_i{s}{k1}_i{s}{k2}_i{s}{k3}_i{s}{k4}', pronoun2))
+
+    return [(''.join(file_lines), len(file_lines)) for file_lines in lines.values()]
+
+class TrackedFile:
+    """Output file that counts its rows and bytes and computes its checksum while it is written"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.f = open(self.path, 'wb')
+        self.rows = 0
+        self.bytes = 0
+        self.sha256 = hashlib.sha256()
+
+    def write(self, text, rows=0):
+        data = text.encode('utf-8')
+        self.f.write(data)
+        self.sha256.update(data)
+        self.bytes += len(data)
+        self.rows += rows
+
+    def close(self):
+        self.f.close()
+
+    def get_entry(self):
+        """Manifest entry of the file"""
+        return {'file': self.path.name, 'rows': self.rows, 'bytes': self.bytes, 'sha256': self.sha256.hexdigest()}
+
+def add_dutch_context(base_rows, pronoun_type_template_mapping, occupation_focus=True, workers=1):
+    """Add context to base rows following original methodology, streaming them into the output files
+
+    Base rows are consumed lazily; with several workers their contexts are generated in parallel processes (each
+    occupation's rows spread over the workers) and written in input order, so the files do not depend on the
+    number of workers. Returns the manifest entry of every output file.
+    """
+    header = 'occupation\tparticipant\tsentence\tpronoun_type\tword\tpronoun\tuid\tconfuse_pronoun\n'
+    output_files = [TrackedFile(pattern) for pattern in get_file_patterns(occupation_focus)]
+    row_lines = partial(get_row_lines, pronoun_type_template_mapping=pronoun_type_template_mapping,
+                        occupation_focus=occupation_focus)
+    try:
+        for f_obj in output_files:
+            f_obj.write(header)
+
+        if workers <= 1:
+            results = map(row_lines, base_rows)
+            for file_chunks in results:
+                for f_obj, (text, rows) in zip(output_files, file_chunks):
+                    f_obj.write(text, rows)
+        else:
+            # imap keeps the input order and only holds a few rows' output at a time
+            with multiprocessing.Pool(workers) as pool:
+                for file_chunks in pool.imap(row_lines, base_rows):
+                    for f_obj, (text, rows) in zip(output_files, file_chunks):
+                        f_obj.write(text, rows)
     finally:
         # Close all files
-        for f_obj in output_files.values():
+        for f_obj in output_files:
             f_obj.close()
+    return [f_obj.get_entry() for f_obj in output_files]
+
+def write_manifest(path, files, base_rows, workers, started, seconds):
+    """Write a machine-readable manifest of the generated files"""
+    manifest = {
+        'created': started,
+        'seconds': round(seconds, 3),
+        'workers': workers,
+        'base_rows': base_rows,
+        'occupations': len(dutch_occupation_to_participant),
+        'files': files,
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1)
 
 def main():
     """Main function to build Dutch dataset"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of processes generating contexts')
+    parser.add_argument('--manifest', default='dutch_manifest.json',
+                        help='manifest with the rows, bytes and checksum of every generated file')
+    args = parser.parse_args()
     print("Building Dutch pronoun fidelity dataset...")
-    
-    # Create base dataset
-    base_data = create_base_dataset()
-    print(f"Created {len(base_data)} base examples")
-    
+    started = datetime.now(timezone.utc).isoformat(timespec='seconds')
+    start = time.perf_counter()
+
     # Build template mapping
     pronoun_type_template_mapping = build_pronoun_type_template_mapping()
-    
-    # Add context (focusing on occupation first)
-    add_dutch_context(base_data, pronoun_type_template_mapping, occupation_focus=True)
-    
-    print("Dataset creation complete!")
+
+    # Add context (focusing on occupation first), counting the base rows as they stream past
+    base_count = itertools.count()
+    base_rows = (row for row, _ in zip(iter_base_rows(), base_count))
+    files = add_dutch_context(base_rows, pronoun_type_template_mapping, occupation_focus=True, workers=args.workers)
+    seconds = time.perf_counter() - start
+    write_manifest(args.manifest, files, next(base_count), args.workers, started, seconds)
+
+    print(f"Dataset creation complete in {seconds:.1f}s!")
     print("Generated files:")
-    for pattern in ['eo_dutch_base.tsv', 'eo_ep_dutch_base.tsv', 'eo_ep_ip_dutch_base.tsv', 
-                   'eo_ep_ip_ip_dutch_base.tsv', 'eo_ep_ip_ip_ip_dutch_base.tsv', 'eo_ep_ip_ip_ip_ip_dutch_base.tsv']:
-        if Path(pattern).exists():
-            size = len(pd.read_csv(pattern, sep='\t'))
-            print(f"  {pattern}: {size} examples")
+    for entry in files:
+        print(f"  {entry['file']}: {entry['rows']} examples, {entry['bytes']} bytes")
+    print(f"Manifest: {args.manifest}")
 
 if __name__ == '__main__':
     main()
@@ -1,9 +1,20 @@
+import argparse
+import contextlib
 import csv
-import sys
+import gzip
 import itertools
+import multiprocessing
+import os
+from collections import deque
+from functools import partial
 from pronouns import mapping
 from pathlib import Path
+from storage import TableWriter, tsv_chunk_to_arrow
 import pandas as pd
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 def instantiate_template(template, occupation, pronoun_type, pronoun):
     return template.replace('$OCCUPATION/PARTICIPANT', occupation).replace(pronoun_type, pronoun)
@@ -35,87 +46,177 @@ def get_output_line(row, context, pronoun1, uid, confuse=''):
                       uid,
                       confuse]) + '\n'
 
-def add_context(filename, pronoun_type_template_mapping, occupation):
+def get_output_names(basename, occupation):
     f = 'o' if occupation else 'p' # first
     s = 'p' if occupation else 'o' # second
+    return [f'e{f}_{basename}.tsv',
+            f'e{f}_e{s}_{basename}.tsv',
+            f'e{f}_e{s}_i{s}_{basename}.tsv',
+            f'e{f}_e{s}_i{s}_i{s}_{basename}.tsv',
+            f'e{f}_e{s}_i{s}_i{s}_i{s}_{basename}.tsv',
+            f'e{f}_e{s}_i{s}_i{s}_i{s}_i{s}_{basename}.tsv']
+
+def build_context_plan(pronoun_type_template_mapping, pronoun_type):
+    # the template combinations only depend on the pronoun type, not on the task row:
+    # a list of (i, pronoun1, [(j, pronoun2, implicit_ks), ...]) in output order
+    explicit_templates = pronoun_type_template_mapping['explicit_template'][pronoun_type]
+    implicit_templates = pronoun_type_template_mapping['implicit_template'][pronoun_type]
+    pronouns = mapping[pronoun_type]
+    plan = []
+    for i, (e1, s1) in enumerate(explicit_templates):
+        for pronoun1 in pronouns:
+            seconds = []
+            for j, (e2, s2) in enumerate(explicit_templates):
+                if (j % 5) == (i % 5): # second template cannot have the same content as the first, regardless of polarity
+                    continue
+                if s2 == s1: # use the opposite sentiment
+                    continue
+                # implicit continuations must have the same sentiment and referent as the last intro
+                # it should not have the same content as either intro
+                # i.e., there should be 4 options
+                implicit_ks = [k for k, (it, st) in enumerate(implicit_templates) if k != j and k != i and st == s2]
+                assert len(implicit_ks) == 4
+                for pronoun2 in pronouns:
+                    if pronoun1 == pronoun2: # we need unique pronouns for each entity being spoken about
+                        continue
+                    seconds.append((j, pronoun2, implicit_ks))
+            plan.append((i, pronoun1, seconds))
+    return plan
+
+def build_context_plans(pronoun_type_template_mapping):
+    return {pronoun_type: build_context_plan(pronoun_type_template_mapping, pronoun_type) for pronoun_type in mapping}
+
+def get_row_lines(row, pronoun_type_template_mapping, plans, occupation):
+    # all output lines of one task row, as one string per output file (same order as get_output_names)
+    f = 'o' if occupation else 'p' # first
+    s = 'p' if occupation else 'o' # second
+    first = 'occupation' if occupation else 'participant'
+    second = 'participant' if occupation else 'occupation'
+    pronoun_type = row['pronoun_type']
+    explicit_templates = pronoun_type_template_mapping['explicit_template'][pronoun_type]
+    implicit_templates = pronoun_type_template_mapping['implicit_template'][pronoun_type]
+
+    # instantiate and capitalize every context sentence once per (template, entity, pronoun)
+    intros1, intros2, implicits = {}, {}, {}
+    def intro1(i, pronoun):
+        if (i, pronoun) not in intros1:
+            intros1[i, pronoun] = instantiate_template(explicit_templates[i][0], row[first], pronoun_type, pronoun).capitalize()
+        return intros1[i, pronoun]
+    def intro2(j, pronoun):
+        if (j, pronoun) not in intros2:
+            intros2[j, pronoun] = instantiate_template(explicit_templates[j][0], row[second], pronoun_type, pronoun).capitalize()
+        return intros2[j, pronoun]
+    def implicit(k, pronoun):
+        # must be filled with the same pronoun as the last intro because it is the same referent
+        if (k, pronoun) not in implicits:
+            implicits[k, pronoun] = instantiate_template(implicit_templates[k][0], row[second], pronoun_type, pronoun).capitalize()
+        return implicits[k, pronoun]
+
+    head = f"{row['occupation']}\t{row['participant']}\t"
+    tail = f" {row['sentence']}\t{pronoun_type}\t{row['word']}\t"
+    ef, ef_es, ef_es_is, ef_es_is_is, ef_es_is_is_is, ef_es_is_is_is_is = [], [], [], [], [], []
+    for i, pronoun1, seconds in plans[pronoun_type]:
+        context1 = head + intro1(i, pronoun1)
+        ef.append(f'{context1}{tail}{pronoun1}\te{f}{i}\t\n')
+        for j, pronoun2, implicit_ks in seconds:
+            context2 = f'{context1} {intro2(j, pronoun2)}'
+            uid2 = f'e{f}{i}_e{s}{j}'
+            end = f'\t{pronoun2}\n'
+            ef_es.append(f'{context2}{tail}{pronoun1}\t{uid2}{end}')
+            continuations = [(f'_i{s}{k}', ' ' + implicit(k, pronoun2)) for k in implicit_ks]
+
+            for u1, i1 in continuations:
+                ef_es_is.append(f'{context2}{i1}{tail}{pronoun1}\t{uid2}{u1}{end}')
+
+            for (u1, i1), (u2, i2) in itertools.permutations(continuations, 2):
+                ef_es_is_is.append(f'{context2}{i1}{i2}{tail}{pronoun1}\t{uid2}{u1}{u2}{end}')
+
+            # exploit the fact that perm(S, 3) == perm(S, 4) when |S| == 4
+            for (u1, i1), (u2, i2), (u3, i3), (u4, i4) in itertools.permutations(continuations, 4):
+                context3 = f'{context2}{i1}{i2}{i3}'
+                uid3 = f'{uid2}{u1}{u2}{u3}'
+                ef_es_is_is_is.append(f'{context3}{tail}{pronoun1}\t{uid3}{end}')
+                ef_es_is_is_is_is.append(f'{context3}{i4}{tail}{pronoun1}\t{uid3}{u4}{end}')
+
+    return [''.join(lines) for lines in (ef, ef_es, ef_es_is, ef_es_is_is, ef_es_is_is_is, ef_es_is_is_is_is)]
+
+def compress_text(text, compression):
+    # gzip members and zstd frames can be concatenated, so every chunk is compressed independently
+    data = text.encode('utf-8')
+    if compression == 'gzip':
+        return gzip.compress(data, compresslevel=6)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ImportError('zstd compression requires the zstandard package')
+        return zstandard.ZstdCompressor().compress(data)
+    return data
+
+def get_compressed_row_lines(row, pronoun_type_template_mapping, plans, occupation, compression):
+    return [compress_text(text, compression) for text in get_row_lines(row, pronoun_type_template_mapping, plans, occupation)]
+
+def get_row_tables(row, pronoun_type_template_mapping, plans, occupation, header):
+    return [tsv_chunk_to_arrow(text, header) for text in get_row_lines(row, pronoun_type_template_mapping, plans, occupation)]
+
+def add_context(filename, pronoun_type_template_mapping, occupation, workers=1, compression=None, output_format='tsv',
+                buffer_size=16 * 1024 * 1024):
     basename = Path(filename).stem
-    with open(filename, 'r', encoding='utf-8') as in_f, \
-         open(f'e{f}_{basename}.tsv', 'w', encoding='utf-8') as ef_f, \
-         open(f'e{f}_e{s}_{basename}.tsv', 'w', encoding='utf-8') as ef_es_f, \
-         open(f'e{f}_e{s}_i{s}_{basename}.tsv', 'w', encoding='utf-8') as ef_es_is_f, \
-         open(f'e{f}_e{s}_i{s}_i{s}_{basename}.tsv', 'w', encoding='utf-8') as ef_es_is_is_f, \
-         open(f'e{f}_e{s}_i{s}_i{s}_i{s}_{basename}.tsv', 'w', encoding='utf-8') as ef_es_is_is_is_f, \
-         open(f'e{f}_e{s}_i{s}_i{s}_i{s}_i{s}_{basename}.tsv', 'w', encoding='utf-8') as ef_es_is_is_is_is_f:
-        header = 'occupation\tparticipant\tsentence\tpronoun_type\tword\tpronoun\tuid\tconfuse_pronoun\n'
-        ef_f.write(header)
-        ef_es_f.write(header)
-        ef_es_is_f.write(header)
-        ef_es_is_is_f.write(header)
-        ef_es_is_is_is_f.write(header)
-        ef_es_is_is_is_is_f.write(header)
-        reader  = csv.DictReader(in_f, delimiter='\t')
-        first = 'occupation' if occupation else 'participant'
-        second = 'participant' if occupation else 'occupation'
-        for row in reader:
-            pronoun_type = row['pronoun_type']
-            pronouns = mapping[pronoun_type]
-            for i, (e1, s1) in enumerate(pronoun_type_template_mapping['explicit_template'][pronoun_type]):
-                for pronoun1 in pronouns:
-                    intro1 = instantiate_template(e1, row[first], pronoun_type, pronoun1)
-                    ef_f.write(get_output_line(row, [intro1], pronoun1, f'e{f}{i}'))
-
-                    for j, (e2, s2) in enumerate(pronoun_type_template_mapping['explicit_template'][pronoun_type]):
-                        if (j % 5) == (i % 5): # second template cannot have the same content as the first, regardless of polarity
-                            continue
-                        if s2 == s1: # use the opposite sentiment
-                            continue
-                        for pronoun2 in pronouns:
-                            if pronoun1 == pronoun2: # we need unique pronouns for each entity being spoken about
-                                continue
-                            intro2 = instantiate_template(e2, row[second], pronoun_type, pronoun2)
-                            ef_es_f.write(get_output_line(row, [intro1, intro2], pronoun1, f'e{f}{i}_e{s}{j}', pronoun2))
-
-                            # implicit continuations must have the same sentiment and referent as the last intro
-                            # it should not have the same content as either intro
-                            # i.e., there should be 4 options
-                            implicit_continuations = []
-                            for k, (it, st) in enumerate(pronoun_type_template_mapping['implicit_template'][pronoun_type]):
-                                if k == j or k == i:
-                                    continue
-                                if st != s2:
-                                    continue
-                                # must be filled with the same pronoun as the last intro because it is the same referent
-                                implicit = instantiate_template(it, row[second], pronoun_type, pronoun2)
-                                implicit_continuations.append((k, implicit))
-                            assert len(implicit_continuations) == 4
-
-                            for perm in itertools.permutations(implicit_continuations, 1):
-                                k1, i1 = perm[0]
-                                ef_es_is_f.write(get_output_line(row, [intro1, intro2, i1], pronoun1,
-                                                 f'e{f}{i}_e{s}{j}_i{s}{k1}', pronoun2))
-
-                            for perm in itertools.permutations(implicit_continuations, 2):
-                                k1, i1 = perm[0]
-                                k2, i2 = perm[1]
-                                ef_es_is_is_f.write(get_output_line(row, [intro1, intro2, i1, i2], pronoun1,
-                                                 f'e{f}{i}_e{s}{j}_i{s}{k1}_i{s}{k2}', pronoun2))
-
-                            # exploit the fact that perm(S, 3) == perm(S, 4) when |S| == 4
-                            for perm in itertools.permutations(implicit_continuations, 4):
-                                k1, i1 = perm[0]
-                                k2, i2 = perm[1]
-                                k3, i3 = perm[2]
-                                k4, i4 = perm[3]
-                                ef_es_is_is_is_f.write(get_output_line(row, [intro1, intro2, i1, i2, i3], pronoun1,
-                                                 f'e{f}{i}_e{s}{j}_i{s}{k1}_i{s}{k2}_i{s}{k3}', pronoun2))
-                                ef_es_is_is_is_is_f.write(get_output_line(row, [intro1, intro2, i1, i2, i3, i4], pronoun1,
-                                                 f'e{f}{i}_e{s}{j}_i{s}{k1}_i{s}{k2}_i{s}{k3}_i{s}{k4}', pronoun2))
+    plans = build_context_plans(pronoun_type_template_mapping)
+    header = ['occupation', 'participant', 'sentence', 'pronoun_type', 'word', 'pronoun', 'uid', 'confuse_pronoun']
+    kwargs = {'pronoun_type_template_mapping': pronoun_type_template_mapping, 'plans': plans, 'occupation': occupation}
+
+    with contextlib.ExitStack() as stack:
+        in_f = stack.enter_context(open(filename, 'r', encoding='utf-8'))
+        names = get_output_names(basename, occupation)
+        if output_format == 'parquet':
+            assert compression is None, 'parquet files are always compressed'
+            row_lines = partial(get_row_tables, header=header, **kwargs)
+            out_fs = [stack.enter_context(TableWriter(Path(name).with_suffix('.parquet'), header)) for name in names]
+        else:
+            suffix = {None: '', 'gzip': '.gz', 'zstd': '.zst'}[compression]
+            row_lines = partial(get_compressed_row_lines, compression=compression, **kwargs)
+            out_fs = [stack.enter_context(open(name + suffix, 'wb', buffering=buffer_size)) for name in names]
+            for out_f in out_fs:
+                out_f.write(compress_text('\t'.join(header) + '\n', compression))
+        reader = csv.DictReader(in_f, delimiter='\t')
+
+        def write(chunks):
+            for out_f, chunk in zip(out_fs, chunks):
+                if output_format == 'parquet':
+                    out_f.write_arrow_table(chunk)
+                else:
+                    out_f.write(chunk)
+
+        if workers <= 1:
+            for row in reader:
+                write(row_lines(row))
+            return
+
+        # task rows are sharded across processes; results are written in input order and at most
+        # 2 * workers rows are in flight to bound memory
+        with multiprocessing.Pool(workers) as pool:
+            pending = deque()
+            for row in reader:
+                pending.append(pool.apply_async(row_lines, (row,)))
+                if len(pending) >= 2 * workers:
+                    write(pending.popleft().get())
+            while pending:
+                write(pending.popleft().get())
 
 
 def main():
-    assert len(sys.argv) == 3
-    pronoun_type_template_mapping = build_pronoun_type_template_mapping(sys.argv[2])
-    add_context(sys.argv[1], pronoun_type_template_mapping, occupation=True)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('task_file')
+    parser.add_argument('context_file')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of processes the task rows are sharded across')
+    parser.add_argument('--compression', choices=['gzip', 'zstd'], default=None,
+                        help='write compressed files (.gz/.zst); the decompressed content is unchanged')
+    parser.add_argument('--format', choices=['tsv', 'parquet'], default='tsv',
+                        help='parquet writes dictionary-encoded columnar files instead of tsv')
+    args = parser.parse_args()
+    pronoun_type_template_mapping = build_pronoun_type_template_mapping(args.context_file)
+    add_context(args.task_file, pronoun_type_template_mapping, occupation=True,
+                workers=args.workers, compression=args.compression, output_format=args.format)
 
 if __name__ == '__main__':
     main()
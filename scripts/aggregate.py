@@ -0,0 +1,176 @@
+import argparse
+import json
+import multiprocessing
+import os
+import re
+from functools import partial
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from answers import extract_answers, language_mappings
+from storage import get_format, read_table, write_table, TableReader
+
+key_columns = ['model', 'kind', 'setting', 'seed', 'distractors', 'prompt', 'pronoun_type', 'pronoun']
+summary_columns = key_columns + ['n', 'correct', 'ambiguous', 'results_file', 'accuracy']
+result_suffixes = {'.tsv', '.parquet'}
+
+def get_nominatives(language):
+    # every pronoun form as its nominative, e.g. ('$POSS_PRONOUN', 'their') -> 'they'
+    mapping = language_mappings[language]
+    return {(pronoun_type, p): mapping['$NOM_PRONOUN'][n]
+            for pronoun_type, pronouns in mapping.items() for n, p in enumerate(pronouns)}
+
+def get_sources_path(summary_file):
+    return Path(summary_file).with_name(Path(summary_file).name + '.sources.json')
+
+def find_result_files(results_dirs):
+    # results files of score_models.py; hidden partial and shard files and journals are left out
+    return [str(path) for results_dir in results_dirs for path in sorted(Path(results_dir).iterdir())
+            if path.suffix in result_suffixes and not path.name.startswith('.')]
+
+def get_stamp(results_file):
+    stat = os.stat(results_file)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def parse_setting(stem):
+    # e.g. 13_eo_ep_ip_task -> ('eo_ep_ip_task', '13', 2): each explicit or implicit participant is a distractor
+    seed, setting = re.fullmatch(r'(?:(\d+)_)?(.*)', stem).groups()
+    parts = setting.split('_')
+    return setting, seed or '', parts.count('ep') + parts.count('ip')
+
+def count_groups(columns, *flags):
+    # rows, and rows with each flag set, per combination of column values: the columns are factorized and combined
+    # into one integer code per row, which numpy counts in a single pass
+    codes = np.zeros(len(flags[0]), dtype=np.int64)
+    uniques = []
+    for column in columns:
+        column_codes, column_uniques = pd.factorize(np.asarray(column, dtype=object), use_na_sentinel=False)
+        codes = codes * len(column_uniques) + column_codes
+        uniques.append(np.asarray(column_uniques, dtype=object))
+    groups, inverse = np.unique(codes, return_inverse=True)
+    n = np.bincount(inverse, minlength=len(groups))
+    counts = [np.bincount(inverse, weights=flag, minlength=len(groups)).astype(np.int64) for flag in flags]
+    keys = []
+    for column_uniques in reversed(uniques):
+        keys.append(column_uniques[groups % len(column_uniques)])
+        groups = groups // len(column_uniques)
+    return keys[::-1], n, *counts
+
+def summarize_file(results_file, language='en'):
+    """Counts of rows and of correct answers in one results file per prompt, pronoun type and declared pronoun.
+
+    A scored row is correct if the best-scoring pronoun is the declared one, a prompted row if the generation
+    names the declared pronoun and no other pronoun of the same type (see answers.py); prompted rows that name
+    several are counted as ambiguous. Pronouns are reported as their nominative.
+    """
+    path = Path(results_file)
+    kind = 'prompt' if path.stem.startswith('prompt_') else 'score'
+    model = path.stem[len('prompt_'):] if kind == 'prompt' else path.stem
+    setting, seed, distractors = parse_setting(path.parent.name)
+    answer_column = 'generation' if kind == 'prompt' else 'verbalized_token'
+    with TableReader(results_file) as reader:
+        fieldnames = reader.fieldnames
+    if 'pronoun' not in fieldnames or answer_column not in fieldnames:
+        # other tables, and results of data files without declared pronouns, which have no accuracy
+        return pd.DataFrame(columns=summary_columns)
+    columns = ['pronoun_type', 'pronoun', answer_column] + (['prompt'] if kind == 'prompt' else [])
+    df = read_table(results_file, columns=columns)
+    pronoun_types = df.pronoun_type.to_numpy(dtype=object)
+    pronouns = df.pronoun.to_numpy(dtype=object)
+    if kind == 'prompt':
+        answers, ambiguous, _ = extract_answers(df.generation, pronoun_types, language)
+        prompts = df.prompt.astype(str).to_numpy(dtype=object)
+    else:
+        answers = df.verbalized_token.to_numpy(dtype=object)
+        ambiguous = np.zeros(len(df), dtype=bool)
+        prompts = np.full(len(df), '', dtype=object)
+    correct = answers == pronouns
+    (prompt, pronoun_type, pronoun), n, n_correct, n_ambiguous = count_groups([prompts, pronoun_types, pronouns],
+                                                                             correct, ambiguous)
+    nominatives = get_nominatives(language)
+    summary = pd.DataFrame({
+        'model': model,
+        'kind': kind,
+        'setting': setting,
+        'seed': seed,
+        'distractors': distractors,
+        'prompt': prompt,
+        'pronoun_type': pronoun_type,
+        'pronoun': [nominatives.get(key, p) for key, p in zip(zip(pronoun_type, pronoun), pronoun)],
+        'n': n,
+        'correct': n_correct,
+        'ambiguous': n_ambiguous,
+    })
+    # forms shared by two pronouns of a type would fall into one group after the nominative mapping
+    summary = summary.groupby(key_columns, sort=False, as_index=False)[['n', 'correct', 'ambiguous']].sum()
+    summary['results_file'] = str(results_file)
+    return summary
+
+def read_summary(summary_file):
+    # the summary and the size, modification time and language of the results files it was computed from
+    sources_path = get_sources_path(summary_file)
+    if not Path(summary_file).exists() or not sources_path.exists():
+        return pd.DataFrame(columns=summary_columns), {}
+    if get_format(summary_file) == 'parquet':
+        summary = read_table(summary_file)
+    else:
+        # seeds and prompt ids stay strings, and scoring rows keep their empty prompt
+        summary = pd.read_csv(summary_file, sep='\t', dtype={'seed': str, 'prompt': str}, keep_default_na=False)
+    if list(summary.columns) != summary_columns:
+        # written by an older version; computed again from scratch
+        return pd.DataFrame(columns=summary_columns), {}
+    with open(sources_path, encoding='utf-8') as f:
+        return summary, json.load(f)
+
+def update_summary(summary_file, results_files, workers=1, language='en'):
+    """Brings the summary up to date with the results files and returns it.
+
+    Only results files that are new or changed since the last update are read; the rows of files that have
+    changed or are no longer given are dropped. The sources file, written after the summary, records the size,
+    modification time and language of every file in it.
+    """
+    summary, sources = read_summary(summary_file)
+    stamps = {results_file: get_stamp(results_file) + [language] for results_file in results_files}
+    changed = [results_file for results_file, stamp in stamps.items() if sources.get(results_file) != stamp]
+    print(f'{len(changed)} new or changed results files, {len(stamps) - len(changed)} unchanged')
+    summary = summary[summary.results_file.isin(set(stamps) - set(changed))]
+    summarize = partial(summarize_file, language=language)
+    if workers <= 1 or len(changed) <= 1:
+        new_summaries = [summarize(results_file) for results_file in changed]
+    else:
+        with multiprocessing.Pool(min(workers, len(changed))) as pool:
+            new_summaries = pool.map(summarize, changed)
+    summary = pd.concat([summary] + new_summaries, ignore_index=True)
+    summary = summary.astype({'distractors': int, 'n': int, 'correct': int, 'ambiguous': int})
+    summary['accuracy'] = summary.correct / summary.n
+    summary = summary.sort_values(['setting', 'seed', 'model', 'kind', 'prompt', 'pronoun_type', 'pronoun'],
+                                  ignore_index=True)
+    write_table(summary, summary_file)
+    with open(get_sources_path(summary_file), 'w', encoding='utf-8') as f:
+        json.dump(stamps, f)
+    return summary
+
+def get_accuracy(summary, by):
+    # accuracy over all rows of each group, e.g. by model and number of distractors
+    totals = summary.groupby(by, as_index=False)[['n', 'correct', 'ambiguous']].sum()
+    totals['accuracy'] = totals.correct / totals.n
+    return totals
+
+def main():
+    # e.g. python3 aggregate.py --by model distractors, in the directory score_models.py was run in
+    parser = argparse.ArgumentParser()
+    parser.add_argument('results_dirs', nargs='*',
+                        help='directories of results files written by score_models.py (default: all directories here)')
+    parser.add_argument('--summary', default='summary.tsv', help='summary table (.tsv or .parquet), updated in place')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of processes reading results files')
+    parser.add_argument('--language', choices=sorted(language_mappings), default='en',
+                        help='pronouns that the generations of the prompted models are matched against')
+    parser.add_argument('--by', nargs='+', choices=key_columns, help='also print the accuracy per these columns')
+    args = parser.parse_args()
+    results_dirs = args.results_dirs or sorted(str(path) for path in Path('.').iterdir() if path.is_dir())
+    summary = update_summary(args.summary, find_result_files(results_dirs), args.workers, args.language)
+    if args.by:
+        print(get_accuracy(summary, args.by).to_string(index=False))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+import re
+import numpy as np
+import pandas as pd
+from pronouns import mapping
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+except ImportError:
+    pa = None
+
+# pronouns per language; the Dutch ones as in claude-scripts/dutch_templates.py
+language_mappings = {
+    'en': mapping,
+    'nl': {
+        '$NOM_PRONOUN': ['hij', 'zij', 'die'],
+        '$ACC_PRONOUN': ['hem', 'haar', 'die'],
+        '$POSS_PRONOUN': ['zijn', 'haar', 'diens'],
+    },
+}
+
+# other words that name a pronoun in generations, as in evaluate_dutch_pronoun_choice of claude-scripts/dutch_prompt.py;
+# they only count when a generation names none of the pronouns themselves
+language_variations = {
+    'en': {},
+    'nl': {'hij': ['he'], 'zij': ['ze', 'she'], 'die': ['they', 'hen', 'hun']},
+}
+
+def get_pattern(forms, unicode_classes):
+    # any of the forms as a whole word; RE2, which runs pyarrow's regex functions, only knows ASCII word boundaries,
+    # so there they are spelled out with unicode classes
+    alternatives = '|'.join(re.escape(form) for form in sorted(forms, key=len, reverse=True))
+    if unicode_classes:
+        return rf'(?:^|[^\pL\pN_])(?:{alternatives})(?:[^\pL\pN_]|$)'
+    return rf'\b(?:{alternatives})\b'
+
+class AnswerExtractor:
+    """Finds the pronouns of one pronoun set that a column of generations names.
+
+    Every pronoun gets one case-insensitive regex of its forms as whole words, compiled once and run over the whole
+    column at once: by RE2 in pyarrow if it is installed, else by pandas. A generation has an answer if it names
+    exactly one pronoun, and is ambiguous if it names several.
+    """
+
+    def __init__(self, pronouns, variations=None):
+        self.pronouns = list(pronouns)
+        variations = variations or {}
+        self.direct_patterns = [get_pattern([p], pa is not None) for p in self.pronouns]
+        self.variation_patterns = [get_pattern(variations[p], pa is not None) if variations.get(p) else None
+                                   for p in self.pronouns]
+        if pa is None:
+            self.direct_patterns = [re.compile(pattern, re.IGNORECASE) for pattern in self.direct_patterns]
+            self.variation_patterns = [pattern and re.compile(pattern, re.IGNORECASE)
+                                       for pattern in self.variation_patterns]
+
+    def match(self, generations, pattern):
+        # whether every generation matches
+        if pa is None:
+            return generations.str.contains(pattern).to_numpy(dtype=bool)
+        return pc.fill_null(pc.match_substring_regex(generations, pattern, ignore_case=True), False).to_numpy(
+            zero_copy_only=False)
+
+    def extract(self, generations):
+        """Answer of every generation ('' if it names no pronoun or several), whether it is ambiguous, and the
+        pronouns it names, joined by '|'."""
+        generations = to_column(generations)
+        named = np.stack([self.match(generations, pattern) for pattern in self.direct_patterns], axis=1)
+        if any(self.variation_patterns):
+            # variations only count in generations that name none of the pronouns themselves
+            unnamed = ~named.any(1)
+            for n, pattern in enumerate(self.variation_patterns):
+                if pattern is not None:
+                    named[:, n] |= unnamed & self.match(generations, pattern)
+        counts = named.sum(1)
+        answers = np.where(counts == 1, np.array(self.pronouns, dtype=object)[named.argmax(1)], '')
+        # the named pronouns as a bit mask per row, which indexes every possible joined string
+        masks = named @ (1 << np.arange(len(self.pronouns)))
+        joined = np.array(['|'.join(p for n, p in enumerate(self.pronouns) if mask >> n & 1)
+                           for mask in range(2 ** len(self.pronouns))], dtype=object)
+        return answers, counts > 1, joined[masks]
+
+def to_column(generations):
+    # a column the regex functions run on, with missing generations as empty strings
+    if pa is None:
+        return pd.Series(generations, dtype=object).fillna('').reset_index(drop=True)
+    if not isinstance(generations, pa.Array):
+        generations = pa.array(pd.Series(generations), type=pa.string(), from_pandas=True)
+    return pc.fill_null(generations, '')
+
+extractors = {}
+
+def get_extractor(language, pronoun_type):
+    # compiled once per language and pronoun set
+    if (language, pronoun_type) not in extractors:
+        extractors[language, pronoun_type] = AnswerExtractor(language_mappings[language][pronoun_type],
+                                                             language_variations[language])
+    return extractors[language, pronoun_type]
+
+def extract_answers(generations, pronoun_types, language='en'):
+    # answer, ambiguity and named pronouns of every generation, each with the pronoun set of its row's pronoun type
+    generations = to_column(generations)
+    pronoun_types = np.asarray(pronoun_types, dtype=object)
+    answers = np.full(len(generations), '', dtype=object)
+    ambiguous = np.zeros(len(generations), dtype=bool)
+    matches = np.full(len(generations), '', dtype=object)
+    for pronoun_type in language_mappings[language]:
+        rows = np.flatnonzero(pronoun_types == pronoun_type)
+        if len(rows):
+            answers[rows], ambiguous[rows], matches[rows] = get_extractor(language, pronoun_type).extract(
+                generations.take(rows))
+    return answers, ambiguous, matches
@@ -0,0 +1,165 @@
+import torch
+import torch.nn.functional as F
+from collections import deque
+
+def get_input_device(model):
+    # weights that accelerate offloaded to disk sit on the meta device; inputs of such models stay on the cpu and
+    # accelerate's hooks move them to wherever the layers run
+    return torch.device('cpu') if model.device.type == 'meta' else model.device
+
+def pad_batch(sequences, pad_token_id=0, padding_side='right'):
+    # pad token id lists into a single tensor along with the matching attention mask;
+    # generation needs left padding so that every prompt ends right before the first new token
+    max_len = max(len(seq) for seq in sequences)
+    input_ids = torch.full((len(sequences), max_len), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(sequences), max_len), dtype=torch.long)
+    for n, seq in enumerate(sequences):
+        start = max_len - len(seq) if padding_side == 'left' else 0
+        input_ids[n, start:start + len(seq)] = torch.tensor(seq, dtype=torch.long)
+        attention_mask[n, start:start + len(seq)] = 1
+    return input_ids, attention_mask
+
+def get_length_batches(lengths, batch_size, mixed_lengths=False, max_tokens=None):
+    # group indices into batches of similar length to keep padding low;
+    # unless mixed_lengths is set, a batch only ever holds sequences of one length, which needs no padding
+    # and therefore reproduces the per-sequence scores exactly; with max_tokens, a batch also stops growing once
+    # its padded size (number of sequences times the longest length) would exceed the budget
+    order = sorted(range(len(lengths)), key=lambda n: lengths[n])
+    batches = []
+    for n in order:
+        if (batches and len(batches[-1]) < batch_size
+                and (mixed_lengths or lengths[batches[-1][-1]] == lengths[n])
+                and (max_tokens is None or (len(batches[-1]) + 1) * lengths[n] <= max_tokens)):
+            batches[-1].append(n)
+        else:
+            batches.append([n])
+    return batches
+
+class Batcher:
+    """Length-sorted batches of at most batch_size sequences and, optionally, max_tokens padded tokens.
+
+    run scores the batches one by one. When a batch runs out of gpu memory, the batch size and token budget are
+    halved and the batch is split up again; the smaller limits stay in place for everything scored afterwards.
+    """
+
+    def __init__(self, batch_size=32, max_tokens=None, mixed_lengths=False):
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.mixed_lengths = mixed_lengths
+
+    def get_batches(self, lengths):
+        return get_length_batches(lengths, self.batch_size, self.mixed_lengths, self.max_tokens)
+
+    def back_off(self, batch, lengths):
+        self.batch_size = max(1, min(self.batch_size, len(batch)) // 2)
+        if self.max_tokens is not None:
+            self.max_tokens = max(1, min(self.max_tokens, len(batch) * max(lengths[n] for n in batch)) // 2)
+        print(f'out of memory, retrying with batches of up to {self.batch_size} sequences'
+              + (f' and {self.max_tokens} tokens' if self.max_tokens is not None else ''))
+
+    def run(self, lengths, score_batch):
+        # yields (batch, score_batch(batch)) for batches of indices into lengths that together cover every index;
+        # the lengths are what a batch costs per sequence, e.g. prompt plus generated tokens
+        pending = deque(self.get_batches(lengths))
+        while pending:
+            batch = pending.popleft()
+            try:
+                result = score_batch(batch)
+            except torch.cuda.OutOfMemoryError:
+                if len(batch) == 1:
+                    raise
+                torch.cuda.empty_cache()
+                self.back_off(batch, lengths)
+                # everything not scored yet is split again under the new limits
+                remaining = batch + [n for queued in pending for n in queued]
+                pending = deque([[remaining[n] for n in smaller]
+                                 for smaller in self.get_batches([lengths[n] for n in remaining])])
+                continue
+            yield batch, result
+
+# get_token_log_probs takes the log_softmax of all logits unless score_models.py turns the chunked kernel on with
+# any of these: the positions of one sequence and entries of the vocabulary it works on at a time (None for all of
+# them) and the dtype it accumulates in ('float32' or 'model', the dtype of the logits; float32 by default)
+log_prob_chunk_positions = None
+log_prob_chunk_vocab = None
+log_prob_dtype = None
+
+def uses_chunked_log_probs():
+    return log_prob_chunk_positions is not None or log_prob_chunk_vocab is not None or log_prob_dtype is not None
+
+def get_log_prob_method(method):
+    # cache method of scores that went through get_token_log_probs: the chunked kernel matches the log_softmax only
+    # up to float rounding, and so do its accumulation dtypes and vocabulary chunks among each other, so each of them
+    # gets keys of its own; position chunks give the same scores
+    if not uses_chunked_log_probs():
+        return method
+    return f"{method}-lse-{log_prob_dtype or 'float32'}" + (f'-vocab{log_prob_chunk_vocab}' if log_prob_chunk_vocab else '')
+
+def get_token_log_probs(logits, targets):
+    # log prob of every target token under the logits at its position; logits are (positions, vocab) or
+    # (sequences, positions, vocab) and targets match them without the vocab.
+    # the chunked kernel computes them as the logit of the target minus the logsumexp of the logits: unlike the
+    # log_softmax of all logits, which is as large as the logits themselves, only one chunk of positions and
+    # vocabulary is upcast and exponentiated at a time, so the memory it takes does not grow with batch size and
+    # length; the logsumexp of vocabulary chunks is combined with logaddexp
+    if not uses_chunked_log_probs():
+        return F.log_softmax(logits, dim=-1).gather(-1, targets.unsqueeze(-1)).squeeze(-1)
+    single = logits.dim() == 2
+    if single:
+        logits = logits.unsqueeze(0)
+        targets = targets.unsqueeze(0)
+    dtype = logits.dtype if log_prob_dtype == 'model' else torch.float32
+    vocab_size = logits.shape[-1]
+    position_chunk = log_prob_chunk_positions or logits.shape[1]
+    vocab_chunk = log_prob_chunk_vocab or vocab_size
+    target_logits = logits.gather(2, targets.unsqueeze(-1)).squeeze(-1).to(dtype)
+    log_normalizers = torch.empty(targets.shape, dtype=dtype, device=logits.device)
+    for n in range(logits.shape[0]):
+        for start in range(0, logits.shape[1], position_chunk):
+            chunk = logits[n, start:start + position_chunk]
+            normalizer = None
+            for vocab_start in range(0, vocab_size, vocab_chunk):
+                part = chunk[:, vocab_start:vocab_start + vocab_chunk].to(dtype).logsumexp(1)
+                normalizer = part if normalizer is None else torch.logaddexp(normalizer, part)
+            log_normalizers[n, start:start + position_chunk] = normalizer
+    token_log_probs = target_logits - log_normalizers
+    return token_log_probs[0] if single else token_log_probs
+
+def get_common_prefix_length(sequences):
+    prefix_len = 0
+    for tokens in zip(*sequences):
+        if any(t != tokens[0] for t in tokens):
+            break
+        prefix_len += 1
+    return prefix_len
+
+def expand_past_key_values(past_key_values, n):
+    # repeat a batch-size-1 cache n times so every suffix can attend to the shared prefix
+    if hasattr(past_key_values, 'batch_repeat_interleave'):
+        past_key_values.batch_repeat_interleave(n)
+        return past_key_values
+    return tuple(tuple(t.expand(n, *t.shape[1:]) for t in layer) for layer in past_key_values)
+
+def score_with_shared_prefix(sequences, prefix_len, model):
+    # token sequences that agree on their first prefix_len tokens: the prefix is encoded once, its past_key_values
+    # are reused for all suffixes in one padded batch; returns the log prob sum of the prefix (excluding its
+    # first token) and, per sequence, the log prob sum of its suffix
+    device = get_input_device(model)
+    prefix = torch.tensor([sequences[0][:prefix_len]], dtype=torch.long, device=device)
+    with torch.no_grad():
+        prefix_outputs = model(prefix, use_cache=True)
+    prefix_logits = prefix_outputs.logits[0]
+    prefix_score = get_token_log_probs(prefix_logits[:-1], prefix[0, 1:]).double().sum().item()
+
+    suffix_ids, suffix_mask = pad_batch([seq[prefix_len:] for seq in sequences])
+    suffix_ids = suffix_ids.to(device)
+    suffix_mask = suffix_mask.to(device)
+    attention_mask = torch.cat([torch.ones((len(sequences), prefix_len), dtype=torch.long, device=device), suffix_mask], dim=1)
+    past_key_values = expand_past_key_values(prefix_outputs.past_key_values, len(sequences))
+    with torch.no_grad():
+        suffix_logits = model(suffix_ids, attention_mask=attention_mask, past_key_values=past_key_values).logits
+    # the first suffix token is predicted by the last prefix position
+    first_log_probs = get_token_log_probs(prefix_logits[-1].expand(len(sequences), -1), suffix_ids[:, 0]).double()
+    token_log_probs = get_token_log_probs(suffix_logits[:, :-1], suffix_ids[:, 1:])
+    suffix_scores = first_log_probs + (token_log_probs.double() * suffix_mask[:, 1:]).sum(dim=1)
+    return prefix_score, suffix_scores.tolist()
@@ -0,0 +1,495 @@
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+# the stages run in fresh processes so that every one reports its own peak memory; torch and transformers are
+# imported inside the stages that need them, so the dataset stages are measured without them
+stage_names = ['add_context', 'dutch_builder', 'sample_templates', 'decoder', 'encoder', 'log_probs', 'prompt']
+contents = ['day', 'sleep', 'shoes', 'meal', 'coffee']
+occupations = [('technician', 'customer'), ('accountant', 'taxpayer'), ('baker', 'visitor'), ('nurse', 'patient'),
+               ('chef', 'guest'), ('pilot', 'passenger'), ('teacher', 'student'), ('lawyer', 'client')]
+# model names that pick the prompt template and generation settings of prompt.py; the models themselves are local
+prompt_models = {'gptneox': 'meta-llama/Llama-2-7b-chat-hf', 't5': 'google/flan-t5-small'}
+
+def read_status(field):
+    # a field of /proc/self/status in bytes, None where there is no such file
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(f'{field}:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def reset_peak_memory():
+    # linux starts the peak resident memory over when 5 is written to clear_refs; elsewhere the peak stays that of
+    # the whole process, and only its growth tells the paths of a stage apart
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def get_peak_memory():
+    # peak resident memory of this process in bytes since reset_peak_memory
+    peak = read_status('VmHWM')
+    if peak is not None:
+        return peak
+    # linux reports kilobytes, macos bytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+repeat = 1
+
+def time_call(fn, *args, **kwargs):
+    """Result, the fastest of repeat runs, which is the least disturbed by whatever else runs on the machine, and
+    the memory of the runs: the peak resident memory while they ran and how far it rose above the memory the process
+    held before them, which is what the path itself needs."""
+    reset_peak_memory()
+    start_memory = read_status('VmRSS') or get_peak_memory()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+    peak = get_peak_memory()
+    return result, min(times), {'peak_memory_bytes': peak, 'memory_growth_bytes': max(peak - start_memory, 0)}
+
+def get_entry(name, items, unit, seconds, **extra):
+    return {'name': name, 'items': items, 'unit': unit, 'seconds': seconds,
+            'throughput': items / max(seconds, 1e-9), **extra}
+
+def write_templates(work_dir, task_rows):
+    """Task and context templates in the format of data/task.tsv and data/context.tsv.
+
+    Every pronoun type gets five contents, each with a negative and a positive template, in the order
+    add_context.py expects (the content of template i is i % 5), and task rows cycle through the occupations.
+    """
+    contexts = {
+        '$NOM_PRONOUN': ('The $OCCUPATION/PARTICIPANT said that $NOM_PRONOUN had a {} {}.', '$NOM_PRONOUN had a {} {}.'),
+        '$ACC_PRONOUN': ('The $OCCUPATION/PARTICIPANT felt that the {1} was {0} for $ACC_PRONOUN.',
+                         'The {1} was {0} for $ACC_PRONOUN.'),
+        '$POSS_PRONOUN': ('The $OCCUPATION/PARTICIPANT said that $POSS_PRONOUN {1} was {0}.', '$POSS_PRONOUN {1} was {0}.'),
+    }
+    with open(work_dir / 'context.tsv', 'w', encoding='utf-8') as f:
+        f.write('pronoun_type\tpolarity\texplicit_template\timplicit_template\n')
+        for pronoun_type, (explicit, implicit) in contexts.items():
+            for polarity, adjective in [('negative', 'bad'), ('positive', 'good')]:
+                for content in contents:
+                    f.write(f'{pronoun_type}\t{polarity}\t{explicit.format(adjective, content)}\t'
+                            f'{implicit.format(adjective, content)}\n')
+    tasks = [
+        ('$NOM_PRONOUN', 'The {0} told the {1} that $NOM_PRONOUN would be back soon.'),
+        ('$ACC_PRONOUN', 'The {1} thanked the {0} and waved at $ACC_PRONOUN.'),
+        ('$POSS_PRONOUN', 'The {0} showed the {1} $POSS_PRONOUN notes.'),
+    ]
+    with open(work_dir / 'task.tsv', 'w', encoding='utf-8') as f:
+        f.write('occupation\tparticipant\tsentence\tpronoun_type\tword\n')
+        for n in range(task_rows):
+            occupation, participant = occupations[n // len(tasks) % len(occupations)]
+            pronoun_type, sentence = tasks[n % len(tasks)]
+            f.write(f'{occupation}\t{participant}\t{sentence.format(occupation, participant)}\t{pronoun_type}\t{occupation}\n')
+
+def get_texts(work_dir):
+    # everything the tokenizers are trained on: templates, pronouns and prompt templates
+    from pronouns import mapping
+    from prompt import get_pronoun_templates
+    texts = []
+    for name in ['task.tsv', 'context.tsv']:
+        with open(work_dir / name, encoding='utf-8') as f:
+            texts.extend(field for line in f for field in line.rstrip('\n').split('\t'))
+    texts += [' '.join(pronouns) for pronouns in mapping.values()]
+    texts += get_pronoun_templates() + ['OPTIONS: ___ [INST] [/INST]']
+    return texts
+
+def build_models(work_dir):
+    """Randomly initialised small GPT-NeoX, BERT and T5 models with tokenizers trained on the benchmark templates,
+    saved in work_dir/models; nothing is downloaded."""
+    import torch
+    from tokenizers import Tokenizer, models, trainers, pre_tokenizers, decoders, processors, normalizers
+    from transformers import (PreTrainedTokenizerFast, GPTNeoXConfig, GPTNeoXForCausalLM, BertConfig, BertForMaskedLM,
+                              T5Config, T5ForConditionalGeneration)
+    torch.manual_seed(0)
+    texts = get_texts(work_dir)
+    model_dir = work_dir / 'models'
+
+    # byte-level bpe, as for pythia
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=600, special_tokens=['<|endoftext|>'], show_progress=False,
+                                  initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+    tokenizer.train_from_iterator(texts, trainer)
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, bos_token='<|endoftext|>', eos_token='<|endoftext|>',
+                                        unk_token='<|endoftext|>')
+    tokenizer.save_pretrained(model_dir / 'gptneox')
+    GPTNeoXForCausalLM(GPTNeoXConfig(vocab_size=len(tokenizer), hidden_size=64, num_hidden_layers=2, num_attention_heads=4,
+                                     intermediate_size=256, max_position_embeddings=512)).save_pretrained(model_dir / 'gptneox')
+
+    # lowercased wordpiece, as for bert-base-uncased
+    tokenizer = Tokenizer(models.WordPiece(unk_token='[UNK]'))
+    tokenizer.normalizer = normalizers.BertNormalizer(lowercase=True)
+    tokenizer.pre_tokenizer = pre_tokenizers.BertPreTokenizer()
+    tokenizer.decoder = decoders.WordPiece()
+    trainer = trainers.WordPieceTrainer(vocab_size=300, special_tokens=['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'],
+                                        show_progress=False)
+    tokenizer.train_from_iterator(texts, trainer)
+    tokenizer.post_processor = processors.TemplateProcessing(
+        single='[CLS] $A [SEP]', pair='[CLS] $A [SEP] $B [SEP]',
+        special_tokens=[('[CLS]', tokenizer.token_to_id('[CLS]')), ('[SEP]', tokenizer.token_to_id('[SEP]'))])
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, pad_token='[PAD]', unk_token='[UNK]',
+                                        cls_token='[CLS]', sep_token='[SEP]', mask_token='[MASK]')
+    tokenizer.save_pretrained(model_dir / 'bert')
+    BertForMaskedLM(BertConfig(vocab_size=len(tokenizer), hidden_size=64, num_hidden_layers=2, num_attention_heads=4,
+                               intermediate_size=256)).save_pretrained(model_dir / 'bert')
+
+    # metaspace bpe with </s> appended, as for t5
+    tokenizer = Tokenizer(models.BPE(unk_token='<unk>'))
+    tokenizer.pre_tokenizer = pre_tokenizers.Metaspace()
+    tokenizer.decoder = decoders.Metaspace()
+    trainer = trainers.BpeTrainer(vocab_size=500, special_tokens=['<pad>', '</s>', '<unk>'], show_progress=False)
+    tokenizer.train_from_iterator(texts, trainer)
+    tokenizer.post_processor = processors.TemplateProcessing(single='$A </s>', special_tokens=[('</s>', 1)])
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, pad_token='<pad>', eos_token='</s>', unk_token='<unk>')
+    tokenizer.save_pretrained(model_dir / 't5')
+    T5ForConditionalGeneration(T5Config(vocab_size=len(tokenizer), d_model=64, d_ff=256, num_layers=2, num_heads=4,
+                                        d_kv=16, decoder_start_token_id=0, pad_token_id=0,
+                                        eos_token_id=1)).save_pretrained(model_dir / 't5')
+
+def setup(work_dir, args):
+    # templates, the full dataset the sampling and scoring stages read, and the models
+    from add_context import add_context, build_pronoun_type_template_mapping
+    write_templates(work_dir, args.task_rows)
+    data_dir = work_dir / 'data'
+    data_dir.mkdir(exist_ok=True)
+    os.chdir(data_dir)
+    add_context(str(work_dir / 'task.tsv'), build_pronoun_type_template_mapping(work_dir / 'context.tsv'), occupation=True)
+    build_models(work_dir)
+
+def count_lines(paths):
+    n = 0
+    for path in paths:
+        with open(path, 'rb') as f:
+            n += sum(chunk.count(b'\n') for chunk in iter(lambda: f.read(1 << 20), b''))
+    return n
+
+def bench_add_context(work_dir, args):
+    from add_context import add_context, build_pronoun_type_template_mapping, get_output_names
+    out_dir = work_dir / 'add_context'
+    out_dir.mkdir(exist_ok=True)
+    os.chdir(out_dir)
+    mapping = build_pronoun_type_template_mapping(work_dir / 'context.tsv')
+    _, seconds, memory = time_call(add_context, str(work_dir / 'task.tsv'), mapping, True)
+    names = get_output_names('task', True)
+    lines = count_lines(names) - len(names)
+    return [get_entry('add_context', lines, 'rows', seconds, **memory,
+                      bytes_per_second=sum(os.path.getsize(name) for name in names) / max(seconds, 1e-9))]
+
+def bench_dutch_builder(work_dir, args):
+    from itertools import islice
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'claude-scripts'))
+    from dutch_dataset_builder import iter_base_rows, build_pronoun_type_template_mapping, add_dutch_context
+    out_dir = work_dir / 'dutch'
+    out_dir.mkdir(exist_ok=True)
+    os.chdir(out_dir)
+    mapping = build_pronoun_type_template_mapping()
+    files, seconds, memory = time_call(lambda: add_dutch_context(islice(iter_base_rows(), args.dutch_rows), mapping))
+    return [get_entry('dutch_builder', sum(entry['rows'] for entry in files), 'rows', seconds, **memory,
+                      bytes_per_second=sum(entry['bytes'] for entry in files) / max(seconds, 1e-9))]
+
+def bench_sample_templates(work_dir, args):
+    from add_context import get_output_names
+    from sample_templates import sample_file
+    os.chdir(work_dir / 'data')
+    # sample_templates.py recognises the file without distractors by its full size only, which the benchmark
+    # templates do not reach
+    names = get_output_names('task', True)[1:]
+    _, seconds, memory = time_call(lambda: [sample_file(name) for name in names])
+    return [get_entry('sample_templates', count_lines(names) - len(names), 'rows', seconds, **memory)]
+
+def read_benchmark_rows(work_dir, n):
+    # n rows spread over the deepest setting, so they cover every task row and several lengths
+    from itertools import islice
+    from pronouns import mapping
+    from storage import TableReader
+    path = work_dir / 'data' / 'eo_ep_ip_ip_ip_ip_task.tsv'
+    total = count_lines([path]) - 1
+    with TableReader(path) as reader:
+        rows = islice(reader, 0, None, max(1, total // n))
+        return [(row['sentence'], row['pronoun_type'], mapping[row['pronoun_type']], row['word']) for row in islice(rows, n)]
+
+def load_local_model(work_dir, name, model_class):
+    from transformers import AutoTokenizer
+    model = model_class.from_pretrained(work_dir / 'models' / name)
+    model.eval()
+    return model, AutoTokenizer.from_pretrained(work_dir / 'models' / name)
+
+def compare_scores(reference, scores, tolerance):
+    # largest difference from the per-row scores of any pronoun, and whether every row keeps its best pronoun
+    max_abs_diff = max(abs(ref[p] - row_scores[p]) for ref, row_scores in zip(reference, scores) for p in ref)
+    same_best = all(max(ref, key=ref.get) == max(row_scores, key=row_scores.get)
+                    for ref, row_scores in zip(reference, scores))
+    return {'max_abs_diff': max_abs_diff, 'same_best': same_best, 'equivalent': max_abs_diff <= tolerance}
+
+def score_decoder_row(sentence, pronoun_type, pronouns, tokenizer, model):
+    # the per-row decoder scoring score_models.py started from, the reference of the decoder paths: a forward pass
+    # per pronoun, a log_softmax of all its logits and a python sum of the log prob of every token after the first
+    import torch
+    import torch.nn.functional as F
+    log_prob_dict = {}
+    for p in pronouns:
+        input_ids = tokenizer(sentence.replace(pronoun_type, p), return_tensors='pt').input_ids
+        with torch.no_grad():
+            log_probs = F.log_softmax(model(input_ids).logits[0], dim=1)
+        log_prob_sum = 0.0
+        for i in range(1, input_ids.shape[1]):
+            log_prob_sum += log_probs[i - 1, input_ids[0, i]].item()
+        log_prob_dict[p] = log_prob_sum
+    return log_prob_dict
+
+def prompt_row(sentence, pronoun_type, pronouns, word, tokenizer, model, model_name):
+    # the per-row prompting prompt.py started from, the reference of batched prompting: one generate call per
+    # template, on the unpadded prompt
+    import torch
+    from prompt import get_prompts, get_gen_config
+    gen_config = get_gen_config(tokenizer, model_name)
+    generations = []
+    for i, prompt in enumerate(get_prompts(sentence, pronoun_type, pronouns, model_name)):
+        input_ids = tokenizer(prompt, return_tensors='pt').input_ids
+        with torch.no_grad():
+            output = model.generate(inputs=input_ids, attention_mask=torch.ones_like(input_ids),
+                                    generation_config=gen_config)[0]
+        if 'flan' not in model_name:
+            output = output[input_ids.shape[1]:]
+        generations.append((i, tokenizer.decode(output, skip_special_tokens=True).strip().replace('\n', ' ')))
+    return generations
+
+def bench_decoder(work_dir, args):
+    from transformers import AutoModelForCausalLM
+    import score_models
+    from batching import Batcher
+    model, tokenizer = load_local_model(work_dir, 'gptneox', AutoModelForCausalLM)
+    rows = [row[:3] for row in read_benchmark_rows(work_dir, args.rows)]
+    reference, seconds, memory = time_call(lambda: [score_decoder_row(*row, tokenizer, model) for row in rows])
+    entries = [get_entry('decoder/per-row', len(rows), 'rows', seconds, **memory)]
+    paths = {
+        'batched': lambda: score_models.get_decoder_log_probs_batch(rows, tokenizer, model, Batcher(args.batch_size)),
+        'mixed-length': lambda: score_models.get_decoder_log_probs_batch(rows, tokenizer, model,
+                                                                         Batcher(args.batch_size, mixed_lengths=True)),
+        'shared-prefix': lambda: [score_models.get_decoder_log_probs_shared_prefix(*row, tokenizer, model) for row in rows],
+    }
+    for name, score in paths.items():
+        scores, seconds, memory = time_call(score)
+        entries.append(get_entry(f'decoder/{name}', len(rows), 'rows', seconds, **memory,
+                                 **compare_scores(reference, scores, args.tolerance)))
+    return entries
+
+def bench_encoder(work_dir, args):
+    from transformers import AutoModelForMaskedLM
+    from minicons import scorer
+    import score_models
+    from batching import Batcher
+    model, tokenizer = load_local_model(work_dir, 'bert', AutoModelForMaskedLM)
+    rows = [row[:3] for row in read_benchmark_rows(work_dir, args.rows)]
+    mlm_scorer = scorer.MaskedLMScorer(model, tokenizer=tokenizer, device='cpu')
+    reference, seconds, memory = time_call(lambda: [score_models.get_encoder_log_probs(*row, mlm_scorer) for row in rows])
+    entries = [get_entry('encoder/per-row', len(rows), 'rows', seconds, **memory)]
+    paths = {
+        'batched': lambda: score_models.get_encoder_log_probs_batch(rows, tokenizer, model, Batcher(args.batch_size)),
+        'mixed-length': lambda: score_models.get_encoder_log_probs_batch(rows, tokenizer, model,
+                                                                         Batcher(args.batch_size, mixed_lengths=True)),
+    }
+    for name, score in paths.items():
+        scores, seconds, memory = time_call(score)
+        entries.append(get_entry(f'encoder/{name}', len(rows), 'rows', seconds, **memory,
+                                 **compare_scores(reference, scores, args.tolerance)))
+    # an approximation of PLL by design (see pll.py), so it is timed but not held to the tolerance
+    scores, seconds, memory = time_call(score_models.get_encoder_log_probs_diff_aware, rows, tokenizer, model, Batcher(args.batch_size))
+    entries.append(get_entry('encoder/diff-aware', len(rows), 'rows', seconds, **memory,
+                             **{**compare_scores(reference, scores, args.tolerance), 'equivalent': None}))
+    return entries
+
+def bench_log_probs(work_dir, args):
+    """Peak memory of turning decoder logits into token log probs, on the rows of the deepest setting (six
+    sentences) and a model with a vocabulary of --vocab-size entries: get_token_log_probs, and the log_softmax of
+    all logits it replaced. Both run in this process, each after a reset of the peak memory, and what they save is
+    the difference of the memory growth of the two."""
+    import torch
+    import torch.nn.functional as F
+    from transformers import AutoConfig, AutoTokenizer, GPTNeoXForCausalLM
+    import batching
+    from batching import pad_batch, get_length_batches, get_token_log_probs
+    config = AutoConfig.from_pretrained(work_dir / 'models' / 'gptneox')
+    config.vocab_size = args.vocab_size
+    torch.manual_seed(0)
+    model = GPTNeoXForCausalLM(config).eval()
+    tokenizer = AutoTokenizer.from_pretrained(work_dir / 'models' / 'gptneox')
+    rows = [row[:3] for row in read_benchmark_rows(work_dir, args.rows)]
+    verbalized = [{p: sentence.replace(pronoun_type, p) for p in pronouns} for sentence, pronoun_type, pronouns in rows]
+    texts = sorted({text for texts in verbalized for text in texts.values()})
+    sequences = tokenizer(texts).input_ids
+
+    def full_log_probs(logits, targets):
+        return F.log_softmax(logits, dim=-1).gather(2, targets.unsqueeze(-1)).squeeze(-1)
+
+    def score(token_log_probs):
+        # padded batches as large as --batch-size, so the logits of a forward pass are as large as they get
+        scores = {}
+        for batch in get_length_batches([len(seq) for seq in sequences], args.batch_size, mixed_lengths=True):
+            input_ids, attention_mask = pad_batch([sequences[n] for n in batch])
+            with torch.no_grad():
+                logits = model(input_ids, attention_mask=attention_mask).logits
+            batch_scores = (token_log_probs(logits[:, :-1], input_ids[:, 1:]).double() * attention_mask[:, 1:]).sum(1)
+            scores.update((texts[n], score) for n, score in zip(batch, batch_scores.tolist()))
+        return [{p: scores[text] for p, text in row_texts.items()} for row_texts in verbalized]
+
+    batching.log_prob_chunk_positions = args.log_prob_chunk_positions
+    scores, seconds, memory = time_call(score, get_token_log_probs)
+    reference, full_seconds, full_memory = time_call(score, full_log_probs)
+    return [get_entry('log_probs/full', len(rows), 'rows', full_seconds, **full_memory),
+            get_entry('log_probs/chunked', len(rows), 'rows', seconds, **memory,
+                      memory_saved_bytes=full_memory['memory_growth_bytes'] - memory['memory_growth_bytes'],
+                      **compare_scores(reference, scores, args.tolerance))]
+
+def bench_prompt(work_dir, args):
+    from transformers import AutoModelForCausalLM, T5ForConditionalGeneration
+    from prompt import prompt_model_batch
+    from batching import Batcher
+    rows = read_benchmark_rows(work_dir, args.prompt_rows)
+    entries = []
+    for name, model_class in [('gptneox', AutoModelForCausalLM), ('t5', T5ForConditionalGeneration)]:
+        model, tokenizer = load_local_model(work_dir, name, model_class)
+        model_type = 'enc-dec' if model.config.is_encoder_decoder else 'decoder'
+        model_name = prompt_models[name]
+        reference, seconds, memory = time_call(lambda: [prompt_row(*row, tokenizer, model, model_name) for row in rows])
+        entries.append(get_entry(f'prompt/{model_type}/per-row', len(rows), 'rows', seconds, **memory))
+        generations, seconds, memory = time_call(prompt_model_batch, rows, tokenizer, model, model_type, model_name,
+                                         Batcher(args.batch_size))
+        # greedy generations of equal-length batches are exactly those of the per-row code
+        same = sum(a == b for ref, row_generations in zip(reference, generations) for a, b in zip(ref, row_generations))
+        total = sum(len(ref) for ref in reference)
+        entries.append(get_entry(f'prompt/{model_type}/batched', len(rows), 'rows', seconds, **memory,
+                                 same_generations=same / total, equivalent=same == total))
+    return entries
+
+def run_stage(name, work_dir, args):
+    # runs in its own process; nothing may go to the network
+    global repeat
+    repeat = args.repeat
+    os.environ['HF_HUB_OFFLINE'] = '1'
+    os.environ['TRANSFORMERS_OFFLINE'] = '1'
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+    if name == 'setup':
+        setup(work_dir, args)
+        return []
+    return [{**entry, 'stage': name} for entry in globals()[f'bench_{name}'](work_dir, args)]
+
+def run_in_process(name, work_dir, args):
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(run_stage, name, work_dir, args).result()
+
+# memory growth a path may gain over its baseline whatever its share, so that paths that need next to no memory
+# of their own do not fail on the noise of the allocator
+memory_slack_bytes = 16 * 2**20
+
+def check_regressions(results, baseline, max_slowdown, max_memory_growth):
+    # messages for every entry that is slower or needs more memory of its own than the baseline allows
+    baseline = {entry['name']: entry for entry in baseline['results']}
+    messages = []
+    for entry in results:
+        base = baseline.get(entry['name'])
+        if base is None:
+            continue
+        if entry['throughput'] < base['throughput'] * (1 - max_slowdown):
+            messages.append(f"{entry['name']}: {entry['throughput']:.1f} {entry['unit']}/s, baseline "
+                            f"{base['throughput']:.1f} {entry['unit']}/s")
+        # baselines from before the memory growth was measured have none to compare with
+        if 'memory_growth_bytes' not in base:
+            continue
+        if entry['memory_growth_bytes'] > base['memory_growth_bytes'] * (1 + max_memory_growth) + memory_slack_bytes:
+            messages.append(f"{entry['name']}: memory growth {entry['memory_growth_bytes'] / 2**20:.0f} MiB, baseline "
+                            f"{base['memory_growth_bytes'] / 2**20:.0f} MiB")
+    return messages
+
+def format_entry(entry):
+    text = (f"{entry['name']:<28} {entry['throughput']:>12.1f} {entry['unit']}/s {entry['seconds']:>8.2f}s "
+            f"{entry['peak_memory_bytes'] / 2**20:>8.0f} MiB peak {entry['memory_growth_bytes'] / 2**20:>6.0f} MiB growth")
+    if 'max_abs_diff' in entry:
+        text += f"  max abs diff {entry['max_abs_diff']:.2e}, same best pronoun: {entry['same_best']}"
+    if 'memory_saved_bytes' in entry:
+        text += f"  {entry['memory_saved_bytes'] / 2**20:.0f} MiB less than log_softmax"
+    if 'same_generations' in entry:
+        text += f"  same generations: {entry['same_generations']:.1%}"
+    return text
+
+def main():
+    # e.g. python3 benchmark.py --save-baseline, then python3 benchmark.py to compare against it
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stages', nargs='+', choices=stage_names, default=stage_names)
+    parser.add_argument('--work-dir', help='directory for the generated data and models (default: a temporary one)')
+    parser.add_argument('--task-rows', type=int, default=6, help='task templates the datasets are generated from')
+    parser.add_argument('--dutch-rows', type=int, default=4, help='base rows of the Dutch builder')
+    parser.add_argument('--rows', type=int, default=48, help='rows scored by the decoder and encoder paths')
+    parser.add_argument('--prompt-rows', type=int, default=8, help='rows prompted with every template')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--vocab-size', type=int, default=32000,
+                        help='vocabulary of the decoder the log_probs stage measures (32000 is that of Llama 2)')
+    parser.add_argument('--log-prob-chunk-positions', type=int, default=256,
+                        help='positions per chunk of the chunked log prob kernel in the log_probs stage')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of every path, of which the fastest counts')
+    parser.add_argument('--tolerance', type=float, default=1e-4,
+                        help='largest difference from the per-row scores that still counts as equivalent')
+    parser.add_argument('--output', default='benchmark.json', help='results of this run')
+    parser.add_argument('--baseline', default='benchmark_baseline.json', help='results to compare against')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results of this run as the baseline')
+    parser.add_argument('--max-slowdown', type=float, default=0.25,
+                        help='fail if the throughput of a path drops by more than this share of the baseline')
+    parser.add_argument('--max-memory-growth', type=float, default=0.25,
+                        help='fail if the memory a path needs above what its process held before grows by more '
+                             'than this share of the baseline')
+    args = parser.parse_args()
+
+    work_dir = Path(args.work_dir or tempfile.mkdtemp(prefix='benchmark_')).resolve()
+    work_dir.mkdir(parents=True, exist_ok=True)
+    try:
+        run_in_process('setup', work_dir, args)
+        results = []
+        for name in args.stages:
+            entries = run_in_process(name, work_dir, args)
+            for entry in entries:
+                print(format_entry(entry))
+            results += entries
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir)
+
+    settings = {name: getattr(args, name) for name in ['task_rows', 'dutch_rows', 'rows', 'prompt_rows', 'batch_size', 'vocab_size', 'log_prob_chunk_positions', 'repeat']}
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump({'settings': settings, 'results': results}, f, indent=1)
+    failures = [f"{entry['name']}: not equivalent to the per-row code" for entry in results if entry.get('equivalent') is False]
+    if args.save_baseline:
+        shutil.copyfile(args.output, args.baseline)
+        print(f'saved baseline {args.baseline}')
+    elif Path(args.baseline).exists():
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline['settings'] != settings:
+            print(f'{args.baseline} was run with other settings, not comparing')
+        else:
+            failures += check_regressions(results, baseline, args.max_slowdown, args.max_memory_growth)
+    for message in failures:
+        print(f'FAILED {message}')
+    if failures:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
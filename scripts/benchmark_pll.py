@@ -0,0 +1,60 @@
+import argparse
+import time
+from itertools import islice
+from pronouns import mapping
+from storage import TableReader
+from pll import score_pll, score_pll_diff_aware
+from batching import Batcher
+from score_models import get_model, get_tokenizer
+
+def time_call(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def compare(rows, full, diff_aware):
+    # how far the diff-aware scores are from full PLL, and how often they pick the same pronoun
+    diffs = [abs(full_scores[p] - diff_scores[p])
+             for full_scores, diff_scores in zip(full, diff_aware) for p in full_scores]
+    same_best = sum(max(full_scores, key=full_scores.get) == max(diff_scores, key=diff_scores.get)
+                    for full_scores, diff_scores in zip(full, diff_aware))
+    pairs = agreeing_pairs = 0
+    for (sentence, pronoun_type, pronouns), full_scores, diff_scores in zip(rows, full, diff_aware):
+        for i, p in enumerate(pronouns):
+            for q in pronouns[i + 1:]:
+                pairs += 1
+                agreeing_pairs += (full_scores[p] > full_scores[q]) == (diff_scores[p] > diff_scores[q])
+    return {
+        'mean abs diff': sum(diffs) / len(diffs),
+        'max abs diff': max(diffs),
+        'same best pronoun': same_best / len(rows),
+        'same pairwise order': agreeing_pairs / pairs,
+    }
+
+def main():
+    # e.g. python3 benchmark_pll.py bert-base-uncased eo_ep_ip_ip_ip_ip_task.tsv --rows 200
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model')
+    parser.add_argument('data_files', nargs='+')
+    parser.add_argument('--rows', type=int, default=200, help='rows scored from the start of each file')
+    parser.add_argument('--batch-size', type=int, default=32)
+    args = parser.parse_args()
+
+    model = get_model(args.model, 'encoder')
+    tokenizer = get_tokenizer(args.model)
+    model.eval()
+    for data_file in args.data_files:
+        with TableReader(data_file) as reader:
+            rows = [(row['sentence'], row['pronoun_type'], mapping[row['pronoun_type']]) for row in islice(reader, args.rows)]
+        texts = [sentence.replace(pronoun_type, p) for sentence, pronoun_type, pronouns in rows for p in pronouns]
+        scores, full_time = time_call(score_pll, texts, tokenizer, model, Batcher(args.batch_size))
+        scores = iter(scores)
+        full = [{p: next(scores) for p in pronouns} for sentence, pronoun_type, pronouns in rows]
+        diff_aware, diff_aware_time = time_call(score_pll_diff_aware, rows, tokenizer, model, Batcher(args.batch_size))
+        print(f'{data_file}: {len(rows)} rows, full PLL {full_time:.1f}s, diff-aware {diff_aware_time:.1f}s '
+              f'({full_time / diff_aware_time:.1f}x)')
+        for name, value in compare(rows, full, diff_aware).items():
+            print(f'  {name}: {value:.4f}')
+
+if __name__ == '__main__':
+    main()
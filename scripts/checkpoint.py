@@ -0,0 +1,77 @@
+import json
+import os
+from pathlib import Path
+from storage import TableWriter
+
+def get_journal_path(out_file):
+    return out_file.with_name(out_file.name + '.journal')
+
+def get_partial_path(out_file):
+    # hidden and with the same suffix, so it is written in the right format but never mistaken for a result
+    return out_file.with_name(f'.{out_file.stem}.partial{out_file.suffix}')
+
+def get_shard_path(out_file, start, stop):
+    # result file of the rows in [start, stop) only, merged into out_file once all shards are done
+    return out_file.with_name(f'.{out_file.stem}.rows{start}-{stop}{out_file.suffix}')
+
+def truncate_incomplete_line(path):
+    # a crash can leave half a line at the end of the journal; drop it so new entries start on a fresh line
+    with open(path, 'rb+') as f:
+        data = f.read()
+        if data and not data.endswith(b'\n'):
+            f.truncate(data.rfind(b'\n') + 1)
+
+class Journal:
+    """Append-only record of the finished rows of one result file.
+
+    Every entry is keyed by (model, data file, row index and uid, prompt id) and holds the output fields of that
+    row, so an interrupted run only needs to score the rows that are missing. A journal also belongs to the load
+    mode of the model (see offload.get_load_mode); a run in another dtype or quantization cannot continue it. The result file itself is only
+    written by finalize, atomically, once all rows are done.
+    """
+
+    def __init__(self, out_file, model, data_file, load_mode=None):
+        self.out_file = Path(out_file)
+        self.path = get_journal_path(self.out_file)
+        self.model = model
+        self.load_mode = load_mode
+        self.data_file = Path(data_file).name
+        self.entries = {}
+        if self.path.exists():
+            truncate_incomplete_line(self.path)
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    entry = json.loads(line)
+                    if entry['model'] != self.model or entry['data_file'] != self.data_file:
+                        raise ValueError(f'{self.path} belongs to {entry["model"]} on {entry["data_file"]}')
+                    if entry.get('load_mode') != self.load_mode:
+                        raise ValueError(f'{self.path} was written with {entry["model"]} loaded as '
+                                         f'{entry.get("load_mode")}, not {self.load_mode}')
+                    self.entries[entry['row'], entry['uid'], entry['prompt']] = entry['data']
+        self.f = open(self.path, 'a', encoding='utf-8')
+
+    def done(self, row, uid, prompt=None):
+        return (row, uid, prompt) in self.entries
+
+    def get(self, row, uid, prompt=None):
+        # output fields of a finished row, or None
+        return self.entries.get((row, uid, prompt))
+
+    def add(self, row, uid, prompt, data):
+        self.entries[row, uid, prompt] = data
+        self.f.write(json.dumps({'model': self.model, 'load_mode': self.load_mode, 'data_file': self.data_file,
+                                 'row': row, 'uid': uid, 'prompt': prompt, 'data': data}) + '\n')
+
+    def sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def finalize(self, header, float_columns=()):
+        # write all rows in input order to a temporary file and move it into place
+        self.f.close()
+        partial_file = get_partial_path(self.out_file)
+        with TableWriter(partial_file, header, float_columns=float_columns) as writer:
+            for key in sorted(self.entries, key=lambda key: (key[0], -1 if key[2] is None else key[2])):
+                writer.write_row(self.entries[key])
+        os.replace(partial_file, self.out_file)
+        self.path.unlink()
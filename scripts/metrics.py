@@ -0,0 +1,215 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+import torch
+from offload import get_peak_memory, reset_peak_memory
+from pretokenize import TokenizerProxy
+
+stages = ['load', 'tokenize', 'forward', 'decode', 'write']
+
+class Metrics:
+    """Time per stage and tokens through the model while one process scores its results files.
+
+    Forward time and tokens come from hooks on the model (and on the encoder of encoder-decoder models, which the
+    option scoring and generate call on their own); calls nested in an outer forward pass are not counted again.
+    Tokenize and decode time come from a TimedTokenizer, load and write time from the stage timer. reset starts
+    the counts and the peak memory of the next results file; the load time of the model stays.
+    """
+
+    def __init__(self):
+        self.load_seconds = 0.0
+        self.depth = 0
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.seconds = defaultdict(float)
+        self.tokens = 0
+        self.padded_tokens = 0
+        self.forward_passes = 0
+        # the peak of this file alone, not one that an earlier file or the model load left behind
+        reset_peak_memory()
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        # stages also run in the reader and writer threads of pipeline.py, where they overlap with the model
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.seconds[name] += time.perf_counter() - start
+
+    def count_tokens(self, args, kwargs):
+        # tokens fed to a forward pass, and how many of them are not padding; with a key/value cache the attention
+        # mask also covers the earlier positions, so only its last columns belong to the new tokens
+        input_ids = kwargs.get('input_ids', args[0] if args else None)
+        attention_mask = kwargs.get('attention_mask')
+        if input_ids is None:
+            input_ids = kwargs.get('decoder_input_ids')
+            attention_mask = kwargs.get('decoder_attention_mask')
+        if not isinstance(input_ids, torch.Tensor):
+            return
+        self.padded_tokens += input_ids.numel()
+        if isinstance(attention_mask, torch.Tensor) and attention_mask.dim() == 2:
+            self.tokens += int(attention_mask[:, -input_ids.shape[-1]:].sum())
+        else:
+            self.tokens += input_ids.numel()
+
+    def before_forward(self, module, args, kwargs):
+        self.depth += 1
+        if self.depth == 1:
+            self.count_tokens(args, kwargs)
+            self.forward_start = time.perf_counter()
+
+    def after_forward(self, module, args, kwargs, output):
+        self.depth -= 1
+        if self.depth == 0:
+            if torch.cuda.is_available():
+                # kernels run asynchronously; wait for them so the time belongs to this pass
+                torch.cuda.synchronize()
+            self.seconds['forward'] += time.perf_counter() - self.forward_start
+            self.forward_passes += 1
+
+    def instrument(self, model):
+        modules = [model]
+        if model.config.is_encoder_decoder:
+            modules.append(model.get_encoder())
+        for module in modules:
+            module.register_forward_pre_hook(self.before_forward, with_kwargs=True)
+            module.register_forward_hook(self.after_forward, with_kwargs=True, always_call=True)
+
+    def get_record(self, model_name, data_file, out_file, rows, row_range=None):
+        elapsed = time.perf_counter() - self.start
+        return {
+            'time': time.time(),
+            'model': model_name,
+            'data_file': str(data_file),
+            'results_file': Path(out_file).name,
+            'rows': rows,
+            'row_range': list(row_range) if row_range is not None else None,
+            'seconds': elapsed,
+            'stage_seconds': {'load': self.load_seconds, **{name: self.seconds[name] for name in stages[1:]}},
+            'rows_per_second': rows / max(elapsed, 1e-9),
+            'tokens': self.tokens,
+            'padded_tokens': self.padded_tokens,
+            'tokens_per_second': self.tokens / max(elapsed, 1e-9),
+            # share of the tokens in forward passes that were padding
+            'padding_waste': 1 - self.tokens / self.padded_tokens if self.padded_tokens else 0.0,
+            'forward_passes': self.forward_passes,
+            'peak_memory_bytes': get_peak_memory(),
+        }
+
+class TimedTokenizer(TokenizerProxy):
+    """Adds the time of the calls of a tokenizer to the tokenize stage and of decode and batch_decode to the decode
+    stage."""
+
+    def __init__(self, tokenizer, metrics):
+        super().__init__(tokenizer)
+        self.metrics = metrics
+
+    def __call__(self, *args, **kwargs):
+        with self.metrics.stage('tokenize'):
+            return self.tokenizer(*args, **kwargs)
+
+    def decode(self, *args, **kwargs):
+        with self.metrics.stage('decode'):
+            return self.tokenizer.decode(*args, **kwargs)
+
+    def batch_decode(self, *args, **kwargs):
+        with self.metrics.stage('decode'):
+            return self.tokenizer.batch_decode(*args, **kwargs)
+
+# one per process; score_models.py instruments every model it loads with it
+metrics = Metrics()
+
+def get_metrics_paths(results_dir):
+    return Path(results_dir) / 'metrics.jsonl', Path(results_dir) / 'metrics.prom'
+
+def read_records(path):
+    if not path.exists():
+        return []
+    with open(path, encoding='utf-8') as f:
+        # a line cut short by a crash is skipped
+        return [json.loads(line) for line in f if line.endswith('\n')]
+
+def get_label_text(labels):
+    escaped = {name: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for name, value in labels.items()}
+    return ','.join(f'{name}="{value}"' for name, value in escaped.items())
+
+def format_prometheus(records):
+    """Prometheus text exposition of the latest record of every results file (and row range) in records."""
+    latest = {}
+    for record in records:
+        latest[record['model'], record['results_file'], str(record['row_range'])] = record
+    lines = []
+
+    def add(name, kind, help_text, samples):
+        lines.append(f'# HELP pronoun_fidelity_{name} {help_text}')
+        lines.append(f'# TYPE pronoun_fidelity_{name} {kind}')
+        lines.extend(f'pronoun_fidelity_{name}{{{get_label_text(labels)}}} {value!r}' for labels, value in samples)
+
+    def get_labels(record, **extra):
+        row_range = record['row_range']
+        rows = f'{row_range[0]}-{row_range[1]}' if row_range else 'all'
+        return {'model': record['model'], 'results_file': record['results_file'], 'rows': rows, **extra}
+
+    records = list(latest.values())
+    add('stage_seconds', 'gauge', 'Seconds spent per stage while scoring a results file.',
+        [(get_labels(r, stage=stage), float(r['stage_seconds'][stage])) for r in records for stage in stages])
+    add('seconds', 'gauge', 'Seconds from the start to the end of scoring a results file.',
+        [(get_labels(r), float(r['seconds'])) for r in records])
+    add('rows', 'gauge', 'Rows scored in the run.', [(get_labels(r), r['rows']) for r in records])
+    add('rows_per_second', 'gauge', 'Rows scored per second.', [(get_labels(r), float(r['rows_per_second'])) for r in records])
+    add('tokens', 'gauge', 'Tokens in forward passes, without padding.', [(get_labels(r), r['tokens']) for r in records])
+    add('tokens_per_second', 'gauge', 'Tokens in forward passes per second, without padding.',
+        [(get_labels(r), float(r['tokens_per_second'])) for r in records])
+    add('padding_waste_ratio', 'gauge', 'Share of the tokens in forward passes that were padding.',
+        [(get_labels(r), float(r['padding_waste'])) for r in records])
+    add('peak_memory_bytes', 'gauge', 'Peak host and gpu memory while scoring the results file.',
+        [(get_labels(r, device=device), n) for r in records for device, n in r['peak_memory_bytes'].items()])
+    return '\n'.join(lines) + '\n'
+
+def export_record(record, results_dir):
+    """Appends the record to metrics.jsonl in the results directory and rewrites metrics.prom from it."""
+    jsonl_path, prom_path = get_metrics_paths(results_dir)
+    with open(jsonl_path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record) + '\n')
+    # written next to it and moved into place, so a textfile collector never reads half a file
+    temp_path = prom_path.with_name(f'.{prom_path.name}.{os.getpid()}')
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(format_prometheus(read_records(jsonl_path)))
+    os.replace(temp_path, prom_path)
+
+def format_record(record):
+    stage_text = ', '.join(f'{name} {seconds:.1f}s' for name, seconds in record['stage_seconds'].items())
+    return (f"{record['rows_per_second']:.2f} rows/s, {record['tokens_per_second']:.0f} tokens/s, "
+            f"{record['padding_waste']:.1%} padding; {stage_text}")
+
+def parse_profile_window(text):
+    # e.g. '2,3': skip two chunks, then trace three
+    skip, active = (int(n) for n in text.split(','))
+    return skip, active
+
+def get_profiler(profile_window, trace_path):
+    """Started torch profiler that traces the chunks of the window into a chrome trace at trace_path; step it after
+    every chunk and stop it at the end. Without a window there is no profiler."""
+    if profile_window is None:
+        return None
+    skip, active = profile_window
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    profiler = torch.profiler.profile(
+        activities=activities,
+        schedule=torch.profiler.schedule(wait=skip, warmup=0, active=active, repeat=1),
+        on_trace_ready=lambda profiler: profiler.export_chrome_trace(str(trace_path)),
+        record_shapes=True)
+    profiler.start()
+    return profiler
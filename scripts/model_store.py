@@ -0,0 +1,119 @@
+import argparse
+import json
+from pathlib import Path
+import torch
+from transformers import AutoTokenizer, AutoModelForMaskedLM, AutoModelForCausalLM, T5ForConditionalGeneration, BertConfig
+from constants import HF_ACCESS_TOKEN
+
+model_classes = {
+    'encoder': AutoModelForMaskedLM,
+    'decoder': AutoModelForCausalLM,
+    'enc-dec': T5ForConditionalGeneration,
+}
+
+def get_store_path(store, model_name):
+    return Path(store) / model_name.replace('/', '_')
+
+def read_metadata(path):
+    metadata_file = path / 'store.json'
+    if not metadata_file.exists():
+        return None
+    with open(metadata_file, encoding='utf-8') as f:
+        return json.load(f)
+
+def uses_device_map(model_name, model_type):
+    # the models that score_models.get_model loads in float16 and spreads over all gpus with device_map='auto'
+    return model_type == 'enc-dec' or (model_type == 'decoder' and any(s in model_name for s in ['12b', '13b', '30b', '66b', '70b']))
+
+def get_torch_dtype(model_name, model_type):
+    # the dtype score_models.get_model loads a model in: float16 for the models spread over the gpus, else that of
+    # the checkpoint
+    return torch.float16 if uses_device_map(model_name, model_type) else 'auto'
+
+def get_device_map(model):
+    # device map for the gpus of this machine, so loading from the store can skip working it out again
+    if not torch.cuda.is_available():
+        return None
+    from accelerate import infer_auto_device_map
+    return infer_auto_device_map(model, no_split_module_classes=model._no_split_modules, dtype=model.dtype)
+
+def convert_model(store, model_name, model_type, max_shard_size='2GB'):
+    # loads a model from the hub in the dtype score_models.get_model uses and saves it as safetensors shards,
+    # along with its tokenizer and the revision it was loaded from
+    path = get_store_path(store, model_name)
+    mosaic = 'mosaic-bert' in model_name
+    kwargs = {'low_cpu_mem_usage': True,
+              'torch_dtype': get_torch_dtype(model_name, model_type)}
+    if mosaic:
+        kwargs.update(config=BertConfig.from_pretrained(model_name), trust_remote_code=True)
+    else:
+        kwargs['token'] = HF_ACCESS_TOKEN
+    model = model_classes[model_type].from_pretrained(model_name, **kwargs)
+    tokenizer = AutoTokenizer.from_pretrained('bert-base-uncased' if mosaic else model_name, token=HF_ACCESS_TOKEN)
+
+    # shards are written in parameter order, i.e. layer by layer, so a shard mostly belongs to a single device
+    model.save_pretrained(path, safe_serialization=True, max_shard_size=max_shard_size)
+    tokenizer.save_pretrained(path)
+    device_map = get_device_map(model) if uses_device_map(model_name, model_type) else None
+    metadata = {
+        'model': model_name,
+        'model_type': model_type,
+        'dtype': str(model.dtype).replace('torch.', ''),
+        'revision': getattr(model.config, '_commit_hash', None),
+        'trust_remote_code': mosaic,
+        'device_map': device_map,
+        'device_count': torch.cuda.device_count() if device_map else 0,
+    }
+    # written last, so an interrupted conversion is not mistaken for a complete one
+    with open(path / 'store.json', 'w', encoding='utf-8') as f:
+        json.dump(metadata, f, indent=1)
+    return path
+
+def load_model(store, model_name, model_type, device, load_kwargs=None):
+    # the model from the store, or None if it has not been converted; load_kwargs (see offload.py) replace the
+    # stored dtype and device map
+    path = get_store_path(store, model_name)
+    metadata = read_metadata(path)
+    if metadata is None:
+        return None
+    kwargs = {'low_cpu_mem_usage': True, 'torch_dtype': getattr(torch, metadata['dtype'])}
+    if metadata['trust_remote_code']:
+        kwargs.update(config=BertConfig.from_pretrained(path), trust_remote_code=True)
+    if load_kwargs is not None:
+        model = model_classes[model_type].from_pretrained(path, **{**kwargs, **load_kwargs})
+    elif uses_device_map(model_name, model_type):
+        # the stored map only applies to a machine with the same number of gpus
+        same_gpus = metadata['device_map'] and metadata['device_count'] == torch.cuda.device_count()
+        kwargs['device_map'] = metadata['device_map'] if same_gpus else 'auto'
+        model = model_classes[model_type].from_pretrained(path, **kwargs)
+    else:
+        model = model_classes[model_type].from_pretrained(path, **kwargs).to(device)
+    # keep the revision of the original checkpoint, which the score cache is keyed by
+    model.config._commit_hash = metadata['revision']
+    return model
+
+def load_tokenizer(store, model_name):
+    path = get_store_path(store, model_name)
+    if read_metadata(path) is None:
+        return None
+    return AutoTokenizer.from_pretrained(path)
+
+def main():
+    # e.g. python3 model_store.py models/ meta-llama/Llama-2-70b-hf; converts every model of score_models.py by default
+    from score_models import models
+    parser = argparse.ArgumentParser()
+    parser.add_argument('store')
+    parser.add_argument('models', nargs='*')
+    parser.add_argument('--max-shard-size', default='2GB')
+    args = parser.parse_args()
+    for model_name, model_type in models:
+        if args.models and model_name not in args.models:
+            continue
+        if read_metadata(get_store_path(args.store, model_name)) is not None:
+            print(f'{model_name} is already converted')
+            continue
+        print(f'converting {model_name}')
+        convert_model(args.store, model_name, model_type, args.max_shard_size)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+import resource
+import sys
+from collections import Counter
+import torch
+from model_store import get_torch_dtype
+
+def parse_max_memory(text):
+    # e.g. '0=20GiB,1=20GiB,cpu=64GiB' -> {0: '20GiB', 1: '20GiB', 'cpu': '64GiB'}, the form accelerate expects
+    max_memory = {}
+    for part in text.split(','):
+        device, limit = part.split('=')
+        max_memory[int(device) if device.isdigit() else device] = limit
+    return max_memory
+
+def get_quantization_config(quantize):
+    # 8-bit or 4-bit weights through bitsandbytes, which only runs on gpus
+    try:
+        import bitsandbytes  # noqa: F401
+    except ImportError:
+        raise ImportError(f'{quantize} weights require the bitsandbytes package')
+    if not torch.cuda.is_available():
+        raise ValueError(f'{quantize} weights require a gpu')
+    from transformers import BitsAndBytesConfig
+    if quantize == '8bit':
+        return BitsAndBytesConfig(load_in_8bit=True)
+    return BitsAndBytesConfig(load_in_4bit=True, bnb_4bit_quant_type='nf4', bnb_4bit_compute_dtype=torch.float16)
+
+def get_load_kwargs(model_name, model_type, quantize=None, max_memory=None, offload_dir=None):
+    """from_pretrained arguments that let accelerate place a model within memory limits.
+
+    With device_map='auto' the layers fill the gpus up to their share of max_memory, then the cpu, and the rest is
+    offloaded to offload_dir. Offloaded layers stay in host memory or on disk and are moved to the gpu (or run on
+    the cpu on machines without one) one layer at a time during every forward pass, so models larger than the
+    available memory can still be scored, at the cost of moving their weights for every batch.
+    """
+    kwargs = {
+        'device_map': 'auto',
+        'low_cpu_mem_usage': True,
+        # the dtype the model is loaded in without these options, so it scores the same with or without them
+        'torch_dtype': get_torch_dtype(model_name, model_type),
+    }
+    if max_memory:
+        kwargs['max_memory'] = parse_max_memory(max_memory)
+    if offload_dir:
+        kwargs['offload_folder'] = offload_dir
+        # the checkpoint is also loaded through disk, so host memory never holds the whole model
+        kwargs['offload_state_dict'] = True
+    if quantize:
+        kwargs['quantization_config'] = get_quantization_config(quantize)
+        # quantized weights keep their own dtype; float16 is what their layers compute in
+        kwargs['torch_dtype'] = torch.float16
+    return kwargs
+
+def get_load_mode(model, quantize=None):
+    # what the scores of a model depend on besides its name and revision: the dtype it computes in and its
+    # quantization; score caches and journals keep the scores of different load modes apart
+    dtype = str(model.dtype).replace('torch.', '')
+    return f'{dtype}-{quantize}' if quantize else dtype
+
+def get_placement(model):
+    # number of modules per device of a model loaded with a device map, e.g. {'0': 40, 'cpu': 20, 'disk': 21}
+    device_map = getattr(model, 'hf_device_map', None)
+    if not device_map:
+        return {str(model.device): 1}
+    return dict(Counter(str(device) for device in device_map.values()))
+
+def read_status(field):
+    # a field of /proc/self/status in bytes, None where there is no such file
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(f'{field}:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def reset_peak_memory():
+    # starts the peaks of get_peak_memory over; linux does so for the resident memory when 5 is written to
+    # clear_refs, elsewhere the host peak stays that of the whole process
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+    for index in range(torch.cuda.device_count()):
+        torch.cuda.reset_peak_memory_stats(index)
+
+def get_peak_memory():
+    # peak resident host memory of this process and peak allocated memory of every gpu since reset_peak_memory,
+    # in bytes
+    peak = read_status('VmHWM')
+    if peak is None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # linux reports kilobytes, macos bytes
+        peak = peak if sys.platform == 'darwin' else peak * 1024
+    peak_memory = {'host': peak}
+    for index in range(torch.cuda.device_count()):
+        peak_memory[f'cuda:{index}'] = torch.cuda.max_memory_allocated(index)
+    return peak_memory
+
+def format_bytes(n):
+    return f'{n / 2**30:.2f} GiB'
+
+def format_memory(peak_memory):
+    return ', '.join(f'{device} {format_bytes(n)}' for device, n in peak_memory.items())
+
+def format_load_report(model, load_seconds):
+    placement = ', '.join(f'{device}: {n}' for device, n in get_placement(model).items())
+    return (f'loaded in {load_seconds:.1f}s, weights {format_bytes(model.get_memory_footprint())}, '
+            f'modules per device: {placement}; peak memory: {format_memory(get_peak_memory())}')
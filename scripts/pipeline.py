@@ -0,0 +1,166 @@
+import queue
+import threading
+from collections import Counter
+from pretokenize import TokenizerProxy
+
+# how long a blocked stage waits before it checks whether the pipeline was stopped
+poll_seconds = 0.1
+done = object()
+
+class AheadTokenizer(TokenizerProxy):
+    """Texts tokenized ahead by prefetch are looked up instead of tokenized again when the scorers call it on plain
+    texts; calls with options and texts that were not prefetched go to the tokenizer itself.
+
+    prefetch runs in the reader thread of a Pipeline while the model runs on the previous chunk, and release drops the
+    texts of a chunk once it is scored; a text prefetched by several chunks stays until all of them are released.
+    """
+
+    def __init__(self, tokenizer):
+        super().__init__(tokenizer)
+        self.encodings = {}
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    def prefetch(self, texts):
+        with self.lock:
+            missing = list(dict.fromkeys(text for text in texts if text not in self.encodings))
+        # tokenizing outside the lock lets the model stage look up texts meanwhile; fast tokenizers also release the
+        # GIL while they encode a batch
+        encoded = self.tokenizer(missing) if missing else None
+        with self.lock:
+            for n, text in enumerate(missing):
+                self.encodings.setdefault(text, (encoded, n))
+            self.counts.update(texts)
+
+    def release(self, texts):
+        with self.lock:
+            self.counts.subtract(texts)
+            for text in set(texts):
+                if self.counts[text] <= 0:
+                    del self.counts[text]
+                    self.encodings.pop(text, None)
+
+    def __call__(self, texts, **kwargs):
+        if kwargs:
+            return self.tokenizer(texts, **kwargs)
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+        with self.lock:
+            sources = [self.encodings.get(text) for text in texts]
+        return self.encode_rest(texts, sources, single)
+
+class Pipeline:
+    """Overlaps reading and tokenizing, scoring and writing of the chunks of one results file.
+
+    A reader thread takes chunks from the chunks iterable, runs prepare on each (e.g. tokenizing its texts ahead)
+    and keeps up to prefetch of the results ready; iterating over the pipeline yields them in order to the model stage,
+    which hands its results to write. A writer thread calls write_fn on them in the order they were handed over.
+    Both queues are bounded, so a stage that falls behind holds the others back instead of piling up chunks.
+
+    An error in any stage stops the pipeline: the reader stops reading, the results that were handed over before
+    are still written (unless writing failed), and the error is raised in the model stage. With prefetch 0
+    everything runs in sequence in the calling thread.
+    """
+
+    def __init__(self, chunks, prepare=None, write_fn=None, prefetch=2):
+        self.chunks = chunks
+        self.prepare = prepare
+        self.write_fn = write_fn
+        self.prefetch = prefetch
+        self.stopped = threading.Event()
+        self.errors = []
+        if prefetch > 0:
+            self.ready = queue.Queue(prefetch)
+            self.results = queue.Queue(prefetch)
+            self.reader = threading.Thread(target=self.read, daemon=True)
+            self.writer = threading.Thread(target=self.write_results, daemon=True)
+            self.reader.start()
+            self.writer.start()
+
+    def put(self, target, item, consumer=None):
+        # blocks while the queue is full; gives up once the pipeline stops or, for a queue with a consumer thread,
+        # once that thread has died
+        while consumer.is_alive() if consumer is not None else not self.stopped.is_set():
+            try:
+                target.put(item, timeout=poll_seconds)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read(self):
+        try:
+            for chunk in self.chunks:
+                if self.stopped.is_set():
+                    return
+                if self.prepare is not None:
+                    chunk = self.prepare(chunk)
+                if not self.put(self.ready, chunk):
+                    return
+            self.put(self.ready, done)
+        except BaseException as e:
+            self.errors.append(e)
+            self.stopped.set()
+
+    def write_results(self):
+        # results that were handed over are written even after another stage failed
+        while True:
+            item = self.results.get()
+            if item is done:
+                return
+            try:
+                self.write_fn(*item)
+            except BaseException as e:
+                self.errors.append(e)
+                self.stopped.set()
+                return
+
+    def raise_errors(self):
+        if self.errors:
+            raise self.errors[0]
+
+    def __iter__(self):
+        if self.prefetch <= 0:
+            for chunk in self.chunks:
+                yield self.prepare(chunk) if self.prepare is not None else chunk
+            return
+        while True:
+            try:
+                chunk = self.ready.get(timeout=poll_seconds)
+            except queue.Empty:
+                # nothing is added once the reader is gone, so an empty queue stays empty
+                if self.reader.is_alive() or not self.ready.empty():
+                    continue
+                # the reader stopped without finishing
+                self.raise_errors()
+                return
+            if chunk is done:
+                return
+            self.raise_errors()
+            yield chunk
+
+    def write(self, *item):
+        if self.prefetch <= 0:
+            self.write_fn(*item)
+            return
+        if not self.put(self.results, item, self.writer):
+            # the writer failed
+            self.raise_errors()
+
+    def close(self):
+        # waits until everything handed over is written
+        if self.prefetch <= 0:
+            return
+        self.stopped.set()
+        self.reader.join()
+        # the writer finishes the queue first
+        self.put(self.results, done, self.writer)
+        self.writer.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+        if exc_type is None:
+            self.raise_errors()
@@ -0,0 +1,118 @@
+import torch
+from batching import pad_batch, Batcher, get_input_device
+
+def get_masked_copies(input_ids, word_ids, tokenizer, positions=None):
+    # one copy of the sentence per predicted token, as in minicons' within_word_l2r PLL: the target token is masked
+    # together with the tokens of the same word that follow it; special tokens are not predicted, and with
+    # positions given only the targets among them are
+    special_ids = {tokenizer.pad_token_id, tokenizer.cls_token_id, tokenizer.sep_token_id}
+    targets = [i for i, token in enumerate(input_ids) if token not in special_ids]
+    selected = [t for t in targets if positions is None or t in positions]
+    copies = []
+    for target in selected:
+        masked = list(input_ids)
+        masked[target] = tokenizer.mask_token_id
+        if word_ids[target] is not None:
+            for j in range(target + 1, targets[-1] + 1):
+                if word_ids[j] == word_ids[target]:
+                    masked[j] = tokenizer.mask_token_id
+        copies.append(masked)
+    return copies, selected
+
+def score_masked_copies(copies, targets, target_ids, model, pad_token_id):
+    # log prob of the original token at the target position of every masked copy
+    input_ids, attention_mask = pad_batch(copies, pad_token_id)
+    device = get_input_device(model)
+    input_ids = input_ids.to(device)
+    attention_mask = attention_mask.to(device)
+    rows = torch.arange(len(copies))
+    with torch.no_grad():
+        logits = model(input_ids, attention_mask=attention_mask).logits
+    logits = logits[rows, torch.tensor(targets)]
+    log_probs = logits - logits.logsumexp(1).unsqueeze(1)
+    return log_probs[rows, torch.tensor(target_ids)].float().cpu()
+
+class MaskedCopies:
+    """Masked copies of many sentences, scored together and summed per owner (a text, or part of one)."""
+
+    def __init__(self):
+        self.copies = []
+        self.targets = []
+        self.target_ids = []
+        self.counts = []
+
+    def add(self, input_ids, word_ids, tokenizer, positions=None):
+        # adds the copies of one owner and returns its index
+        copies, targets = get_masked_copies(input_ids, word_ids, tokenizer, positions)
+        self.copies += copies
+        self.targets += targets
+        self.target_ids += [input_ids[t] for t in targets]
+        self.counts.append(len(copies))
+        return len(self.counts) - 1
+
+    def score(self, tokenizer, model, batcher=None):
+        # the copies are scored in batches of equal length (or of similar length if the batcher mixes lengths),
+        # and the token scores of each owner are summed in float32 like minicons does
+        batcher = batcher or Batcher()
+        token_scores = torch.zeros(len(self.copies))
+
+        def score_batch(batch):
+            return score_masked_copies([self.copies[n] for n in batch], [self.targets[n] for n in batch],
+                                       [self.target_ids[n] for n in batch], model, tokenizer.pad_token_id)
+
+        for batch, scores in batcher.run([len(copy) for copy in self.copies], score_batch):
+            token_scores[batch] = scores
+        return [scores.sum(0).item() for scores in token_scores.split(self.counts)]
+
+def score_pll(texts, tokenizer, model, batcher=None):
+    # within_word_l2r pseudo log likelihood of every text
+    encoded = tokenizer(texts)
+    copies = MaskedCopies()
+    for n in range(len(texts)):
+        copies.add(encoded.input_ids[n], encoded.word_ids(n), tokenizer)
+    return copies.score(tokenizer, model, batcher)
+
+def get_slot_spans(sentence, slot, filler):
+    # character spans of the filler wherever it replaces the slot in sentence.replace(slot, filler)
+    spans = []
+    parts = sentence.split(slot)
+    start = 0
+    for part in parts[:-1]:
+        start += len(part)
+        spans.append((start, start + len(filler)))
+        start += len(filler)
+    return spans
+
+def get_slot_positions(offsets, spans):
+    # tokens whose characters overlap one of the spans
+    return {i for i, (start, end) in enumerate(offsets)
+            if end > start and any(start < span_end and end > span_start for span_start, span_end in spans)}
+
+def score_pll_diff_aware(rows, tokenizer, model, batcher=None):
+    """Approximate within_word_l2r PLL for rows of (sentence, pronoun_type, pronouns).
+
+    The verbalizations of a row only differ in the pronoun slot. The context tokens (everything outside the slot)
+    are scored once per row, in a copy of the sentence with the slot filled by the mask token; only the slot tokens
+    are scored per pronoun, exactly as in score_pll. The score of a pronoun is the context score plus its slot score.
+
+    This differs from full PLL in one way: when a context token is predicted, the slot holds a mask token instead of
+    the pronoun. The context score is therefore the same for all pronouns of a row, so differences between the
+    pronouns only come from the slot tokens, and the absolute scores differ from full PLL by how much the pronoun
+    itself helps to predict the context.
+    """
+    copies = MaskedCopies()
+    owners = []
+    for sentence, pronoun_type, pronouns in rows:
+        masked_sentence = sentence.replace(pronoun_type, tokenizer.mask_token)
+        encoded = tokenizer(masked_sentence, return_offsets_mapping=True)
+        slot = get_slot_positions(encoded.offset_mapping, get_slot_spans(sentence, pronoun_type, tokenizer.mask_token))
+        context = copies.add(encoded.input_ids, encoded.word_ids(), tokenizer,
+                             set(range(len(encoded.input_ids))) - slot)
+        slots = {}
+        for p in pronouns:
+            encoded = tokenizer(sentence.replace(pronoun_type, p), return_offsets_mapping=True)
+            slots[p] = copies.add(encoded.input_ids, encoded.word_ids(), tokenizer,
+                                  get_slot_positions(encoded.offset_mapping, get_slot_spans(sentence, pronoun_type, p)))
+        owners.append((context, slots))
+    scores = copies.score(tokenizer, model, batcher)
+    return [{p: scores[context] + scores[slot] for p, slot in slots.items()} for context, slots in owners]
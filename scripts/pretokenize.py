@@ -0,0 +1,202 @@
+import argparse
+import hashlib
+import json
+from array import array
+from itertools import islice
+from pathlib import Path
+import numpy as np
+from pronouns import mapping
+from prompt import get_prompts
+from storage import TableReader
+
+def get_text_hash(text):
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+
+def get_tokenizer_fingerprint(tokenizer):
+    # tokenizers with the same vocabulary and rules share their artifacts, e.g. all pythia models
+    description = tokenizer.backend_tokenizer.to_str() if tokenizer.is_fast else tokenizer.name_or_path
+    return hashlib.sha256(description.encode('utf-8')).hexdigest()[:16]
+
+def get_artifact_path(tokens_dir, data_file, kind, fingerprint):
+    return Path(tokens_dir) / Path(data_file).stem / f'{kind}_{fingerprint}'
+
+def get_row_texts(row, kind, model_name=None, model_type=None, options=True):
+    # every string the scorers of one kind of model tokenize for a row; options leaves out the sequences that only
+    # --prompt-mode options scores
+    pronouns = mapping[row['pronoun_type']]
+    if kind == 'sentences':
+        return [row['sentence'].replace(row['pronoun_type'], p) for p in pronouns]
+    prompts = get_prompts(row['sentence'], row['pronoun_type'], pronouns, model_name)
+    if model_type == 'decoder' and options:
+        # the sequences scored by --prompt-mode options
+        return prompts + [f'{prompt} {p}' for prompt in prompts for p in pronouns]
+    return prompts
+
+def get_texts(data_file, kind, model_name=None, model_type=None):
+    # every string the scorers of one kind of model tokenize for a data file
+    with TableReader(data_file) as reader:
+        for row in reader:
+            yield from get_row_texts(row, kind, model_name, model_type)
+
+def write_artifact(path, texts, tokenizer, with_word_ids=False, chunk_size=10000):
+    """Tokenizes texts into memory-mappable arrays in path.
+
+    ids.bin holds the token ids of all sequences back to back (uint16 where the vocabulary allows it), word_ids.bin
+    the matching word ids (-1 for special tokens) if they are asked for, and offsets.npy where every
+    sequence starts. hashes.npy holds the sorted 64-bit hashes of the texts and positions.npy the sequence of each;
+    texts are only looked up by hash, which at 64 bits is not expected to collide within a data file.
+    """
+    path.mkdir(parents=True, exist_ok=True)
+    dtype = np.uint16 if len(tokenizer) <= 2**16 else np.int32
+    hashes = array('Q')
+    offsets = array('q', [0])
+    texts = iter(texts)
+    with open(path / 'ids.bin', 'wb') as ids_file, open(path / 'word_ids.bin', 'wb') as word_ids_file:
+        while True:
+            chunk = list(islice(texts, chunk_size))
+            if not chunk:
+                break
+            encoded = tokenizer(chunk)
+            for n, text in enumerate(chunk):
+                input_ids = encoded.input_ids[n]
+                hashes.append(get_text_hash(text))
+                offsets.append(offsets[-1] + len(input_ids))
+                np.asarray(input_ids, dtype=dtype).tofile(ids_file)
+                if with_word_ids:
+                    word_ids = [-1 if w is None else w for w in encoded.word_ids(n)]
+                    np.asarray(word_ids, dtype=np.int32).tofile(word_ids_file)
+    # duplicate texts keep their first sequence
+    hashes, positions = np.unique(np.frombuffer(hashes, dtype=np.uint64), return_index=True)
+    np.save(path / 'hashes.npy', hashes)
+    np.save(path / 'positions.npy', positions)
+    np.save(path / 'offsets.npy', np.frombuffer(offsets, dtype=np.int64))
+    # written last, so an interrupted run is not mistaken for a complete artifact
+    with open(path / 'meta.json', 'w', encoding='utf-8') as f:
+        json.dump({'dtype': np.dtype(dtype).name, 'tokens': offsets[-1], 'word_ids': with_word_ids}, f)
+
+class TokenArtifact:
+    """Memory-mapped token ids of the texts of one data file, as written by write_artifact."""
+
+    def __init__(self, path):
+        with open(path / 'meta.json', encoding='utf-8') as f:
+            meta = json.load(f)
+        self.hashes = np.load(path / 'hashes.npy', mmap_mode='r')
+        self.positions = np.load(path / 'positions.npy', mmap_mode='r')
+        self.offsets = np.load(path / 'offsets.npy', mmap_mode='r')
+        # numpy cannot map empty files
+        self.ids = np.zeros(0, dtype=meta['dtype'])
+        self.word_ids = np.zeros(0, dtype=np.int32) if meta['word_ids'] else None
+        if meta['tokens']:
+            self.ids = np.memmap(path / 'ids.bin', dtype=meta['dtype'], mode='r', shape=(meta['tokens'],))
+            if meta['word_ids']:
+                self.word_ids = np.memmap(path / 'word_ids.bin', dtype=np.int32, mode='r', shape=(meta['tokens'],))
+
+    def find(self, texts):
+        # sequence of every text, or -1 for texts that are not in the artifact
+        if len(self.hashes) == 0:
+            return np.full(len(texts), -1)
+        hashes = np.array([get_text_hash(text) for text in texts], dtype=np.uint64)
+        indices = np.minimum(np.searchsorted(self.hashes, hashes), len(self.hashes) - 1)
+        return np.where(self.hashes[indices] == hashes, self.positions[indices], -1)
+
+    def get_ids(self, sequence):
+        return self.ids[self.offsets[sequence]:self.offsets[sequence + 1]].tolist()
+
+    def get_word_ids(self, sequence):
+        if self.word_ids is None:
+            raise ValueError('this artifact was written without word ids')
+        return [None if w < 0 else w for w in self.word_ids[self.offsets[sequence]:self.offsets[sequence + 1]].tolist()]
+
+class Encoding:
+    """The parts of a BatchEncoding that the scorers use, for sequences read from artifacts or tokenized on the spot."""
+
+    def __init__(self, sources, single):
+        # sources hold (artifact, sequence) or (BatchEncoding, index) per text
+        self.sources = sources
+        self.single = single
+        input_ids = [source.get_ids(n) if isinstance(source, TokenArtifact) else source.input_ids[n] for source, n in sources]
+        self.input_ids = input_ids[0] if single else input_ids
+
+    def word_ids(self, batch_index=0):
+        source, n = self.sources[batch_index]
+        return source.get_word_ids(n) if isinstance(source, TokenArtifact) else source.word_ids(n)
+
+class TokenizerProxy:
+    """Stands in for a tokenizer and hands everything it does not override to the tokenizer itself; the proxies of
+    score_models.py (PretokenizedTokenizer, pipeline.AheadTokenizer, metrics.TimedTokenizer) wrap one another."""
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+
+    def __getattr__(self, name):
+        return getattr(self.tokenizer, name)
+
+    def __len__(self):
+        return len(self.tokenizer)
+
+    def __call__(self, *args, **kwargs):
+        return self.tokenizer(*args, **kwargs)
+
+    def encode_rest(self, texts, sources, single):
+        # an Encoding of the texts, tokenizing those that have no source yet in one call
+        missing = [n for n, source in enumerate(sources) if source is None]
+        if missing:
+            encoded = self.tokenizer([texts[n] for n in missing])
+            for k, n in enumerate(missing):
+                sources[n] = (encoded, k)
+        return Encoding(sources, single)
+
+class PretokenizedTokenizer(TokenizerProxy):
+    """Plain calls on texts read their token ids from the artifacts when they are there and only tokenize the rest;
+    calls with options go to the tokenizer itself."""
+
+    def __init__(self, tokenizer, artifacts):
+        super().__init__(tokenizer)
+        self.artifacts = artifacts
+
+    def __call__(self, texts, **kwargs):
+        if kwargs:
+            return self.tokenizer(texts, **kwargs)
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+        sources = [None] * len(texts)
+        for artifact in self.artifacts:
+            missing = [n for n, source in enumerate(sources) if source is None]
+            for n, sequence in zip(missing, artifact.find([texts[n] for n in missing])):
+                if sequence >= 0:
+                    sources[n] = (artifact, int(sequence))
+        return self.encode_rest(texts, sources, single)
+
+def load_pretokenized(tokens_dir, data_file, tokenizer):
+    # the tokenizer, reading from the artifacts of the data file that were written with the same tokenizer
+    fingerprint = get_tokenizer_fingerprint(tokenizer)
+    artifacts = [TokenArtifact(path) for path in sorted((Path(tokens_dir) / Path(data_file).stem).glob(f'*_{fingerprint}'))
+                 if (path / 'meta.json').exists()]
+    return PretokenizedTokenizer(tokenizer, artifacts) if artifacts else tokenizer
+
+def main():
+    # e.g. python3 pretokenize.py 19*.tsv --tokens-dir tokens; then python3 score_models.py 19*.tsv --tokens-dir tokens
+    from score_models import models, get_tokenizer
+    parser = argparse.ArgumentParser()
+    parser.add_argument('data_files', nargs='+')
+    parser.add_argument('--tokens-dir', default='tokens')
+    parser.add_argument('--models', nargs='+', help='only these models of score_models.py')
+    parser.add_argument('--model-store', help='directory of models converted by model_store.py')
+    args = parser.parse_args()
+    for MODEL, model_type in models:
+        if args.models and MODEL not in args.models:
+            continue
+        tokenizer = get_tokenizer(MODEL, args.model_store)
+        kind = 'prompts' if 'chat' in MODEL or 'flan' in MODEL else 'sentences'
+        fingerprint = get_tokenizer_fingerprint(tokenizer)
+        for data_file in args.data_files:
+            path = get_artifact_path(args.tokens_dir, data_file, kind, fingerprint)
+            if (path / 'meta.json').exists():
+                # written earlier, or for another model with the same tokenizer
+                continue
+            print(f'{MODEL}: {path}')
+            # only the encoders' PLL needs word ids
+            write_artifact(path, get_texts(data_file, kind, MODEL, model_type), tokenizer, with_word_ids=model_type == 'encoder')
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,9 @@
+from collections import Counter
 import torch
 from transformers import GenerationConfig
+from answers import extract_answers
+from batching import (pad_batch, Batcher, get_common_prefix_length, score_with_shared_prefix, get_input_device,
+                      get_token_log_probs, get_log_prob_method)
 
 llama2_chat_family = ['meta-llama/Llama-2-7b-chat-hf', 'meta-llama/Llama-2-13b-chat-hf', 'meta-llama/Llama-2-70b-chat-hf']
 only_pre_trained_family = ['meta-llama/Llama-2-7b-hf', 'meta-llama/Llama-2-13b-hf', 'meta-llama/Llama-2-70b-hf',
@@ -56,32 +60,183 @@ def get_instruction_template_fns(model_signature):
         raise NotImplementedError(f"Instruction template for {model_signature} not implemented")
 
 
-def prompt_model(sentence, pronoun_type, pronouns, word, tokenizer, model, model_type, model_name):
-    sentence_with_blank = sentence.replace(pronoun_type, '___')
-    instruction_template = get_instruction_template_fns(model_name)
-    all_pronoun_templates = get_pronoun_templates()
-
-    options = pronouns
-    options_ = 'OPTIONS:\n' + '\n'.join(['- ' + o for o in options])
+def get_gen_config(tokenizer, model_name):
     gen_config_args = {
         'max_new_tokens': 20 if 'llama' in model_name else 5,
         'num_beams': 1,
         'eos_token_id': tokenizer.eos_token_id,
-        'pad_token': tokenizer.pad_token_id
+        'pad_token_id': tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
     }
-    gen_config = GenerationConfig(**gen_config_args)
+    return GenerationConfig(**gen_config_args)
 
-    for i, pronoun_template in enumerate(all_pronoun_templates):
-        filled = pronoun_template.format(task=sentence_with_blank, options=options_)
-        filled_with_instruction = instruction_template.add_prompt_template(filled)
-        input_ids = tokenizer(filled_with_instruction, return_tensors="pt").input_ids.cuda()
+def get_prompts(sentence, pronoun_type, pronouns, model_name):
+    # the filled prompts of every template for one row, in template order
+    sentence_with_blank = sentence.replace(pronoun_type, '___')
+    instruction_template = get_instruction_template_fns(model_name)
+    options_ = 'OPTIONS:\n' + '\n'.join(['- ' + o for o in pronouns])
+    return [instruction_template.add_prompt_template(t.format(task=sentence_with_blank, options=options_))
+            for t in get_pronoun_templates()]
+
+def generate_batch(prompts, tokenizer, model, model_name, batcher=None):
+    # generations for many prompts at once; prompts are left-padded with an attention mask,
+    # and unless the batcher mixes lengths a batch only holds prompts of one length, which keeps greedy
+    # decoding identical to generating every prompt on its own
+    batcher = batcher or Batcher(16)
+    gen_config = get_gen_config(tokenizer, model_name)
+    sequences = tokenizer(prompts).input_ids
+    generations = [None] * len(prompts)
+    # encoder-decoder models read the prompt with the encoder only, so their prompts can stay right-padded
+    padding_side = 'right' if model.config.is_encoder_decoder else 'left'
+
+    def generate(batch):
+        input_ids, attention_mask = pad_batch([sequences[n] for n in batch], gen_config.pad_token_id, padding_side)
+        device = get_input_device(model)
         with torch.no_grad():
-            outputs = model.generate(inputs=input_ids, generation_config=gen_config).cpu().detach()[0]
-            input_ids_cpu = input_ids.cpu().detach()[0]
+            outputs = model.generate(inputs=input_ids.to(device), attention_mask=attention_mask.to(device),
+                                     generation_config=gen_config).cpu().detach()
+        return input_ids.shape[1], outputs
+
+    # a batch costs its prompts plus the tokens generated for them
+    lengths = [len(seq) + gen_config.max_new_tokens for seq in sequences]
+    for batch, (prompt_len, outputs) in batcher.run(lengths, generate):
+        for n, output in zip(batch, outputs):
             if 'flan' in model_name:
-                decoded_tokens = tokenizer.decode(outputs, skip_special_tokens=True)
+                decoded_tokens = tokenizer.decode(output, skip_special_tokens=True)
             else:
-                decoded_tokens = tokenizer.decode(outputs[len(input_ids_cpu):], skip_special_tokens=True)
-            decoded_tokens = (decoded_tokens.strip()).replace("\n", " ")
-
-        yield i, decoded_tokens
+                decoded_tokens = tokenizer.decode(output[prompt_len:], skip_special_tokens=True)
+            generations[n] = (decoded_tokens.strip()).replace("\n", " ")
+    return generations
+
+def get_generations(prompts, tokenizer, model, model_name, batcher=None, cache=None):
+    # {prompt: generation} of distinct prompts, generating only those that are not cached
+    prompts = set(prompts)
+    # greedy generations of left-padded mixed-length batches can differ from those of equal-length batches
+    method = 'prompt-mixed-length' if batcher is not None and batcher.mixed_lengths else 'prompt'
+    generations = cache.get_many(method, prompts) if cache is not None else {}
+    missing = sorted(prompts - generations.keys())
+    if missing:
+        new_generations = dict(zip(missing, generate_batch(missing, tokenizer, model, model_name, batcher)))
+        if cache is not None:
+            cache.put_many(method, new_generations)
+        generations.update(new_generations)
+    return generations
+
+def prompt_model_batch(rows, tokenizer, model, model_type, model_name, batcher=None, cache=None):
+    # rows are (sentence, pronoun_type, pronouns, word) tuples; every (row, template) prompt is generated in
+    # batches and the result keeps the order of prompt_model: a list of (prompt_id, generation) per row
+    row_prompts = [get_prompts(sentence, pronoun_type, pronouns, model_name) for sentence, pronoun_type, pronouns, word in rows]
+    generations = get_generations([prompt for prompts in row_prompts for prompt in prompts], tokenizer, model,
+                                  model_name, batcher, cache)
+    return [[(i, generations[prompt]) for i, prompt in enumerate(prompts)] for prompts in row_prompts]
+
+def score_options_decoder(prompt, options, tokenizer, model):
+    # log prob of every option as the continuation of the prompt; the prompt is encoded once
+    # and its cache is shared by the options
+    sequences = tokenizer([f'{prompt} {o}' for o in options]).input_ids
+    prompt_ids = tokenizer(prompt).input_ids
+    # tokens the prompt and every completed sequence agree on belong to the prompt alone
+    prefix_len = min([get_common_prefix_length([prompt_ids, seq]) for seq in sequences] + [len(seq) - 1 for seq in sequences])
+    _, option_scores = score_with_shared_prefix(sequences, prefix_len, model)
+    return option_scores
+
+def score_options_enc_dec(prompt, options, tokenizer, model):
+    # log prob of every option as the decoder output for the prompt; the encoder runs once for all options
+    device = get_input_device(model)
+    encoded = tokenizer(prompt, return_tensors='pt').to(device)
+    labels, label_mask = pad_batch(tokenizer(options, add_special_tokens=False).input_ids)
+    labels = labels.to(device)
+    label_mask = label_mask.to(device)
+    with torch.no_grad():
+        encoder_outputs = model.get_encoder()(input_ids=encoded.input_ids, attention_mask=encoded.attention_mask)
+        hidden_states = encoder_outputs.last_hidden_state.expand(len(options), -1, -1)
+        logits = model(encoder_outputs=(hidden_states,),
+                       attention_mask=encoded.attention_mask.expand(len(options), -1),
+                       labels=labels.masked_fill(label_mask == 0, -100)).logits
+    token_log_probs = get_token_log_probs(logits, labels)
+    return (token_log_probs.double() * label_mask).sum(dim=1).tolist()
+
+def get_option_scores(prompts, pronouns, tokenizer, model, cache=None):
+    # {option: log prob} of every prompt of one row
+    method = get_log_prob_method('prompt-options')
+    cached = cache.get_many(method, prompts) if cache is not None else {}
+    results = []
+    for prompt in prompts:
+        if prompt in cached:
+            option_scores = cached[prompt]
+        else:
+            if model.config.is_encoder_decoder:
+                scores = score_options_enc_dec(prompt, pronouns, tokenizer, model)
+            else:
+                scores = score_options_decoder(prompt, pronouns, tokenizer, model)
+            option_scores = dict(zip(pronouns, scores))
+            if cache is not None:
+                cache.put_many(method, {prompt: option_scores})
+        results.append(option_scores)
+    return results
+
+def get_best_option(option_scores):
+    return sorted(option_scores.items(), key=lambda x: x[1], reverse=True)[0][0]
+
+def prompt_model_options(rows, tokenizer, model, model_type, model_name, cache=None):
+    # instead of generating, score every pronoun option as the answer to each prompt;
+    # returns a list of (prompt_id, best option, {option: log prob}) per row
+    results = []
+    for sentence, pronoun_type, pronouns, word in rows:
+        prompts = get_prompts(sentence, pronoun_type, pronouns, model_name)
+        option_scores = get_option_scores(prompts, pronouns, tokenizer, model, cache)
+        results.append([(i, get_best_option(scores), scores) for i, scores in enumerate(option_scores)])
+    return results
+
+def get_option_confidence(option_scores):
+    # probability of the best option among the options
+    scores = torch.tensor(list(option_scores.values()), dtype=torch.float64)
+    return scores.softmax(0).max().item()
+
+def prompt_model_adaptive(rows, tokenizer, model, model_type, model_name, order, quorum, confidence=None,
+                          prompt_mode='generate', batcher=None, cache=None, known=None):
+    """Like prompt_model_batch (or prompt_model_options with prompt_mode 'options'), but the templates of a row
+    only run until its answer is settled.
+
+    The templates run in the given order, one round at a time for all rows that are still open. A row stops once
+    quorum of its templates give the same answer (the pronoun a generation names, see answers.py, or the best
+    option), or, in options mode, once a template's best option has at least the given probability among the
+    options. known holds a {prompt_id: result} per row of templates that already ran, e.g. in an interrupted run;
+    they are replayed instead of running again. Every row gets the results of the templates that ran, in the
+    order they ran.
+    """
+    row_prompts = [get_prompts(sentence, pronoun_type, pronouns, model_name) for sentence, pronoun_type, pronouns, word in rows]
+    known = known or [{} for _ in rows]
+    results = [[] for _ in rows]
+    votes = [Counter() for _ in rows]
+    open_rows = list(range(len(rows)))
+    for i in order:
+        if not open_rows:
+            break
+        if prompt_mode == 'options':
+            round_results = [known[n][i] if i in known[n] else
+                             get_option_scores([row_prompts[n][i]], rows[n][2], tokenizer, model, cache)[0]
+                             for n in open_rows]
+            answers = [get_best_option(option_scores) for option_scores in round_results]
+            round_results = [(i, answer, option_scores) for answer, option_scores in zip(answers, round_results)]
+        else:
+            generations = get_generations([row_prompts[n][i] for n in open_rows if i not in known[n]], tokenizer,
+                                          model, model_name, batcher, cache)
+            round_results = [(i, known[n][i] if i in known[n] else generations[row_prompts[n][i]]) for n in open_rows]
+            answers, _, _ = extract_answers([generation for _, generation in round_results],
+                                            [rows[n][1] for n in open_rows])
+        still_open = []
+        for n, result, answer in zip(open_rows, round_results, answers):
+            results[n].append(result)
+            if answer:
+                votes[n][answer] += 1
+            settled = votes[n] and max(votes[n].values()) >= quorum
+            if prompt_mode == 'options' and confidence is not None:
+                settled = settled or get_option_confidence(result[2]) >= confidence
+            if not settled:
+                still_open.append(n)
+        open_rows = still_open
+    return results
+
+def prompt_model(sentence, pronoun_type, pronouns, word, tokenizer, model, model_type, model_name, cache=None):
+    yield from prompt_model_batch([(sentence, pronoun_type, pronouns, word)], tokenizer, model, model_type, model_name,
+                                  cache=cache)[0]
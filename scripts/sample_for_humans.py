@@ -1,13 +1,14 @@
 from pathlib import Path
 from glob import glob
 import pandas as pd
+from storage import read_table
 
 dfs = []
 ids = []
-for f in glob('13_*.tsv'):
+for f in glob('13_*.tsv') + glob('13_*.parquet'):
     id_ = Path(f).stem.split('13_')[1]
     ids.append(id_)
-    dfs.append(pd.read_csv(f, sep='\t'))
+    dfs.append(read_table(f))
 
 df = pd.concat(dfs, keys=ids)
 sampled = df.groupby(level=0).sample(100, random_state=131719)
@@ -1,14 +1,110 @@
+import argparse
+from collections import defaultdict
 from glob import glob
+import numpy as np
 import pandas as pd
+from storage import get_format, read_arrow_table, write_table, TableReader
+from virtual_dataset import VirtualDataset
 
-for f in glob('*.tsv'):
-    df = pd.read_csv(f, sep='\t')
-    occupations_only = df[df.occupation == df.word]
-    print(f, len(occupations_only))
-
-    for seed in [13, 17, 19]:
-        if len(occupations_only) == 7200:
-            sampled = occupations_only.groupby(['word', 'pronoun_type', 'pronoun']).sample(3, random_state=seed)
-        else:
-            sampled = occupations_only.groupby(['word', 'pronoun_type', 'pronoun', 'confuse_pronoun']).sample(1, random_state=seed)
-        sampled.to_csv(f'{seed}_{f}', sep='\t', index=None)
+seeds = [13, 17, 19]
+group_columns = ['word', 'pronoun_type', 'pronoun', 'confuse_pronoun']
+
+def index_groups(filename, chunk_size=200000):
+    # row numbers of the rows with occupation == word, per (word, pronoun_type, pronoun, confuse_pronoun) group,
+    # in file order; only the group columns are read, a chunk at a time, and missing values are kept as NaN keys
+    with TableReader(filename) as reader:
+        columns = ['occupation'] + [column for column in group_columns if column in reader.fieldnames]
+    if get_format(filename) == 'parquet':
+        chunks = [read_arrow_table(filename).select(columns).to_pandas()]
+    else:
+        chunks = pd.read_csv(filename, sep='\t', usecols=columns, chunksize=chunk_size)
+    groups = defaultdict(list)
+    n_rows = 0
+    for chunk in chunks:
+        for column in group_columns:
+            if column not in chunk:
+                chunk[column] = np.nan
+        occupations_only = chunk[chunk.occupation == chunk.word]
+        n_rows += len(occupations_only)
+        for key, positions in occupations_only.groupby(group_columns, sort=False, dropna=False).indices.items():
+            groups[key].append(occupations_only.index.values[positions])
+    return {key: np.concatenate(positions) for key, positions in groups.items()}, n_rows
+
+def merge_groups(groups, n_keys):
+    # groups by the first n_keys columns only; like pandas, groups with a missing key are left out
+    merged = defaultdict(list)
+    for key, rows in groups.items():
+        if not any(pd.isna(k) for k in key[:n_keys]):
+            merged[key[:n_keys]].append(rows)
+    return {key: np.sort(np.concatenate(rows)) for key, rows in merged.items()}
+
+def sample_groups(groups, n, seed):
+    """Row numbers of n rows per group, the same rows in the same order as pandas' groupby(...).sample(n, random_state=seed).
+
+    pandas goes through the groups in sorted key order with a single RandomState and picks the rows of a group with
+    choice(group size, n, replace=False); the same calls here reproduce its output exactly.
+    """
+    random_state = np.random.RandomState(seed)
+    return np.concatenate([groups[key][random_state.choice(len(groups[key]), size=n, replace=False)]
+                           for key in sorted(groups)])
+
+def read_tsv_rows(filename, rows):
+    # header and {row number: line} of the given rows, in one pass over the file
+    wanted = set(rows.tolist())
+    lines = {}
+    with open(filename, encoding='utf-8') as f:
+        header = f.readline()
+        for row, line in enumerate(f):
+            if row in wanted:
+                lines[row] = line
+                if len(lines) == len(wanted):
+                    break
+    return header, lines
+
+def sample_file(f):
+    # all seeds of one file from a single index of its groups
+    groups, n_rows = index_groups(f)
+    print(f, n_rows)
+    if n_rows == 7200:
+        samples = {seed: sample_groups(merge_groups(groups, 3), 3, seed) for seed in seeds}
+    else:
+        samples = {seed: sample_groups(merge_groups(groups, 4), 1, seed) for seed in seeds}
+
+    if get_format(f) == 'parquet':
+        table = read_arrow_table(f)
+        for seed, rows in samples.items():
+            write_table(table.take(rows).to_pandas(), f'{seed}_{f}')
+        return
+    # tab-separated lines are copied as they are; the files hold plain strings only, which pandas writes back unchanged
+    header, lines = read_tsv_rows(f, np.concatenate(list(samples.values())))
+    for seed, rows in samples.items():
+        with open(f'{seed}_{f}', 'w', encoding='utf-8') as out:
+            out.write(header)
+            out.writelines(lines[row] for row in rows)
+
+def sample_files():
+    for f in glob('*.tsv') + glob('*.parquet'):
+        sample_file(f)
+
+def sample_virtual(task_file, context_file):
+    # sample straight from the add_context combinatorics without generating the full files first
+    for depth in range(1, 7):
+        dataset = VirtualDataset(task_file, context_file, depth)
+        print(dataset.name, len(dataset))
+        for seed in seeds:
+            sampled = dataset.sample(3 if depth == 1 else 1, seed)
+            dataset.write(sampled, f'{seed}_{dataset.name}')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--task-file', help='sample from the task and context templates instead of the generated *.tsv files')
+    parser.add_argument('--context-file')
+    args = parser.parse_args()
+    if args.task_file:
+        assert args.context_file
+        sample_virtual(args.task_file, args.context_file)
+    else:
+        sample_files()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+import multiprocessing
+import os
+import re
+from multiprocessing.connection import wait
+import torch
+import score_models
+from score_models import get_parser, construct_model_file_map
+from checkpoint import get_partial_path, get_shard_path
+from storage import TableReader, TableWriter, read_arrow_table
+
+# parameter counts of the models whose names do not include them
+model_params = {
+    'albert-base-v2': 11e6,
+    'albert-large-v2': 17e6,
+    'albert-xlarge-v2': 58e6,
+    'albert-xxlarge-v2': 223e6,
+    'bert-base-uncased': 110e6,
+    'bert-large-uncased': 340e6,
+    'roberta-base': 125e6,
+    'roberta-large': 355e6,
+    'mosaic-bert-base-seqlen-2048': 137e6,
+    'flan-t5-small': 77e6,
+    'flan-t5-base': 248e6,
+    'flan-t5-large': 783e6,
+    'flan-t5-xl': 2.85e9,
+    'flan-t5-xxl': 11.3e9,
+}
+
+def get_model_params(model_name):
+    name = model_name.split('/')[-1]
+    if name in model_params:
+        return model_params[name]
+    match = re.search(r'-(\d+(?:\.\d+)?)([mb])(?:-|$)', name)
+    if match is None:
+        return None
+    return float(match.group(1)) * {'m': 1e6, 'b': 1e9}[match.group(2)]
+
+def get_model_memory(model_name, model_type):
+    # rough size in bytes of the weights as loaded by score_models.get_model, with some room for activations;
+    # models of unknown size only take up one of the worker slots of a device
+    params = get_model_params(model_name)
+    if params is None:
+        return 0
+    half = model_type == 'enc-dec' or any(s in model_name for s in ['12b', '13b', '30b', '66b', '70b'])
+    return params * (2 if half else 4) * 1.2
+
+def get_devices(args):
+    if args.devices:
+        return args.devices.split(',')
+    if torch.cuda.is_available():
+        return [f'cuda:{i}' for i in range(torch.cuda.device_count())]
+    return ['cpu']
+
+def get_device_memory(device, devices, args):
+    if args.device_memory_gb:
+        return args.device_memory_gb * 2**30
+    if device.startswith('cuda'):
+        return torch.cuda.get_device_properties(get_device_index(device)).total_memory
+    # the cpu devices share the system memory
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / devices.count('cpu')
+
+def get_device_index(device):
+    return int(device.split(':')[1]) if ':' in device else 0
+
+def get_visible_devices(devices):
+    # value of CUDA_VISIBLE_DEVICES for a worker, so that 'cuda' and device_map='auto' in score_models only use its gpus
+    if devices[0] == 'cpu':
+        return ''
+    indices = [get_device_index(device) for device in devices]
+    visible = os.environ.get('CUDA_VISIBLE_DEVICES')
+    if visible:
+        return ','.join(visible.split(',')[i] for i in indices)
+    return ','.join(str(i) for i in indices)
+
+def count_rows(data_file):
+    with TableReader(data_file) as reader:
+        if reader.format == 'parquet':
+            return reader.parquet_file.metadata.num_rows
+        return sum(1 for _ in reader)
+
+def get_work_units(model_file_map, shard_rows):
+    # (data file, result file, start, stop) units of every model that still need scoring, and the shards of every result file
+    row_counts = {}
+    units = {}
+    shards = {}
+    for MODEL, files in model_file_map.items():
+        units[MODEL] = []
+        for model_type, data_file, out_file in files:
+            if data_file not in row_counts:
+                row_counts[data_file] = count_rows(data_file)
+            n_rows = row_counts[data_file]
+            ranges = [(start, min(start + shard_rows, n_rows)) for start in range(0, n_rows, shard_rows)] or [(0, 0)]
+            shards[out_file] = [get_shard_path(out_file, start, stop) for start, stop in ranges]
+            for start, stop in ranges:
+                if not get_shard_path(out_file, start, stop).exists():
+                    units[MODEL].append((data_file, out_file, start, stop))
+    return units, shards
+
+def merge_shards(out_file, shard_files):
+    # concatenate the shards of a result file in row order and move the result into place atomically
+    if len(shard_files) == 1:
+        os.replace(shard_files[0], out_file)
+        return
+    partial_file = get_partial_path(out_file)
+    with TableReader(shard_files[0]) as reader:
+        header = reader.fieldnames
+    with TableWriter(partial_file, header) as writer:
+        for shard_file in shard_files:
+            if writer.format == 'tsv':
+                with open(shard_file, encoding='utf-8') as f:
+                    f.readline() # header
+                    writer.write_tsv_chunk(f.read())
+            else:
+                writer.write_arrow_table(read_arrow_table(shard_file))
+    os.replace(partial_file, out_file)
+    for shard_file in shard_files:
+        shard_file.unlink()
+
+def run_worker(args, model_name, model_type, units, next_unit, threads=None):
+    # loads the model once and scores units until none are left; the units are shared with the other workers of the model
+    if threads:
+        torch.set_num_threads(threads)
+    model, tokenizer, cache = score_models.load_model(model_name, model_type, args)
+    while True:
+        with next_unit.get_lock():
+            n = next_unit.value
+            next_unit.value += 1
+        if n >= len(units):
+            break
+        data_file, out_file, start, stop = units[n]
+        score_models.score_file(args, model_name, model_type, model, tokenizer, cache, data_file,
+                                get_shard_path(out_file, start, stop), (start, stop))
+    if cache is not None:
+        cache.close()
+
+class Scheduler:
+    """Runs the models on a set of devices, several worker processes at a time.
+
+    Every worker loads one model on one device (or on several gpus for models that do not fit on one) and takes
+    row ranges of that model's result files from a shared list until all are scored. Devices take new workers as
+    long as their memory and worker slots allow, so small models are packed several to a device. Once all ranges
+    of a model are done, the shards of each result file are merged in row order.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.devices = get_devices(args)
+        self.capacity = [get_device_memory(device, self.devices, args) for device in self.devices]
+        self.free = list(self.capacity)
+        self.n_workers = [0] * len(self.devices)
+        # cpu workers split the cores between them instead of each using all of them
+        cpu_slots = self.devices.count('cpu') * args.workers_per_device
+        self.cpu_threads = max(1, (os.cpu_count() or 1) // cpu_slots) if cpu_slots else None
+        self.context = multiprocessing.get_context('spawn')
+        self.running = {}
+
+    def place(self, memory):
+        # indices of the devices for a new worker of the given size, or None if it has to wait
+        fitting = [i for i in range(len(self.devices))
+                   if self.free[i] >= memory and self.n_workers[i] < self.args.workers_per_device]
+        if fitting:
+            return [max(fitting, key=lambda i: self.free[i])]
+        if memory <= max(self.capacity):
+            return None
+        # larger than any device: spread over idle devices, or over all of them if even those are not enough
+        idle = [i for i in range(len(self.devices)) if self.n_workers[i] == 0]
+        chosen = []
+        for i in idle:
+            chosen.append(i)
+            if sum(self.capacity[j] for j in chosen) >= memory:
+                return chosen
+        return chosen if len(idle) == len(self.devices) else None
+
+    def start_worker(self, job, device_indices):
+        devices = [self.devices[i] for i in device_indices]
+        threads = self.cpu_threads if devices[0] == 'cpu' else None
+        process = self.context.Process(target=run_worker, args=(self.args, job['model'], job['model_type'],
+                                                                job['units'], job['next_unit'], threads))
+        # spawned workers inherit the environment, and read it before cuda is initialized
+        previous = os.environ.get('CUDA_VISIBLE_DEVICES')
+        os.environ['CUDA_VISIBLE_DEVICES'] = get_visible_devices(devices)
+        try:
+            process.start()
+        finally:
+            if previous is None:
+                del os.environ['CUDA_VISIBLE_DEVICES']
+            else:
+                os.environ['CUDA_VISIBLE_DEVICES'] = previous
+        print(f'{job["model"]} on {",".join(devices)}')
+        for i in device_indices:
+            self.n_workers[i] += 1
+            self.free[i] -= job['memory'] if len(device_indices) == 1 else self.capacity[i]
+        job['running'] += 1
+        self.running[process.sentinel] = (process, job, device_indices)
+
+    def finish_worker(self, sentinel):
+        process, job, device_indices = self.running.pop(sentinel)
+        process.join()
+        for i in device_indices:
+            self.n_workers[i] -= 1
+            self.free[i] += job['memory'] if len(device_indices) == 1 else self.capacity[i]
+        job['running'] -= 1
+        if process.exitcode != 0:
+            raise RuntimeError(f'worker for {job["model"]} failed with exit code {process.exitcode}')
+
+    def run(self, model_file_map):
+        units, shards = get_work_units(model_file_map, self.args.shard_rows)
+        jobs = []
+        for MODEL, files in model_file_map.items():
+            model_type = files[0][0]
+            jobs.append({'model': MODEL, 'model_type': model_type, 'memory': get_model_memory(MODEL, model_type),
+                         'units': units[MODEL], 'next_unit': self.context.Value('i', 0), 'running': 0,
+                         'out_files': [out_file for model_type, data_file, out_file in files]})
+        try:
+            while jobs:
+                for job in jobs:
+                    # no more workers than there are unclaimed units
+                    while job['running'] < len(job['units']) - job['next_unit'].value:
+                        device_indices = self.place(job['memory'])
+                        if device_indices is None:
+                            break
+                        self.start_worker(job, device_indices)
+                finished = [job for job in jobs if job['running'] == 0 and job['next_unit'].value >= len(job['units'])]
+                for job in finished:
+                    for out_file in job['out_files']:
+                        merge_shards(out_file, shards[out_file])
+                    jobs.remove(job)
+                if self.running:
+                    for sentinel in wait(list(self.running)):
+                        self.finish_worker(sentinel)
+                elif jobs and not finished:
+                    raise RuntimeError(f'no device can run {jobs[0]["model"]}')
+        finally:
+            for process, job, device_indices in self.running.values():
+                process.terminate()
+
+def parse_args():
+    parser = get_parser()
+    parser.add_argument('--devices', help='comma-separated devices for the workers, e.g. cuda:0,cuda:1 or cpu,cpu; '
+                                          'defaults to all gpus, or the cpu')
+    parser.add_argument('--workers-per-device', type=int, default=4,
+                        help='most workers (models) on one device at a time')
+    parser.add_argument('--device-memory-gb', type=float,
+                        help='memory per device that models are packed into; defaults to the gpu memory, or the '
+                             'system memory split between the cpu devices')
+    parser.add_argument('--shard-rows', type=int, default=5000,
+                        help='rows per unit of work; keep it the same when resuming an interrupted run')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    model_file_map = construct_model_file_map(args.data_files, args.output_format, args.quantize)
+    Scheduler(args).run(model_file_map)
+
+if __name__ == '__main__':
+    main()
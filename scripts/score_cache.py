@@ -0,0 +1,95 @@
+import hashlib
+import json
+import sqlite3
+import time
+
+class ScoreCache:
+    """Persistent cache of model outputs keyed by (model name and revision, scoring method, exact input text).
+
+    load_mode (see offload.get_load_mode) becomes part of every method, so scores of a model loaded in another
+    dtype or quantized never serve each other.
+
+    Values are anything json can store: a log prob for the scoring paths, a generation for the prompting path.
+    Entries are kept in a SQLite file that several runs can share; once the stored keys and values exceed
+    max_bytes, the least recently used entries are evicted.
+    """
+
+    def __init__(self, path, model_name, revision=None, max_bytes=None, load_mode=None):
+        self.model_name = model_name
+        self.revision = revision or ''
+        self.load_mode = load_mode
+        self.max_bytes = max_bytes
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS scores '
+                                '(key TEXT PRIMARY KEY, value TEXT, size INTEGER, last_used REAL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS scores_last_used ON scores (last_used)')
+        # the total size is kept up to date by triggers, so nothing has to add up the sizes of all entries again; the
+        # entries a REPLACE overwrites only fire the delete trigger with recursive triggers on
+        self.connection.execute('PRAGMA recursive_triggers = ON')
+        self.connection.execute('BEGIN IMMEDIATE')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)')
+        self.connection.execute("INSERT OR IGNORE INTO meta SELECT 'size', COALESCE(SUM(size), 0) FROM scores")
+        self.connection.execute("CREATE TRIGGER IF NOT EXISTS scores_insert AFTER INSERT ON scores BEGIN "
+                                "UPDATE meta SET value = value + new.size WHERE name = 'size'; END")
+        self.connection.execute("CREATE TRIGGER IF NOT EXISTS scores_delete AFTER DELETE ON scores BEGIN "
+                                "UPDATE meta SET value = value - old.size WHERE name = 'size'; END")
+        self.connection.commit()
+
+    def get_key(self, method, text):
+        if self.load_mode:
+            method = f'{method}-{self.load_mode}'
+        return hashlib.sha256(json.dumps([self.model_name, self.revision, method, text]).encode('utf-8')).hexdigest()
+
+    def get_many(self, method, texts):
+        # {text: value} for the texts that are cached
+        keys = {self.get_key(method, text): text for text in texts}
+        found = {}
+        key_list = list(keys)
+        for start in range(0, len(key_list), 500): # stay below SQLite's limit on query parameters
+            batch = key_list[start:start + 500]
+            rows = self.connection.execute(f'SELECT key, value FROM scores WHERE key IN ({",".join("?" * len(batch))})', batch)
+            for key, value in rows:
+                found[keys[key]] = json.loads(value)
+        if found:
+            now = time.time()
+            self.connection.executemany('UPDATE scores SET last_used = ? WHERE key = ?',
+                                        [(now, self.get_key(method, text)) for text in found])
+            self.connection.commit()
+        return found
+
+    def put_many(self, method, values):
+        now = time.time()
+        rows = []
+        for text, value in values.items():
+            key = self.get_key(method, text)
+            value = json.dumps(value)
+            rows.append((key, value, len(key) + len(value), now))
+        self.connection.executemany('INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?)', rows)
+        self.connection.commit()
+        if self.max_bytes is not None:
+            self.evict()
+
+    def get_size(self):
+        return self.connection.execute("SELECT value FROM meta WHERE name = 'size'").fetchone()[0]
+
+    def evict(self):
+        excess = self.get_size() - self.max_bytes
+        if excess <= 0:
+            return
+        # delete the least recently used entries until the cache fits again
+        rows = self.connection.execute('SELECT key, size FROM scores ORDER BY last_used')
+        evicted = []
+        for key, size in rows:
+            if excess <= 0:
+                break
+            evicted.append((key,))
+            excess -= size
+        self.connection.executemany('DELETE FROM scores WHERE key = ?', evicted)
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+def get_revision(model):
+    # commit hash of the checkpoint when it was loaded from the hub
+    return getattr(model.config, '_commit_hash', None)
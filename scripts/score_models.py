@@ -1,16 +1,28 @@
 import torch
 from transformers import AutoTokenizer, AutoModelForMaskedLM, AutoModelForCausalLM, T5ForConditionalGeneration, BertConfig
 import numpy as np
-import torch.nn.functional as F
 from collections import defaultdict
 from typing import Dict
+from itertools import islice
 from pathlib import Path
 from constants import HF_ACCESS_TOKEN
 from pronouns import mapping
-from prompt import prompt_model
+from prompt import prompt_model_batch, prompt_model_options, prompt_model_adaptive, get_pronoun_templates
+from pll import score_pll, score_pll_diff_aware
+import batching
+from batching import (pad_batch, Batcher, get_common_prefix_length, score_with_shared_prefix, get_token_log_probs,
+                      get_log_prob_method)
+from storage import TableReader, get_suffix
+from checkpoint import Journal
+from score_cache import ScoreCache, get_revision
+import model_store
+from offload import get_load_kwargs, get_load_mode, format_load_report, format_memory, reset_peak_memory
+from pretokenize import load_pretokenized, get_row_texts
+from pipeline import Pipeline, AheadTokenizer
+from metrics import metrics, TimedTokenizer, export_record, format_record, get_profiler, parse_profile_window
 from minicons import scorer
-import csv
-import sys
+import argparse
+import time
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
@@ -19,7 +31,18 @@ def get_mask_token(model):
         return '<mask>'
     return '[MASK]'
 
-def get_model(model_name, model_type):
+def get_model(model_name, model_type, store=None, load_kwargs=None):
+    # load_kwargs of offload.get_load_kwargs place decoder and encoder-decoder models with accelerate instead,
+    # quantized or offloaded; the encoders are small, and most of them cannot be split by a device map
+    if model_type == 'encoder':
+        load_kwargs = None
+    if store is not None:
+        # converted ahead of time by model_store.py, if it is in the store
+        model = model_store.load_model(store, model_name, model_type, device, load_kwargs)
+        if model is not None:
+            return model
+    if load_kwargs is not None:
+        return model_store.model_classes[model_type].from_pretrained(model_name, token=HF_ACCESS_TOKEN, **load_kwargs)
     if model_type == 'encoder':
         if 'mosaic-bert' in model_name:
             config = BertConfig.from_pretrained(model_name)
@@ -46,7 +69,11 @@ def get_model(model_name, model_type):
         raise ValueError('unsupported model type!')
     return model
 
-def get_tokenizer(model_name):
+def get_tokenizer(model_name, store=None):
+    if store is not None:
+        tokenizer = model_store.load_tokenizer(store, model_name)
+        if tokenizer is not None:
+            return tokenizer
     if 'mosaic-bert' in model_name:
         tokenizer = AutoTokenizer.from_pretrained('bert-base-uncased')
     else:
@@ -94,31 +121,115 @@ models = [
     ('meta-llama/Llama-2-70b-chat-hf', 'decoder'),
 ]
 
-def get_encoder_log_probs(sentence, pronoun_type, pronouns, mlm_scorer):
+def get_encoder_log_probs(sentence, pronoun_type, pronouns, mlm_scorer, cache=None):
+    verbalized = {p: sentence.replace(pronoun_type, p) for p in pronouns}
+    cached = cache.get_many('encoder', verbalized.values()) if cache is not None else {}
     log_prob_dict = {}
     for p in pronouns:
-        verbalized = sentence.replace(pronoun_type, p)
-        log_prob_dict[p] = mlm_scorer.sequence_score(verbalized,
+        if verbalized[p] in cached:
+            log_prob_dict[p] = cached[verbalized[p]]
+            continue
+        log_prob_dict[p] = mlm_scorer.sequence_score(verbalized[p],
                                                      reduction = lambda x: x.sum(0).item(),
                                                      PLL_metric='within_word_l2r')[0]
+    if cache is not None:
+        cache.put_many('encoder', {verbalized[p]: log_prob_dict[p] for p in pronouns if verbalized[p] not in cached})
     return log_prob_dict
 
+def get_encoder_log_probs_batch(rows, tokenizer, model, batcher=None, cache=None):
+    # rows are (sentence, pronoun_type, pronouns) triples; the masked copies of all their verbalizations are scored together
+    verbalized = [{p: sentence.replace(pronoun_type, p) for p in pronouns} for sentence, pronoun_type, pronouns in rows]
+    batcher = batcher or Batcher()
+    method = 'encoder-mixed-length' if batcher.mixed_lengths else 'encoder'
+    all_texts = {text for texts in verbalized for text in texts.values()}
+    scores = cache.get_many(method, all_texts) if cache is not None else {}
+    missing = sorted(all_texts - scores.keys())
+    if missing:
+        new_scores = dict(zip(missing, score_pll(missing, tokenizer, model, batcher)))
+        if cache is not None:
+            cache.put_many(method, new_scores)
+        scores.update(new_scores)
+    return [{p: scores[text] for p, text in texts.items()} for texts in verbalized]
+
+def get_encoder_log_probs_diff_aware(rows, tokenizer, model, batcher=None, cache=None):
+    # the context outside the pronoun slot is scored once per row; see pll.score_pll_diff_aware for how this
+    # differs from full PLL. A score depends on the template and not only on the verbalized sentence,
+    # so the template and pronoun make up the cache key
+    batcher = batcher or Batcher()
+    method = 'encoder-diff-aware-mixed-length' if batcher.mixed_lengths else 'encoder-diff-aware'
+    keys = [{p: f'{sentence}\t{p}' for p in pronouns} for sentence, pronoun_type, pronouns in rows]
+    scores = cache.get_many(method, {key for row_keys in keys for key in row_keys.values()}) if cache is not None else {}
+    missing = [row for row, row_keys in zip(rows, keys) if any(key not in scores for key in row_keys.values())]
+    if missing:
+        new_scores = {}
+        for (sentence, pronoun_type, pronouns), log_prob_dict in zip(missing, score_pll_diff_aware(missing, tokenizer, model, batcher)):
+            new_scores.update({f'{sentence}\t{p}': score for p, score in log_prob_dict.items()})
+        if cache is not None:
+            cache.put_many(method, new_scores)
+        scores.update(new_scores)
+    return [{p: scores[key] for p, key in row_keys.items()} for row_keys in keys]
+
+def score_decoder_sequences(sequences, model):
+    # sum of log probs of every token given its prefix (excluding the first token) for each sequence
+    input_ids, attention_mask = pad_batch(sequences)
+    input_ids = input_ids.to(device)
+    attention_mask = attention_mask.to(device)
+    with torch.no_grad():
+        logits = model(input_ids, attention_mask=attention_mask).logits
+    token_log_probs = get_token_log_probs(logits[:, :-1], input_ids[:, 1:]) # logprob at the k-1-th position of the kth token in the input
+    token_log_probs = token_log_probs.double() * attention_mask[:, 1:]
+    return token_log_probs.sum(dim=1).tolist()
+
+def get_decoder_log_probs_batch(rows, tokenizer, model, batcher=None, cache=None):
+    # rows are (sentence, pronoun_type, pronouns) triples; all their verbalizations are scored together
+    verbalized = [{p: sentence.replace(pronoun_type, p) for p in pronouns} for sentence, pronoun_type, pronouns in rows]
+    batcher = batcher or Batcher()
+    method = get_log_prob_method('decoder-mixed-length' if batcher.mixed_lengths else 'decoder')
+    all_texts = {text for texts in verbalized for text in texts.values()}
+    scores = cache.get_many(method, all_texts) if cache is not None else {}
+    missing = sorted(all_texts - scores.keys())
+    if missing:
+        sequences = tokenizer(missing).input_ids
+        new_scores = {}
+
+        def score_batch(batch):
+            return score_decoder_sequences([sequences[n] for n in batch], model)
+
+        for batch, batch_scores in batcher.run([len(seq) for seq in sequences], score_batch):
+            for n, score in zip(batch, batch_scores):
+                new_scores[missing[n]] = score
+        if cache is not None:
+            cache.put_many(method, new_scores)
+        scores.update(new_scores)
+    return [{p: scores[text] for p, text in texts.items()} for texts in verbalized]
+
 def get_decoder_log_probs(sentence, pronoun_type, pronouns, tokenizer, model):
-    log_prob_dict = {}
-    for p in pronouns:
-        verbalized = sentence.replace(pronoun_type, p)
-        input_ids = tokenizer(verbalized, return_tensors='pt').input_ids.to(device)
-        outputs = model(input_ids).logits.detach()
-        out_logits = outputs[0]
-        log_probs = F.log_softmax(out_logits, dim=1) # convert to log probs by doing a log softmax
-        log_prob_sum = 0.0
-        for i in range(1, input_ids.shape[1]): # iterate over every input token position excluding BOS
-            lp = log_probs[i-1, input_ids[0, i]] # logprob at the k-1-th position of the kth token in the input
-            log_prob_sum += lp.item()
-        log_prob_dict[p] = log_prob_sum
-    return log_prob_dict
+    return get_decoder_log_probs_batch([(sentence, pronoun_type, pronouns)], tokenizer, model)[0]
+
+def get_decoder_log_probs_shared_prefix(sentence, pronoun_type, pronouns, tokenizer, model, cache=None):
+    # the verbalizations only differ from the pronoun slot onwards, so the common prefix is encoded once
+    # and its past_key_values are reused to score the diverging suffixes of all pronouns in one batch
+    verbalized = [sentence.replace(pronoun_type, p) for p in pronouns]
+    if cache is not None:
+        method = get_log_prob_method('decoder-shared-prefix')
+        cached = cache.get_many(method, verbalized)
+        if len(cached) == len(verbalized):
+            return {p: cached[text] for p, text in zip(pronouns, verbalized)}
+        log_prob_dict = get_decoder_log_probs_shared_prefix(sentence, pronoun_type, pronouns, tokenizer, model)
+        cache.put_many(method, {text: log_prob_dict[p] for p, text in zip(pronouns, verbalized)})
+        return log_prob_dict
+
+    sequences = tokenizer(verbalized).input_ids
+    # every suffix needs at least one token to be predicted from the prefix
+    prefix_len = min(get_common_prefix_length(sequences), min(len(seq) for seq in sequences) - 1)
+    if prefix_len < 1:
+        return get_decoder_log_probs(sentence, pronoun_type, pronouns, tokenizer, model)
 
-def construct_model_file_map(input_files):
+    prefix_score, suffix_scores = score_with_shared_prefix(sequences, prefix_len, model)
+    return {p: prefix_score + score for p, score in zip(pronouns, suffix_scores)}
+
+def construct_model_file_map(input_files, output_format='tsv', quantize=None):
+    # results of quantized models are kept apart, e.g. facebook_opt-13b-8bit.tsv
     model_file_map = defaultdict(list)
     for data_file in input_files:
         # make directory for results
@@ -126,8 +237,10 @@ def construct_model_file_map(input_files):
         folder = Path(stem)
         folder.mkdir(exist_ok=True)
         for MODEL, model_type in models:
-            out_file = Path(folder / f"{MODEL.replace('/', '_')}.tsv")
-            prompt_out_file = Path(folder / f"prompt_{MODEL.replace('/', '_')}.tsv")
+            suffix = get_suffix(output_format)
+            name = MODEL.replace('/', '_') + (f'-{quantize}' if quantize else '')
+            out_file = Path(folder / f"{name}{suffix}")
+            prompt_out_file = Path(folder / f"prompt_{name}{suffix}")
             if out_file.exists() and prompt_out_file.exists():
                 continue
             if not out_file.exists() and 'chat' not in MODEL and 'flan' not in MODEL:
@@ -136,104 +249,383 @@ def construct_model_file_map(input_files):
                 model_file_map[MODEL].append((model_type, data_file, prompt_out_file))
     return model_file_map
 
-def main():
-    assert len(sys.argv) >= 2
+def iter_chunks(iterable, chunk_size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
-    model_file_map = construct_model_file_map(sys.argv[1:])
+def parse_template_order(text):
+    order = [int(i) for i in text.split(',')]
+    if len(set(order)) < len(order) or not all(0 <= i < len(get_pronoun_templates()) for i in order):
+        raise argparse.ArgumentTypeError(f'template ids must be distinct and between 0 and {len(get_pronoun_templates()) - 1}')
+    return order
 
-    for MODEL in model_file_map:
-        print(f'loading {MODEL}')
-        model_type = model_file_map[MODEL][0][0]
-        model = get_model(MODEL, model_type)
-        tokenizer = get_tokenizer(MODEL)
-        model.eval() # disable dropout
-        for model_type, data_file, out_file in model_file_map[MODEL]:
-            is_prompt = 'prompt' in out_file.name
-            print(out_file)
-            header = [
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('data_files', nargs='+')
+    parser.add_argument('--batch-size', type=int, default=32,
+                        help='maximum number of verbalized sentences per decoder forward pass, masked copies per encoder '
+                             'forward pass or prompts per generate call')
+    parser.add_argument('--chunk-size', type=int, default=256,
+                        help='number of rows read and scored together')
+    parser.add_argument('--max-batch-tokens', type=int,
+                        help='token budget of a forward pass: batches stop growing once their number of sequences times '
+                             'the longest length (plus the generated tokens when prompting) reaches it; batches that run '
+                             'out of gpu memory are split and both limits halved')
+    parser.add_argument('--mixed-length-batches', action='store_true',
+                        help='allow padded batches of different lengths; faster, but scores only match the '
+                             'unbatched ones up to floating point rounding')
+    parser.add_argument('--encoder-scoring', choices=['batched', 'minicons', 'diff-aware'], default='batched',
+                        help='batched scores the masked copies of many sentences together; minicons scores one '
+                             'sentence at a time; both compute the same within_word_l2r PLL; diff-aware scores the '
+                             'context around the pronoun once per row, with the pronoun masked, which approximates PLL')
+    parser.add_argument('--decoder-scoring', choices=['batched', 'shared-prefix'], default='batched',
+                        help='shared-prefix encodes the part of a row shared by all pronouns once and reuses its '
+                             'cache; scores match batched scoring up to floating point rounding')
+    parser.add_argument('--log-prob-chunk-positions', type=int,
+                        help='compute the decoder log probs with a chunked kernel, this many positions of a sequence at '
+                             'a time, as the logit of a token minus the logsumexp of the logits, instead of the '
+                             'log_softmax of all logits at once; takes less memory, but the scores only match up to '
+                             'floating point rounding (and are cached apart)')
+    parser.add_argument('--log-prob-chunk-vocab', type=int,
+                        help='compute the decoder log probs with the chunked kernel, taking the logsumexp over this '
+                             'many vocabulary entries at a time (default: the whole vocabulary)')
+    parser.add_argument('--log-prob-dtype', choices=['float32', 'model'],
+                        help='compute the decoder log probs with the chunked kernel, upcasting every chunk of float16 '
+                             'or bfloat16 logits to float32 (the default of the kernel) or keeping the dtype of the model')
+    parser.add_argument('--output-format', choices=['tsv', 'parquet'], default='tsv',
+                        help='format of the result files; data files can be tsv or parquet either way')
+    parser.add_argument('--prompt-mode', choices=['generate', 'options'], default='generate',
+                        help='options scores every pronoun as the answer to each prompt instead of generating')
+    parser.add_argument('--adaptive-templates', action='store_true',
+                        help='run the prompt templates of a row in --template-order only until --quorum of them agree '
+                             'on the answer (or, with --prompt-mode options, one reaches --confidence); the results '
+                             'files only hold the templates that ran')
+    parser.add_argument('--template-order', type=parse_template_order,
+                        help='comma-separated template ids for --adaptive-templates (default: all, in their usual order)')
+    parser.add_argument('--quorum', type=int, default=3,
+                        help='number of templates that must give the same answer to stop a row early')
+    parser.add_argument('--confidence', type=float,
+                        help='with --prompt-mode options, also stop a row once the best option of a template has at '
+                             'least this probability among the options')
+    parser.add_argument('--quantize', choices=['8bit', '4bit'],
+                        help='load the weights quantized with bitsandbytes (requires a gpu)')
+    parser.add_argument('--max-memory',
+                        help='memory per device for the layers of a model, e.g. 0=20GiB,1=20GiB,cpu=64GiB; layers that '
+                             'do not fit are kept in host memory or --offload-dir and moved in for every forward pass')
+    parser.add_argument('--offload-dir', help='directory for the layers that fit on no device')
+    parser.add_argument('--model-store', help='directory of models converted by model_store.py; models that are not '
+                                              'in it are loaded from the hugging face cache as usual')
+    parser.add_argument('--tokens-dir', help='directory of token ids written by pretokenize.py; texts that are not in '
+                                             'it are tokenized as usual')
+    parser.add_argument('--cache', help='SQLite file of cached scores and generations, shared across runs')
+    parser.add_argument('--cache-max-mb', type=int, help='evict the least recently used cache entries beyond this size')
+    parser.add_argument('--prefetch-chunks', type=int, default=2,
+                        help='chunks read and tokenized ahead in a reader thread, and scored chunks waiting for the writer '
+                             'thread, while the model works; 0 reads, scores and writes in sequence in one thread')
+    parser.add_argument('--profile-window', type=parse_profile_window,
+                        help='SKIP,COUNT: trace COUNT chunks of every results file after skipping SKIP of them with the '
+                             'torch profiler, into a chrome trace <results file>.trace.json')
+    return parser
+
+def parse_args():
+    return get_parser().parse_args()
+
+def load_model(MODEL, model_type, args):
+    print(f'loading {MODEL}')
+    load_kwargs = None
+    if args.quantize or args.max_memory or args.offload_dir:
+        load_kwargs = get_load_kwargs(MODEL, model_type, args.quantize, args.max_memory, args.offload_dir)
+    reset_peak_memory()
+    start = time.perf_counter()
+    model = get_model(MODEL, model_type, args.model_store, load_kwargs)
+    tokenizer = get_tokenizer(MODEL, args.model_store)
+    model.eval() # disable dropout
+    metrics.load_seconds = time.perf_counter() - start
+    batching.log_prob_chunk_positions = args.log_prob_chunk_positions
+    batching.log_prob_chunk_vocab = args.log_prob_chunk_vocab
+    batching.log_prob_dtype = args.log_prob_dtype
+    metrics.instrument(model)
+    print(f'{MODEL}: {format_load_report(model, metrics.load_seconds)}')
+    cache = None
+    if args.cache:
+        cache = ScoreCache(args.cache, MODEL, get_revision(model),
+                           max_bytes=args.cache_max_mb * 1024 * 1024 if args.cache_max_mb else None,
+                           load_mode=get_load_mode(model, args.quantize))
+    return model, tokenizer, cache
+
+def read_rows(reader, row_range=None):
+    # (row index, row) pairs of the whole file, or only of the rows in [start, stop)
+    rows = enumerate(reader)
+    if row_range is not None:
+        rows = islice(rows, *row_range)
+    return rows
+
+def get_known_prompts(journal, row_index, row, prompt_header, p_columns, prompt_mode):
+    # {prompt_id: generation, or {option: log prob} in options mode} of the templates of a row in the journal
+    pronouns = mapping[row['pronoun_type']]
+    known = {}
+    for prompt in range(len(get_pronoun_templates())):
+        data = journal.get(row_index, row.get('uid', ''), prompt)
+        if data is None:
+            continue
+        if prompt_mode == 'options':
+            known[prompt] = {p: float(data[prompt_header.index(column)]) for p, column in zip(pronouns, p_columns)}
+        else:
+            known[prompt] = data[prompt_header.index('generation')]
+    return known
+
+def score_file(args, MODEL, model_type, model, tokenizer, cache, data_file, out_file, row_range=None):
+    is_prompt = 'prompt' in out_file.name
+    print(out_file)
+    metrics.reset()
+    n_done = 0
+    # shrinks its batches for the rest of the file if the model runs out of memory
+    batcher = Batcher(args.batch_size, args.max_batch_tokens, args.mixed_length_batches)
+    if args.tokens_dir:
+        # token ids written ahead of time by pretokenize.py, if there are any for this file and tokenizer
+        tokenizer = load_pretokenized(args.tokens_dir, data_file, tokenizer)
+    # tokenize and decode time go into the metrics of the file
+    tokenizer = TimedTokenizer(tokenizer, metrics)
+    profiler = get_profiler(args.profile_window, out_file.with_name(out_file.name + '.trace.json'))
+    if is_prompt:
+        # encoder-decoder option scoring only tokenizes with options of its own
+        prefetch_kind = None if model_type == 'enc-dec' and args.prompt_mode == 'options' else 'prompts'
+    else:
+        # and so do minicons and diff-aware scoring
+        prefetch_kind = None if model_type == 'encoder' and args.encoder_scoring != 'batched' else 'sentences'
+    ahead = args.prefetch_chunks > 0 and prefetch_kind is not None
+    if ahead:
+        tokenizer = AheadTokenizer(tokenizer)
+
+    def prepare(indexed_chunk):
+        # runs in the reader thread of the pipeline: the texts the scorers will tokenize for the chunk are
+        # tokenized while the model works on the chunks before it
+        texts = []
+        if ahead:
+            texts = [text for row_index, row in indexed_chunk
+                     for text in get_row_texts(row, prefetch_kind, MODEL, model_type, args.prompt_mode == 'options')]
+            tokenizer.prefetch(texts)
+        return indexed_chunk, texts
+
+    header = [
+        'sentence',
+        'verbalized_token',
+        'pronoun_type',
+        'occupation',
+        'participant',
+        'word'
+    ]
+    if not is_prompt:
+        if model_type == 'encoder' and args.encoder_scoring == 'minicons':
+            mlm_scorer = scorer.MaskedLMScorer(model, tokenizer=tokenizer, device=device)
+        with TableReader(data_file) as reader:
+            p_columns = [f'p_{p}' for p in mapping['$NOM_PRONOUN']]
+            pll_header = header + p_columns
+            if 'pronoun' in reader.fieldnames:
+                pll_header += ['pronoun']
+            # rows finished by an earlier, interrupted run are skipped
+            journal = Journal(out_file, MODEL, data_file, get_load_mode(model, args.quantize))
+            pending = ((row_index, row) for row_index, row in read_rows(reader, row_range)
+                       if not journal.done(row_index, row.get('uid', '')))
+
+            def write_scores(indexed_chunk, chunk_associations):
+                with metrics.stage('write'):
+                    for (row_index, row), associations in zip(indexed_chunk, chunk_associations):
+                        pronouns = mapping[row['pronoun_type']]
+                        verbalized_token = sorted(associations.items(), key=lambda x: x[1], reverse=True)[0][0]
+
+                        data = [
+                            row['sentence'],
+                            verbalized_token,
+                            row['pronoun_type'],
+                            row['occupation'],
+                            row['participant'],
+                            row['word']
+                        ]
+                        data += [f'{associations[pronouns[n]]}' for n in range(len(pronouns))]
+                        if 'pronoun' in reader.fieldnames:
+                            data += [row['pronoun']]
+                        journal.add(row_index, row.get('uid', ''), None, data)
+                    journal.sync()
+
+            with Pipeline(iter_chunks(pending, args.chunk_size), prepare, write_scores, args.prefetch_chunks) as pipeline:
+                for indexed_chunk, texts in pipeline:
+                    chunk = [row for row_index, row in indexed_chunk]
+                    n_done += len(chunk)
+                    if model_type == 'encoder' and args.encoder_scoring == 'batched':
+                        # sentence-level pseudo log probabilities with different pronouns
+                        chunk_associations = get_encoder_log_probs_batch(
+                                [(row['sentence'], row['pronoun_type'], mapping[row['pronoun_type']]) for row in chunk],
+                                tokenizer,
+                                model,
+                                batcher=batcher,
+                                cache=cache
+                                )
+                    elif model_type == 'encoder' and args.encoder_scoring == 'diff-aware':
+                        # pseudo log probabilities with different pronouns, sharing the scores of the context
+                        chunk_associations = get_encoder_log_probs_diff_aware(
+                                [(row['sentence'], row['pronoun_type'], mapping[row['pronoun_type']]) for row in chunk],
+                                tokenizer,
+                                model,
+                                batcher=batcher,
+                                cache=cache
+                                )
+                    elif model_type == 'encoder':
+                        # sentence-level pseudo log probabilities with different pronouns
+                        chunk_associations = [get_encoder_log_probs(
+                                row['sentence'],
+                                row['pronoun_type'],
+                                mapping[row['pronoun_type']],
+                                mlm_scorer,
+                                cache=cache
+                                ) for row in chunk]
+                    elif args.decoder_scoring == 'shared-prefix':
+                        # sentence-level log probabilities with different pronouns, sharing the cached prefix
+                        chunk_associations = [get_decoder_log_probs_shared_prefix(
+                                row['sentence'],
+                                row['pronoun_type'],
+                                mapping[row['pronoun_type']],
+                                tokenizer,
+                                model,
+                                cache=cache
+                                ) for row in chunk]
+                    else:
+                        # sentence-level log probabilities with different pronouns
+                        chunk_associations = get_decoder_log_probs_batch(
+                                [(row['sentence'], row['pronoun_type'], mapping[row['pronoun_type']]) for row in chunk],
+                                tokenizer,
+                                model,
+                                batcher=batcher,
+                                cache=cache
+                                )
+                    pipeline.write(indexed_chunk, chunk_associations)
+                    if ahead:
+                        tokenizer.release(texts)
+                    if profiler:
+                        profiler.step()
+            with metrics.stage('write'):
+                journal.finalize(pll_header, float_columns=p_columns)
+    elif is_prompt:
+        with TableReader(data_file) as reader:
+            prompt_header = [
                 'sentence',
-                'verbalized_token',
+                'generation',
                 'pronoun_type',
                 'occupation',
                 'participant',
-                'word'
+                'word',
+                'prompt'
             ]
-            if not is_prompt:
-                if model_type == 'encoder':
-                    mlm_scorer = scorer.MaskedLMScorer(model, tokenizer=tokenizer, device=device)
-                with open(out_file, 'w') as out_f:
-                    with open(data_file) as f:
-                        reader = csv.DictReader(f, delimiter='\t')
-                        pll_header = header + [f'p_{p}' for p in mapping['$NOM_PRONOUN']]
-                        if 'pronoun' in reader.fieldnames:
-                            pll_header += ['pronoun']
-                        out_f.write('\t'.join(pll_header) + '\n')
-
-                        for row in reader:
-                            pronouns = mapping[row['pronoun_type']]
-                            if model_type == 'encoder':
-                                # sentence-level pseudo log probabilities with different pronouns
-                                associations = get_encoder_log_probs(
-                                        row['sentence'],
-                                        row['pronoun_type'],
-                                        pronouns,
-                                        mlm_scorer
-                                        )
-                            else:
-                                # sentence-level log probabilities with different pronouns
-                                associations = get_decoder_log_probs(
-                                        row['sentence'],
-                                        row['pronoun_type'],
-                                        pronouns,
-                                        tokenizer,
-                                        model
-                                        )
-                            verbalized_token = sorted(associations.items(), key=lambda x: x[1], reverse=True)[0][0]
+            p_columns = []
+            if args.prompt_mode == 'options':
+                # the best option goes into the generation column, followed by the log prob of every option
+                p_columns = [f'p_{p}' for p in mapping['$NOM_PRONOUN']]
+            prompt_header += p_columns
+            if 'pronoun' in reader.fieldnames:
+                prompt_header += ['pronoun']
+            journal = Journal(out_file, MODEL, data_file, get_load_mode(model, args.quantize))
+            n_prompts = len(get_pronoun_templates())
+            pending = ((row_index, row) for row_index, row in read_rows(reader, row_range)
+                       if not all(journal.done(row_index, row.get('uid', ''), prompt) for prompt in range(n_prompts)))
+            n_run = 0
+            n_run_before = 0
 
+            def write_generations(indexed_chunk, chunk_generations):
+                with metrics.stage('write'):
+                    for (row_index, row), generations in zip(indexed_chunk, chunk_generations):
+                        uid = row.get('uid', '')
+                        for prompt, generation, option_scores in generations:
+                            if journal.done(row_index, uid, prompt):
+                                continue
                             data = [
                                 row['sentence'],
-                                verbalized_token,
+                                generation,
                                 row['pronoun_type'],
                                 row['occupation'],
                                 row['participant'],
-                                row['word']
+                                row['word'],
+                                str(prompt)
                             ]
-                            data += [f'{associations[pronouns[n]]}' for n in range(len(pronouns))]
+                            data += option_scores
                             if 'pronoun' in reader.fieldnames:
                                 data += [row['pronoun']]
-                            out_f.write('\t'.join(data) + '\n')
-            elif is_prompt:
-                with open(out_file, 'w', encoding='utf-8') as prompt_out_f:
-                    with open(data_file) as f:
-                        reader = csv.DictReader(f, delimiter='\t')
-                        prompt_header = [
-                            'sentence',
-                            'generation',
-                            'pronoun_type',
-                            'occupation',
-                            'participant',
-                            'word',
-                            'prompt'
-                        ]
-                        if 'pronoun' in reader.fieldnames:
-                            prompt_header += ['pronoun']
-                        prompt_out_f.write('\t'.join(prompt_header) + '\n')
-
-                        for row in reader:
-                            pronouns = mapping[row['pronoun_type']]
-                            for prompt, generation in prompt_model(row['sentence'], row['pronoun_type'], pronouns, row['word'], tokenizer, model, model_type, MODEL):
-                                data = [
-                                    row['sentence'],
-                                    generation,
-                                    row['pronoun_type'],
-                                    row['occupation'],
-                                    row['participant'],
-                                    row['word'],
-                                    str(prompt)
-                                ]
-                                if 'pronoun' in reader.fieldnames:
-                                    data += [row['pronoun']]
-                                prompt_out_f.write('\t'.join(data) + '\n')
+                            journal.add(row_index, uid, prompt, data)
+                    journal.sync()
+
+            with Pipeline(iter_chunks(pending, args.chunk_size), prepare, write_generations, args.prefetch_chunks) as pipeline:
+                for indexed_chunk, texts in pipeline:
+                    chunk_rows = [(row['sentence'], row['pronoun_type'], mapping[row['pronoun_type']], row['word'])
+                                  for row_index, row in indexed_chunk]
+                    n_done += len(chunk_rows)
+                    if args.adaptive_templates:
+                        # templates that ran for a row before an interruption are replayed from the journal
+                        known = [get_known_prompts(journal, row_index, row, prompt_header, p_columns, args.prompt_mode)
+                                 for row_index, row in indexed_chunk]
+                        chunk_results = prompt_model_adaptive(chunk_rows, tokenizer, model, model_type, MODEL,
+                                                              args.template_order or range(n_prompts), args.quorum,
+                                                              args.confidence, args.prompt_mode, batcher=batcher,
+                                                              cache=cache, known=known)
+                        # templates replayed from the journal ran in an earlier process
+                        n_replayed = sum(result[0] in row_known for row_results, row_known in zip(chunk_results, known)
+                                         for result in row_results)
+                        n_run += sum(len(row_results) for row_results in chunk_results) - n_replayed
+                        n_run_before += n_replayed
+                        if args.prompt_mode == 'options':
+                            chunk_generations = [[(prompt, best, [f'{option_scores[p]}' for p in pronouns])
+                                                  for prompt, best, option_scores in row_results]
+                                                 for (sentence, pronoun_type, pronouns, word), row_results in zip(chunk_rows, chunk_results)]
+                        else:
+                            chunk_generations = [[(prompt, generation, []) for prompt, generation in row_results]
+                                                 for row_results in chunk_results]
+                    elif args.prompt_mode == 'options':
+                        chunk_generations = [[(prompt, best, [f'{option_scores[p]}' for p in pronouns])
+                                               for prompt, best, option_scores in row_results]
+                                              for (sentence, pronoun_type, pronouns, word), row_results in zip(chunk_rows,
+                                                  prompt_model_options(chunk_rows, tokenizer, model, model_type, MODEL, cache=cache))]
+                    else:
+                        chunk_generations = [[(prompt, generation, []) for prompt, generation in row_generations]
+                                             for row_generations in prompt_model_batch(
+                                                 chunk_rows,
+                                                 tokenizer,
+                                                 model,
+                                                 model_type,
+                                                 MODEL,
+                                                 batcher=batcher,
+                                                 cache=cache
+                                                 )]
+                    pipeline.write(indexed_chunk, chunk_generations)
+                    if ahead:
+                        tokenizer.release(texts)
+                    if profiler:
+                        profiler.step()
+            if args.adaptive_templates and n_done:
+                print(f'{out_file}: ran {n_run} of {n_done * n_prompts} prompts'
+                      + (f' ({n_run_before} more ran before the interruption)' if n_run_before else ''))
+            with metrics.stage('write'):
+                journal.finalize(prompt_header, float_columns=p_columns)
+    if profiler:
+        profiler.stop()
+    record = metrics.get_record(MODEL, data_file, out_file, n_done, row_range)
+    export_record(record, out_file.parent)
+    print(f'{out_file}: {n_done} rows in {record["seconds"]:.1f}s ({format_record(record)}); '
+          f'peak memory: {format_memory(record["peak_memory_bytes"])}')
+
+def main():
+    args = parse_args()
+
+    model_file_map = construct_model_file_map(args.data_files, args.output_format, args.quantize)
+
+    for MODEL in model_file_map:
+        model_type = model_file_map[MODEL][0][0]
+        model, tokenizer, cache = load_model(MODEL, model_type, args)
+        for model_type, data_file, out_file in model_file_map[MODEL]:
+            score_file(args, MODEL, model_type, model, tokenizer, cache, data_file, out_file)
 
 if __name__ == '__main__':
     main()
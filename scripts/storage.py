@@ -0,0 +1,179 @@
+import csv
+import sys
+from pathlib import Path
+import pandas as pd
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# columns with few distinct values that repeat in every row; stored dictionary-encoded in parquet files
+categorical_columns = ['occupation', 'participant', 'pronoun_type', 'word', 'pronoun', 'confuse_pronoun',
+                       'verbalized_token', 'uid']
+
+formats = {'.tsv': 'tsv', '.parquet': 'parquet'}
+
+def get_format(filename):
+    return formats.get(Path(filename).suffix, 'tsv')
+
+def get_suffix(output_format):
+    return {'tsv': '.tsv', 'parquet': '.parquet'}[output_format]
+
+def require_pyarrow():
+    if pa is None:
+        raise ImportError('parquet files require the pyarrow package')
+
+def encode_column(name, array, float_columns=()):
+    # string column as stored in parquet files
+    if name in float_columns:
+        return array.cast(pa.float64())
+    if name in categorical_columns:
+        return array.dictionary_encode()
+    return array
+
+def rows_to_arrow(rows, header, float_columns=()):
+    columns = list(zip(*rows)) or [[] for _ in header]
+    return pa.table([encode_column(name, pa.array(values, type=pa.string()), float_columns)
+                     for name, values in zip(header, columns)], names=header)
+
+def tsv_chunk_to_arrow(text, header, float_columns=()):
+    # arrow table of a block of tab-separated lines without header;
+    # cheap to pickle, so it can be built in a worker process
+    require_pyarrow()
+    return rows_to_arrow([line.split('\t') for line in text.splitlines()], header, float_columns)
+
+def read_table(filename, columns=None, categorical=False):
+    # pandas frame of a tsv or parquet file, optionally only with the given columns;
+    # dictionary-encoded parquet columns are only kept as categoricals on request, since those compare and group
+    # differently from the plain columns read from tsv files
+    if get_format(filename) == 'parquet':
+        require_pyarrow()
+        df = pd.read_parquet(filename, columns=columns)
+        if not categorical:
+            for column in df.columns:
+                if isinstance(df[column].dtype, pd.CategoricalDtype):
+                    df[column] = df[column].astype(object)
+        return df
+    return pd.read_csv(filename, sep='\t', usecols=columns)
+
+def read_arrow_table(filename):
+    require_pyarrow()
+    return pq.read_table(filename)
+
+def write_table(df, filename):
+    if get_format(filename) == 'parquet':
+        require_pyarrow()
+        df = df.copy()
+        for column in df.columns:
+            if column in categorical_columns:
+                df[column] = df[column].astype('category')
+        df.to_parquet(filename, index=False)
+    else:
+        df.to_csv(filename, sep='\t', index=None)
+
+class TableReader:
+    """Rows of a tsv or parquet file as dicts of strings, like csv.DictReader."""
+
+    def __init__(self, filename, columns=None, batch_size=65536):
+        self.filename = filename
+        self.format = get_format(filename)
+        if self.format == 'parquet':
+            require_pyarrow()
+            self.parquet_file = pq.ParquetFile(filename)
+            self.columns = columns
+            self.batch_size = batch_size
+            self.fieldnames = columns or self.parquet_file.schema_arrow.names
+        else:
+            self.f = open(filename, encoding='utf-8')
+            self.reader = csv.DictReader(self.f, delimiter='\t')
+            self.fieldnames = self.reader.fieldnames
+
+    def __iter__(self):
+        if self.format == 'tsv':
+            yield from self.reader
+            return
+        for batch in self.parquet_file.iter_batches(batch_size=self.batch_size, columns=self.columns):
+            for row in batch.to_pylist():
+                yield {k: '' if v is None else v if isinstance(v, str) else repr(v) for k, v in row.items()}
+
+    def close(self):
+        if self.format == 'tsv':
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class TableWriter:
+    """Writes rows of strings to a tsv file, or to a parquet file in row groups of dictionary-encoded columns.
+
+    Columns listed in float_columns are stored as float64 in parquet files.
+    """
+
+    def __init__(self, filename, header, float_columns=(), row_group_size=65536):
+        self.filename = filename
+        self.header = list(header)
+        self.format = get_format(filename)
+        self.float_columns = set(float_columns)
+        self.row_group_size = row_group_size
+        if self.format == 'parquet':
+            require_pyarrow()
+            self.rows = []
+            self.writer = None
+        else:
+            self.f = open(filename, 'w', encoding='utf-8')
+            self.f.write('\t'.join(self.header) + '\n')
+
+    def write_row(self, data):
+        if self.format == 'tsv':
+            self.f.write('\t'.join(data) + '\n')
+            return
+        self.rows.append(data)
+        if len(self.rows) >= self.row_group_size:
+            self.flush()
+
+    def write_tsv_chunk(self, text):
+        # a block of tab-separated lines without header, e.g. a chunk of add_context output
+        if self.format == 'tsv':
+            self.f.write(text)
+            return
+        self.flush()
+        self.write_arrow_table(tsv_chunk_to_arrow(text, self.header, self.float_columns))
+
+    def write_arrow_table(self, table):
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.filename, table.schema, compression='zstd')
+        self.writer.write_table(table)
+
+    def flush(self):
+        if self.format == 'tsv' or not self.rows:
+            return
+        self.write_arrow_table(rows_to_arrow(self.rows, self.header, self.float_columns))
+        self.rows = []
+
+    def close(self):
+        if self.format == 'tsv':
+            self.f.close()
+            return
+        self.flush()
+        if self.writer is None:
+            # no rows: still write a file with the right columns
+            self.write_arrow_table(rows_to_arrow([], self.header, self.float_columns))
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def main():
+    # convert between formats, e.g. python3 storage.py eo_task.tsv eo_task.parquet
+    assert len(sys.argv) == 3
+    write_table(read_table(sys.argv[1]), sys.argv[2])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+import bisect
+import csv
+import itertools
+from pathlib import Path
+import numpy as np
+from add_context import build_pronoun_type_template_mapping, build_context_plans, get_output_line, get_output_names, instantiate_template
+
+header = ['occupation', 'participant', 'sentence', 'pronoun_type', 'word', 'pronoun', 'uid', 'confuse_pronoun']
+
+# permutations of the 4 implicit continuations used for 1, 2, 3 and 4 implicit distractors;
+# 3 distractors use the first three positions of perm(S, 4), exactly like add_context
+implicit_permutations = {
+    0: [()],
+    1: list(itertools.permutations(range(4), 1)),
+    2: list(itertools.permutations(range(4), 2)),
+    3: [perm[:3] for perm in itertools.permutations(range(4), 4)],
+    4: list(itertools.permutations(range(4), 4)),
+}
+
+class IndexRanges:
+    """The indices of disjoint [start, end) ranges as one ascending sequence, without listing them."""
+
+    def __init__(self, ranges):
+        ranges = sorted(ranges)
+        self.starts = np.array([start for start, end in ranges])
+        self.sizes = np.array([end - start for start, end in ranges])
+        self.ends = np.cumsum(self.sizes)
+
+    def __len__(self):
+        return int(self.ends[-1])
+
+    def __getitem__(self, positions):
+        positions = np.asarray(positions)
+        range_ids = np.searchsorted(self.ends, positions, side='right')
+        return self.starts[range_ids] + positions - (self.ends[range_ids] - self.sizes[range_ids])
+
+class VirtualDataset:
+    """The instances of one add_context output file, computed on demand instead of read from disk.
+
+    Index n is the n-th data line of the file add_context would write for the same task and context
+    templates. depth is the number of context sentences, i.e. 1 for eo_task up to 6 for eo_ep_ip_ip_ip_ip_task.
+    """
+
+    def __init__(self, task_file, context_file, depth, occupation=True):
+        assert 1 <= depth <= 6
+        self.depth = depth
+        self.occupation = occupation
+        self.f = 'o' if occupation else 'p' # first
+        self.s = 'p' if occupation else 'o' # second
+        self.first = 'occupation' if occupation else 'participant'
+        self.second = 'participant' if occupation else 'occupation'
+        self.name = get_output_names(Path(task_file).stem, occupation)[depth - 1]
+        with open(task_file, encoding='utf-8') as f:
+            self.rows = list(csv.DictReader(f, delimiter='\t'))
+        self.pronoun_type_template_mapping = build_pronoun_type_template_mapping(context_file)
+        plans = build_context_plans(self.pronoun_type_template_mapping)
+        self.permutations = implicit_permutations[max(depth - 2, 0)]
+
+        # the combinations a row expands to, in output order; a single context sentence only depends on (i, pronoun1)
+        self.combinations = {}
+        for pronoun_type, plan in plans.items():
+            if depth == 1:
+                self.combinations[pronoun_type] = [(i, pronoun1, None, '', None) for i, pronoun1, seconds in plan]
+            else:
+                self.combinations[pronoun_type] = [(i, pronoun1, j, pronoun2, implicit_ks)
+                                                   for i, pronoun1, seconds in plan
+                                                   for j, pronoun2, implicit_ks in seconds]
+        self.combination_index = {pronoun_type: {c[:4]: n for n, c in enumerate(combinations)}
+                                  for pronoun_type, combinations in self.combinations.items()}
+
+        # first index of every task row
+        self.row_offsets = [0]
+        for row in self.rows:
+            self.row_offsets.append(self.row_offsets[-1] + len(self.combinations[row['pronoun_type']]) * len(self.permutations))
+
+    def __len__(self):
+        return self.row_offsets[-1]
+
+    def locate(self, index):
+        # (row index, combination, permutation) of an instance
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        row_index = bisect.bisect_right(self.row_offsets, index) - 1
+        local = index - self.row_offsets[row_index]
+        combination = self.combinations[self.rows[row_index]['pronoun_type']][local // len(self.permutations)]
+        return row_index, combination, self.permutations[local % len(self.permutations)]
+
+    def get_uid(self, combination, permutation):
+        i, pronoun1, j, pronoun2, implicit_ks = combination
+        parts = [f'e{self.f}{i}']
+        if j is not None:
+            parts.append(f'e{self.s}{j}')
+            parts += [f'i{self.s}{implicit_ks[position]}' for position in permutation]
+        return '_'.join(parts)
+
+    def get_line(self, index):
+        # the exact line add_context writes for this instance
+        row_index, (i, pronoun1, j, pronoun2, implicit_ks), permutation = self.locate(index)
+        row = self.rows[row_index]
+        pronoun_type = row['pronoun_type']
+        explicit_templates = self.pronoun_type_template_mapping['explicit_template'][pronoun_type]
+        implicit_templates = self.pronoun_type_template_mapping['implicit_template'][pronoun_type]
+        context = [instantiate_template(explicit_templates[i][0], row[self.first], pronoun_type, pronoun1)]
+        if j is not None:
+            context.append(instantiate_template(explicit_templates[j][0], row[self.second], pronoun_type, pronoun2))
+            context += [instantiate_template(implicit_templates[implicit_ks[position]][0], row[self.second], pronoun_type, pronoun2)
+                        for position in permutation]
+        uid = self.get_uid((i, pronoun1, j, pronoun2, implicit_ks), permutation)
+        return get_output_line(row, context, pronoun1, uid, pronoun2)
+
+    def __getitem__(self, index):
+        return dict(zip(header, self.get_line(index).rstrip('\n').split('\t')))
+
+    def get_index(self, row_index, uid, pronoun, confuse_pronoun=''):
+        # a uid names the templates but not the pronouns, so the pronoun (and confuse pronoun) are needed as well
+        parts = uid.split('_')
+        if len(parts) != self.depth:
+            raise ValueError(f'uid {uid} does not belong to {self.name}')
+        i = int(parts[0][2:])
+        j = int(parts[1][2:]) if self.depth > 1 else None
+        pronoun_type = self.rows[row_index]['pronoun_type']
+        key = (i, pronoun, j, confuse_pronoun if self.depth > 1 else '')
+        if key not in self.combination_index[pronoun_type]:
+            raise KeyError(f'no instance {uid} with pronouns {pronoun}/{confuse_pronoun} in row {row_index}')
+        n = self.combination_index[pronoun_type][key]
+        implicit_ks = self.combinations[pronoun_type][n][4]
+        positions = tuple(implicit_ks.index(int(part[2:])) for part in parts[2:])
+        return self.row_offsets[row_index] + n * len(self.permutations) + self.permutations.index(positions)
+
+    def get_strata(self, occupations_only=True):
+        # map (word, pronoun_type, pronoun, confuse_pronoun) to the index ranges of its instances;
+        # all permutations of one combination are contiguous, so no index is enumerated one by one
+        strata = {}
+        for row_index, row in enumerate(self.rows):
+            if occupations_only and row['occupation'] != row['word']:
+                continue
+            offset = self.row_offsets[row_index]
+            for n, (i, pronoun1, j, pronoun2, implicit_ks) in enumerate(self.combinations[row['pronoun_type']]):
+                start = offset + n * len(self.permutations)
+                key = (row['word'], row['pronoun_type'], pronoun1, pronoun2)
+                strata.setdefault(key, []).append((start, start + len(self.permutations)))
+        return strata
+
+    def get_groups(self, with_confuse_pronoun=None, occupations_only=True):
+        # the indices of every (word, pronoun_type, pronoun[, confuse_pronoun]) group, by default grouped like
+        # sample_templates.py groups the file: by the confuse pronoun as well unless there is only one context sentence
+        if with_confuse_pronoun is None:
+            with_confuse_pronoun = self.depth > 1
+        groups = {}
+        for (word, pronoun_type, pronoun, confuse_pronoun), ranges in self.get_strata(occupations_only).items():
+            key = (word, pronoun_type, pronoun, confuse_pronoun) if with_confuse_pronoun else (word, pronoun_type, pronoun)
+            groups.setdefault(key, []).extend(ranges)
+        return {key: IndexRanges(ranges) for key, ranges in groups.items()}
+
+    def sample(self, n, seed, with_confuse_pronoun=None, occupations_only=True):
+        """Stratified sample of n instances per (word, pronoun_type, pronoun[, confuse_pronoun]) group.
+
+        The indices are those of the rows pandas' groupby().sample(n, random_state=seed) picks from the file add_context
+        writes, in the same order, as sample_templates.py samples that file.
+        """
+        # sample_templates.py imports this module
+        from sample_templates import sample_groups
+        return sample_groups(self.get_groups(with_confuse_pronoun, occupations_only), n, seed).tolist()
+
+    def write(self, indices, filename):
+        with open(filename, 'w', encoding='utf-8') as out_f:
+            out_f.write('\t'.join(header) + '\n')
+            for index in indices:
+                out_f.write(self.get_line(index))
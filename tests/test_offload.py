@@ -0,0 +1,47 @@
+from types import SimpleNamespace
+import pytest
+import torch
+import score_models
+from checkpoint import Journal
+from offload import get_load_kwargs, get_load_mode
+
+class RecordingLoader:
+    # stands in for a transformers model class and keeps the arguments of from_pretrained
+    def __init__(self):
+        self.kwargs = None
+
+    def from_pretrained(self, model_name, **kwargs):
+        self.kwargs = kwargs
+        return self
+
+    def to(self, device):
+        return self
+
+@pytest.mark.parametrize('model_name, model_type', [
+    ('google/flan-t5-small', 'enc-dec'),
+    ('google/flan-t5-xl', 'enc-dec'),
+    ('meta-llama/Llama-2-13b-hf', 'decoder'),
+    ('facebook/opt-66b', 'decoder'),
+    ('EleutherAI/pythia-70m', 'decoder'),
+])
+def test_offloaded_models_load_in_the_dtype_of_get_model(monkeypatch, model_name, model_type):
+    loader = RecordingLoader()
+    monkeypatch.setattr(score_models, 'AutoModelForCausalLM', loader)
+    monkeypatch.setattr(score_models, 'T5ForConditionalGeneration', loader)
+    score_models.get_model(model_name, model_type)
+    for kwargs in [{'max_memory': 'cpu=1GiB'}, {'offload_dir': 'offload'}]:
+        assert get_load_kwargs(model_name, model_type, **kwargs)['torch_dtype'] == loader.kwargs['torch_dtype']
+
+def test_load_mode():
+    model = SimpleNamespace(dtype=torch.float16)
+    assert get_load_mode(model) == 'float16'
+    assert get_load_mode(model, '8bit') == 'float16-8bit'
+
+def test_journal_of_another_load_mode_is_not_continued(tmp_path):
+    out_file = tmp_path / 'model.tsv'
+    journal = Journal(out_file, 'model', 'data.tsv', 'float16')
+    journal.add(0, 'uid', None, ['row'])
+    journal.sync()
+    assert Journal(out_file, 'model', 'data.tsv', 'float16').done(0, 'uid')
+    with pytest.raises(ValueError):
+        Journal(out_file, 'model', 'data.tsv', 'float16-8bit')
@@ -0,0 +1,45 @@
+import os
+import pandas as pd
+import pytest
+from add_context import add_context, build_pronoun_type_template_mapping, get_output_names
+from benchmark import write_templates
+from sample_templates import sample_file
+from virtual_dataset import VirtualDataset
+
+@pytest.fixture(scope='module')
+def generated(tmp_path_factory):
+    # templates of benchmark.py and the full add_context output files made from them
+    work_dir = tmp_path_factory.mktemp('templates')
+    write_templates(work_dir, 12)
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        add_context(str(work_dir / 'task.tsv'), build_pronoun_type_template_mapping(work_dir / 'context.tsv'), occupation=True)
+    finally:
+        os.chdir(cwd)
+    return work_dir
+
+@pytest.mark.parametrize('depth', range(1, 7))
+@pytest.mark.parametrize('seed', [13, 17, 19])
+def test_virtual_sample_matches_pandas(generated, depth, seed):
+    name = get_output_names('task', True)[depth - 1]
+    df = pd.read_csv(generated / name, sep='\t')
+    occupations_only = df[df.occupation == df.word]
+    columns = ['word', 'pronoun_type', 'pronoun'] + (['confuse_pronoun'] if depth > 1 else [])
+    n = 3 if depth == 1 else 1
+    expected = occupations_only.groupby(columns).sample(n, random_state=seed)
+
+    dataset = VirtualDataset(generated / 'task.tsv', generated / 'context.tsv', depth)
+    sampled = dataset.sample(n, seed)
+    assert sampled == expected.index.tolist()
+    dataset.write(sampled, generated / f'virtual_{seed}_{name}')
+    assert (generated / f'virtual_{seed}_{name}').read_text() == expected.to_csv(sep='\t', index=None)
+
+def test_streaming_sample_matches_virtual(generated, monkeypatch):
+    monkeypatch.chdir(generated)
+    name = get_output_names('task', True)[2]
+    sample_file(name)
+    dataset = VirtualDataset(generated / 'task.tsv', generated / 'context.tsv', 3)
+    for seed in [13, 17, 19]:
+        dataset.write(dataset.sample(1, seed), f'virtual_{seed}_{name}')
+        assert (generated / f'{seed}_{name}').read_text() == (generated / f'virtual_{seed}_{name}').read_text()
@@ -0,0 +1,31 @@
+from score_cache import ScoreCache
+
+def get_sum(cache):
+    return cache.connection.execute('SELECT COALESCE(SUM(size), 0) FROM scores').fetchone()[0]
+
+def test_size_follows_inserts_replacements_and_evictions(tmp_path):
+    cache = ScoreCache(tmp_path / 'scores.db', 'model')
+    other = ScoreCache(tmp_path / 'scores.db', 'model')
+    cache.put_many('decoder', {f'text {n}': -float(n) for n in range(100)})
+    # another process replaces some of the entries
+    other.put_many('decoder', {f'text {n}': 'a longer value than before' for n in range(50)})
+    assert cache.get_size() == get_sum(cache) > 0
+    cache.max_bytes = cache.get_size() // 2
+    cache.put_many('decoder', {'one more': 0.0})
+    assert cache.get_size() == get_sum(cache) <= cache.max_bytes
+
+def test_size_of_a_cache_written_before_it_was_tracked(tmp_path):
+    cache = ScoreCache(tmp_path / 'scores.db', 'model')
+    cache.put_many('decoder', {f'text {n}': -float(n) for n in range(10)})
+    size = cache.get_size()
+    cache.connection.execute('DROP TABLE meta')
+    cache.connection.commit()
+    cache.close()
+    assert ScoreCache(tmp_path / 'scores.db', 'model').get_size() == size
+
+def test_load_modes_are_cached_apart(tmp_path):
+    full = ScoreCache(tmp_path / 'scores.db', 'model', 'abc', load_mode='float16')
+    quantized = ScoreCache(tmp_path / 'scores.db', 'model', 'abc', load_mode='float16-8bit')
+    full.put_many('decoder', {'text': -1.0})
+    assert quantized.get_many('decoder', ['text']) == {}
+    assert full.get_many('decoder', ['text']) == {'text': -1.0}